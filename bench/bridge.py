@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file bridge.py
+# Benchmarks the simulation bridge (playernsd.simulation.Simulation) on its
+# own, with bench/fakesim standing in for the simulator executable, and
+# reports the message throughput and latency through the pipes and the
+# property round trip time.
+
+import os
+import sys
+import time
+import optparse
+import threading
+
+from common import ROOT, percentile
+from playernsd.simulation import Simulation
+
+## Path of the stand-in simulator.
+FAKESIM = os.path.join(ROOT, 'bench', 'fakesim')
+
+## The receiving end of the benchmark.
+class Receiver():
+  ## Initialise the receiver.
+  # @param self The Receiver instance.
+  # @param window Maximum number of messages in flight.
+  def __init__(self, window):
+    self.window = window
+    self.inflight = 0
+    self.received = 0
+    self.latencies = []
+    self.propvals = []
+    self.cond = threading.Condition()
+  ## Wait until another message may be sent.
+  # @param self The Receiver instance.
+  def acquire(self):
+    with self.cond:
+      while self.window and self.inflight >= self.window:
+        # Dropped messages never come back, so don't wait for them forever
+        if not self.wait(1.0):
+          self.inflight = 0
+      self.inflight += 1
+  ## Wait for a change with a timeout.
+  # @param self The Receiver instance.
+  # @param timeout Seconds to wait.
+  # @return False if nothing was received in the time.
+  def wait(self, timeout):
+    received = self.received + len(self.propvals)
+    self.cond.wait(timeout)
+    return received != self.received + len(self.propvals)
+  ## Handle a batch of messages from the simulation.
+  # @param self The Receiver instance.
+  # @param batch List of (from, to, msg) tuples.
+  def recv_many(self, batch):
+    now = time.time()
+    with self.cond:
+      for _from, to, msg in batch:
+        count = isinstance(to, list) and len(to) or 1
+        self.latencies.extend([now - float(msg.split(' ', 1)[0])] * count)
+        self.received += count
+        self.inflight -= 1
+      self.cond.notify_all()
+  ## Handle a single message from the simulation.
+  # @param self The Receiver instance.
+  def recv(self, _from, to, msg):
+    self.recv_many([(_from, to, msg)])
+  ## Handle a property value from the simulation.
+  # @param self The Receiver instance.
+  def prop_val(self, _from, prop, val):
+    with self.cond:
+      self.propvals.append(time.time())
+      self.cond.notify_all()
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser(usage='usage: %prog [options]')
+  parser.add_option('-n', '--count', type='int', dest='count', default=50000,
+    help='number of messages to send [default: %default]')
+  parser.add_option('-b', '--size', type='int', dest='size', default=64,
+    help='message payload size in bytes [default: %default]')
+  parser.add_option('-c', '--clients', type='int', dest='clients', default=8,
+    help='number of clients [default: %default]')
+  parser.add_option('-w', '--window', type='int', dest='window', default=256,
+    help='messages in flight, 0 for unlimited [default: %default]')
+  parser.add_option('-g', '--propgets', type='int', dest='propgets',
+    default=1000, help='number of property round trips [default: %default]')
+  parser.add_option('-o', type='string', dest='sim_options', default='',
+    help='comma separated options to fakesim')
+  (options, args) = parser.parse_args()
+  receiver = Receiver(options.window)
+  sim = Simulation([FAKESIM] + (options.sim_options and
+    options.sim_options.split(',') or []), receiver.recv, receiver.prop_val,
+    receiver.recv_many)
+  names = ['robot%d' % i for i in range(options.clients)]
+  for name in names:
+    sim.new_client(name)
+  sim.daemon = True
+  sim.start()
+  # Messages between the clients
+  pad = 'x' * max(0, options.size - 18)
+  start = time.time()
+  for i in range(options.count):
+    if i % 1000 == 0 and sim.p.poll() != None:
+      print 'fakesim exited with ' + str(sim.p.returncode)
+      sys.exit(1)
+    receiver.acquire()
+    sim.send(names[i % len(names)], names[(i + 1) % len(names)],
+      '%.6f ' % time.time() + pad)
+  with receiver.cond:
+    while receiver.received < options.count and receiver.wait(1.0):
+      pass
+  elapsed = time.time() - start
+  latencies = sorted(receiver.latencies)
+  print 'messages:   %d sent, %d received in %.2f s, %.1f msgs/s' % (
+    options.count, receiver.received, elapsed, receiver.received / elapsed)
+  print 'latency:    p50 %.3f ms, p99 %.3f ms' % (
+    percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000)
+  # Property round trips, one at a time
+  sim.prop_set(names[0], 'self.position', '1.0 2.0 0.0')
+  roundtrips = []
+  for i in range(options.propgets):
+    sent = time.time()
+    with receiver.cond:
+      count = len(receiver.propvals)
+      sim.prop_get(names[0], 'self.position')
+      while len(receiver.propvals) == count and receiver.wait(1.0):
+        pass
+      if len(receiver.propvals) > count:
+        roundtrips.append(receiver.propvals[-1] - sent)
+  roundtrips.sort()
+  print 'propget:    %d round trips, p50 %.3f ms, p99 %.3f ms' % (
+    len(roundtrips), percentile(roundtrips, 50) * 1000,
+    percentile(roundtrips, 99) * 1000)
+  sim.stop()
+  sim.p.stdin.close()
+  sim.p.wait()
@@ -0,0 +1,434 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file common.py
+# Common helpers for the benchmarks: a protocol client, a daemon launcher
+# that samples the daemon's CPU and memory use, and a synthetic map.
+
+import os
+import sys
+import time
+import zlib
+import socket
+import random
+import threading
+import subprocess
+from struct import *
+
+## Root directory of the repository.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+from playernsd.compress import Decompressor
+
+## Get a percentile of a sorted list.
+# @param values The sorted values.
+# @param p The percentile (0-100).
+def percentile(values, p):
+  if not values:
+    return float('nan')
+  return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+## Find a free TCP port on localhost.
+def free_port():
+  s = socket.socket()
+  s.bind(('127.0.0.1', 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
+
+## Check whether a python module can be imported by the daemon's python.
+# @param module The module name.
+def has_module(module):
+  return subprocess.call([sys.executable, '-c', 'import ' + module],
+    stderr=open(os.devnull, 'w')) == 0
+
+## Write a synthetic occupancy map as a greyscale PNG.
+#
+# The map has walls around the border and a number of random rectangular
+# obstacles; black pixels are walls and white pixels are free space.
+# @param path The path to write the PNG to.
+# @param size The width and height in pixels.
+# @param obstacles The number of obstacles.
+# @param seed The random seed.
+def synthetic_map(path, size=400, obstacles=12, seed=1):
+  rnd = random.Random(seed)
+  rows = [bytearray('\xff' * size) for y in range(size)]
+  for y in range(size):
+    for x in (0, 1, size - 2, size - 1):
+      rows[y][x] = 0
+      rows[x][y] = 0
+  for i in range(obstacles):
+    w, h = rnd.randint(size / 40, size / 10), rnd.randint(size / 40, size / 10)
+    x0, y0 = rnd.randint(2, size - w - 2), rnd.randint(2, size - h - 2)
+    for y in range(y0, y0 + h):
+      rows[y][x0:x0 + w] = '\x00' * w
+  raw = ''.join('\x00' + str(r) for r in rows)
+  def chunk(kind, data):
+    return pack('>I', len(data)) + kind + data + \
+      pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+  with open(path, 'wb') as f:
+    f.write('\x89PNG\r\n\x1a\n')
+    f.write(chunk('IHDR', pack('>IIBBBBB', size, size, 8, 0, 0, 0, 0)))
+    f.write(chunk('IDAT', zlib.compress(raw)))
+    f.write(chunk('IEND', ''))
+
+## A playernsd daemon started for a benchmark.
+class Daemon():
+  ## Start the daemon.
+  # @param self The Daemon instance.
+  # @param args Additional arguments to the daemon.
+  # @param port The port to listen on (a free one by default).
+  # @param output File for the daemon's output (the terminal by default).
+  def __init__(self, args=[], port=None, output=None):
+    self.port = port or free_port()
+    self.address = ('127.0.0.1', self.port)
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, 'src'))
+    self.p = subprocess.Popen([sys.executable,
+      os.path.join(ROOT, 'src', 'playernsd'), '-q', '-l', os.devnull,
+      '-p', str(self.port)] + args, env=env, stdout=output, stderr=output)
+    self.wait_listening()
+  ## Wait until the daemon accepts connections.
+  # @param self The Daemon instance.
+  # @param timeout Seconds to wait.
+  def wait_listening(self, timeout=10.0):
+    end = time.time() + timeout
+    while time.time() < end:
+      if self.p.poll() != None:
+        raise RuntimeError('playernsd exited with ' + str(self.p.returncode))
+      try:
+        socket.create_connection(self.address).close()
+        return
+      except socket.error:
+        time.sleep(0.05)
+    raise RuntimeError('playernsd did not start listening')
+  ## Get the CPU time used by the daemon in seconds.
+  # @param self The Daemon instance.
+  def cpu(self):
+    with open('/proc/%d/stat' % self.p.pid) as f:
+      fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / \
+      float(os.sysconf('SC_CLK_TCK'))
+  ## Get the resident set size of the daemon in KiB.
+  # @param self The Daemon instance.
+  def rss(self):
+    with open('/proc/%d/status' % self.p.pid) as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1])
+    return 0
+  ## Stop the daemon.
+  # @param self The Daemon instance.
+  def stop(self):
+    if self.p.poll() == None:
+      self.p.terminate()
+      self.p.wait()
+
+## A protocol client for benchmarks.
+#
+# A reader thread parses the daemon's messages, answers pings and passes
+# the messages to the callbacks.
+class Client():
+  ## Connect and register with the daemon.
+  # @param self The Client instance.
+  # @param address The (host, port) of the daemon.
+  # @param name The client id.
+  # @param on_msg Callback taking (src, payload, binary) for messages.
+  # @param on_propval Callback taking (var, value) for property values.
+  # @param family The socket address family.
+  # @param compress Whether to ask for compressed binary messages.
+  # @param udp Whether to send and receive binary messages in datagrams
+  #        (see dgram).
+  def __init__(self, address, name, on_msg=None, on_propval=None,
+      family=socket.AF_INET, compress=False, udp=False):
+    self.prepare(name, on_msg, on_propval, compress)
+    self.open(address, family)
+    self.register(udp and ' udp' or '')
+    if udp:
+      # a unix socket client is on the daemon's host
+      self.subscribe(family == socket.AF_UNIX and '127.0.0.1' or address[0])
+  ## Set up the state of the client.
+  # @param self The Client instance.
+  # @param name The client id.
+  # @param on_msg Callback taking (src, payload, binary) for messages.
+  # @param on_propval Callback taking (var, value) for property values.
+  # @param compress Whether to ask for compressed binary messages.
+  def prepare(self, name, on_msg, on_propval, compress):
+    self.name = name
+    self.decompressor = compress and Decompressor() or None
+    self.on_msg = on_msg
+    self.on_propval = on_propval
+    self.errors = []
+    self.registered = threading.Event()
+    self.features = []
+    self.udp = None
+  ## Connect to the daemon and start the reader thread.
+  # @param self The Client instance.
+  # @param address The (host, port) of the daemon.
+  # @param family The socket address family.
+  def open(self, address, family):
+    self.sock = socket.socket(family, socket.SOCK_STREAM)
+    self.sock.connect(address)
+    if family == socket.AF_INET:
+      self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.__lock = threading.Lock()
+    self.__data = ''
+    self.__reader = threading.Thread(target=self.read)
+    self.__reader.daemon = True
+    self.__reader.start()
+  ## Register with the daemon.
+  # @param self The Client instance.
+  # @param features Further features to ask for.
+  def register(self, features=''):
+    self.send('greetings ' + self.name + ' playernsd 0001' +
+      (self.decompressor and ' zlib' or '') + features + '\n')
+    if not self.registered.wait(10.0):
+      raise RuntimeError(self.name + ' could not register')
+  ## Send raw data to the daemon.
+  # @param self The Client instance.
+  # @param data The data to send.
+  def send(self, data):
+    with self.__lock:
+      self.sock.sendall(data)
+  ## Send a text message.
+  # @param self The Client instance.
+  # @param text The text (without newlines).
+  # @param to The destination client id, or None to broadcast.
+  def msgtext(self, text, to=None):
+    self.send('msgtext' + (to and ' ' + to or '') + '\n' + text + '\n')
+  ## Send a binary message.
+  # @param self The Client instance.
+  # @param data The binary data.
+  # @param to The destination client id, or None to broadcast.
+  def msgbin(self, data, to=None):
+    self.send('msgbin' + (to and ' ' + to or '') + ' ' + str(len(data)) +
+      '\n' + data)
+  ## Subscribe to messages sent in datagrams.
+  # @param self The Client instance.
+  # @param host The host of the daemon.
+  def subscribe(self, host):
+    udp = [f for f in self.features if f.startswith('udp:')]
+    if not udp:
+      raise RuntimeError(self.name + ' was not given a datagram token')
+    port, self.token = udp[0].split(':')[1:]
+    self.udp_address = (host, int(port))
+    self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.udp.settimeout(0.2)
+    # the subscription or its answer may be lost
+    for i in range(50):
+      self.udp.sendto(self.token + ' subscribe\n', self.udp_address)
+      try:
+        if self.udp.recv(65535) == 'subscribed\n':
+          break
+      except socket.timeout:
+        pass
+    else:
+      raise RuntimeError(self.name + ' could not subscribe')
+    self.udp.settimeout(None)
+    reader = threading.Thread(target=self.read_datagrams)
+    reader.daemon = True
+    reader.start()
+  ## Send a binary message in a datagram.
+  # @param self The Client instance.
+  # @param data The binary data.
+  # @param to The destination client id, or None to broadcast.
+  def dgram(self, data, to=None):
+    self.udp.sendto(self.token + ' msgbin' + (to and ' ' + to or '') + ' ' +
+      str(len(data)) + '\n' + data, self.udp_address)
+  ## Datagram reader thread routine.
+  # @param self The Client instance.
+  def read_datagrams(self):
+    try:
+      while True:
+        data = self.udp.recv(65535)
+        line, data = data.split('\n', 1)
+        command = line.split(' ')
+        if command[0] == 'msgbin' and self.on_msg:
+          self.on_msg(command[1], data, True)
+    except socket.error:
+      pass
+  ## Send several binary messages in one msgbatch.
+  # @param self The Client instance.
+  # @param batch List of (to, data) tuples, where to is None to broadcast.
+  def msgbatch(self, batch):
+    body = ''.join(['msgbin' + (to and ' ' + to or '') + ' ' +
+      str(len(data)) + '\n' + data for to, data in batch])
+    self.send('msgbatch %d %d\n' % (len(batch), len(body)) + body)
+  ## Read a number of bytes from the buffered data and the socket.
+  # @param self The Client instance.
+  # @param n The number of bytes.
+  def read_bytes(self, n):
+    while len(self.__data) < n:
+      d = self.sock.recv(65536)
+      if not d:
+        raise EOFError()
+      self.__data += d
+    data, self.__data = self.__data[:n], self.__data[n:]
+    return data
+  ## Read a line from the buffered data and the socket.
+  # @param self The Client instance.
+  def read_line(self):
+    while '\n' not in self.__data:
+      d = self.sock.recv(65536)
+      if not d:
+        raise EOFError()
+      self.__data += d
+    line, self.__data = self.__data.split('\n', 1)
+    return line
+  ## Reader thread routine.
+  # @param self The Client instance.
+  def read(self):
+    try:
+      while True:
+        self.receive(self.read_line())
+    except (EOFError, socket.error):
+      pass
+  ## Handle a message from the daemon, reading the rest of it.
+  # @param self The Client instance.
+  # @param line The first line of the message.
+  def receive(self, line):
+    command = line.split(' ')
+    cmd = command[0]
+    if cmd == 'ping':
+      self.send('pong\n')
+    elif cmd == 'registered':
+      self.features = command[1:]
+      self.registered.set()
+    elif cmd == 'msgtext':
+      text = self.read_line()
+      if self.on_msg:
+        self.on_msg(command[1], text, False)
+    elif cmd == 'msgbin' or cmd == 'msgbinz':
+      data = self.read_bytes(int(command[2]))
+      if cmd == 'msgbinz':
+        data = self.decompressor.decompress(data)
+      if self.on_msg:
+        self.on_msg(command[1], data, True)
+    elif cmd == 'propval':
+      if self.on_propval:
+        self.on_propval(command[1], ' '.join(command[2:]))
+    elif cmd == 'stats':
+      self.read_bytes(int(command[1]))
+    elif cmd == 'error':
+      self.errors.append(line)
+  ## Disconnect from the daemon.
+  # @param self The Client instance.
+  def close(self):
+    try:
+      self.send('bye\n')
+    except socket.error:
+      pass
+    self.sock.close()
+    if self.udp:
+      self.udp.close()
+
+## A gateway connection carrying many clients.
+#
+# The clients are connected with connect and used like a Client.
+class Gateway(Client):
+  ## Connect to the daemon and open the gateway.
+  # @param self The Gateway instance.
+  # @param address The (host, port) of the daemon.
+  # @param family The socket address family.
+  def __init__(self, address, family=socket.AF_INET):
+    self.prepare('gateway', None, None, False)
+    self.clients = {}
+    self.opened = threading.Event()
+    self.open(address, family)
+    self.send('gateway\n')
+    if not self.opened.wait(10.0):
+      raise RuntimeError('could not open a gateway')
+  ## Connect and register a client over the gateway.
+  # @param self The Gateway instance.
+  # @param name The client id.
+  # @param on_msg Callback taking (src, payload, binary) for messages.
+  # @param on_propval Callback taking (var, value) for property values.
+  # @param compress Whether to ask for compressed binary messages.
+  # @return The SubClient instance.
+  def connect(self, name, on_msg=None, on_propval=None, compress=False):
+    c = SubClient(self, len(self.clients) + 1, name, on_msg, on_propval,
+      compress)
+    self.clients[c.handle] = c
+    c.register()
+    return c
+  ## Handle a message from the daemon, passing frames to the clients.
+  # @param self The Gateway instance.
+  # @param line The first line of the message.
+  def receive(self, line):
+    if line.startswith('sub '):
+      command = line.split(' ')
+      data = self.read_bytes(int(command[2]))
+      if data:
+        self.clients[int(command[1])].feed(data)
+    elif line == 'gateway':
+      self.opened.set()
+    else:
+      Client.receive(self, line)
+
+## A client on a gateway connection.
+class SubClient(Client):
+  ## Set up the client.
+  # @param self The SubClient instance.
+  # @param gateway The Gateway instance.
+  # @param handle The handle of the client on the gateway connection.
+  # @param name The client id.
+  # @param on_msg Callback taking (src, payload, binary) for messages.
+  # @param on_propval Callback taking (var, value) for property values.
+  # @param compress Whether to ask for compressed binary messages.
+  def __init__(self, gateway, handle, name, on_msg, on_propval, compress):
+    self.prepare(name, on_msg, on_propval, compress)
+    self.gateway = gateway
+    self.handle = handle
+    self.data = ''
+  ## Send commands to the daemon.
+  # @param self The SubClient instance.
+  # @param data The commands.
+  def send(self, data):
+    self.gateway.send('sub %d %d\n' % (self.handle, len(data)) + data)
+  ## Read a number of bytes from the frame being handled.
+  # @param self The SubClient instance.
+  # @param n The number of bytes.
+  def read_bytes(self, n):
+    data, self.data = self.data[:n], self.data[n:]
+    return data
+  ## Read a line from the frame being handled.
+  # @param self The SubClient instance.
+  def read_line(self):
+    line, self.data = self.data.split('\n', 1)
+    return line
+  ## Handle the messages in a frame for the client.
+  # @param self The SubClient instance.
+  # @param data The frame.
+  def feed(self, data):
+    self.data = data
+    while self.data:
+      self.receive(self.read_line())
+  ## Disconnect the client.
+  # @param self The SubClient instance.
+  def close(self):
+    self.gateway.send('sub %d 0\n' % self.handle)
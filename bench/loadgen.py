@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file loadgen.py
+# Synthetic multi-robot load generator.
+#
+# Starts a local playernsd for each scenario (no simulation, the passthrough
+# example, the lineofsight example on a synthetic map, and the fakesim
+# stand-in for an external simulator), connects a growing number of clients
+# that exchange timestamped messages and properties, and reports the
+# delivery rate, the delivery latency and the CPU and memory used by the
+# daemon.
+
+import os
+import sys
+import time
+import random
+import tempfile
+import optparse
+import threading
+import socket
+
+from common import ROOT, Client, Daemon, Gateway, free_port, percentile, synthetic_map, has_module
+
+## Width and height of the simulated world for lineofsight in metres.
+WORLD = 100.0
+
+## Operations performed by the clients, with their relative weights.
+OPERATIONS = [('msgtext', 4), ('msgbin', 4), ('broadcast', 1),
+  ('propget', 1), ('propset', 1)]
+
+## Get the daemon arguments for a scenario.
+# @param scenario The scenario name.
+# @param workdir Directory for generated files.
+def scenario_args(scenario, workdir):
+  if scenario == 'none':
+    return []
+  elif scenario == 'passthrough':
+    return [os.path.join(ROOT, 'examples', 'passthrough.py')]
+  elif scenario == 'fakesim':
+    return [os.path.join(ROOT, 'bench', 'fakesim')]
+  elif scenario == 'lineofsight':
+    path = os.path.join(workdir, 'map.png')
+    synthetic_map(path)
+    return ['-o', 'image=%s,width=%g,height=%g' % (path, WORLD, WORLD),
+      os.path.join(ROOT, 'examples', 'lineofsight.py')]
+  raise ValueError('unknown scenario ' + scenario)
+
+## A robot generating load.
+class Robot(threading.Thread):
+  ## Connect the robot.
+  # @param self The Robot instance.
+  # @param address The (host, port) of the daemon.
+  # @param name The client id.
+  # @param peers The client ids of all robots.
+  # @param rate Operations per second (0 for as fast as possible).
+  # @param size The message payload size in bytes.
+  # @param seed The random seed.
+  # @param compress Whether to ask for compressed binary messages.
+  # @param gateway The Gateway to connect over (its own connection if None).
+  # @param udp Whether to send binary messages in datagrams.
+  # @param family The socket address family of the address.
+  def __init__(self, address, name, peers, rate, size, seed, compress=False,
+      gateway=None, udp=False, family=socket.AF_INET):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.peers = [p for p in peers if p != name] or [name]
+    self.rate = rate
+    self.size = size
+    self.random = random.Random(seed)
+    self.sent = 0
+    self.received = 0
+    self.latencies = []
+    self.__propgets = []
+    self.__ops = [op for op, w in OPERATIONS for i in range(w)]
+    self.running = True
+    if gateway:
+      self.client = gateway.connect(name, self.on_msg, self.on_propval,
+        compress)
+    else:
+      self.client = Client(address, name, self.on_msg, self.on_propval,
+        family, compress, udp)
+    self.send_bin = udp and self.client.dgram or self.client.msgbin
+    # Place the robot, which lineofsight needs to deliver anything
+    p = WORLD * 0.45
+    self.client.send('propset self.position %f %f 0\n' %
+      (self.random.uniform(-p, p), self.random.uniform(-p, p)))
+  ## Handle a message delivered to the robot.
+  # @param self The Robot instance.
+  # @param src The sender.
+  # @param payload The payload.
+  # @param binary Whether the message was msgbin.
+  def on_msg(self, src, payload, binary):
+    self.received += 1
+    self.latencies.append(time.time() - float(payload.split(' ', 1)[0]))
+  ## Handle a property value delivered to the robot.
+  # @param self The Robot instance.
+  # @param var The property name.
+  # @param value The property value.
+  def on_propval(self, var, value):
+    if self.__propgets:
+      self.latencies.append(time.time() - self.__propgets.pop(0))
+      self.received += 1
+  ## Perform a single operation.
+  # @param self The Robot instance.
+  def operate(self):
+    op = self.random.choice(self.__ops)
+    now = time.time()
+    # Payloads start with the send time, as the simulation may deliver a
+    # text message as a binary one
+    stamp = '%.6f ' % now
+    if op == 'msgtext':
+      self.client.msgtext(stamp + 'x' * (self.size - len(stamp)),
+        self.random.choice(self.peers))
+    elif op == 'msgbin':
+      self.send_bin(stamp + '\0' * (self.size - len(stamp)),
+        self.random.choice(self.peers))
+    elif op == 'broadcast':
+      self.send_bin(stamp + '\0' * (self.size - len(stamp)))
+    elif op == 'propget':
+      self.__propgets.append(now)
+      self.client.send('propget self.position\n')
+    elif op == 'propset':
+      self.client.send('propset self.heading %f\n' % self.random.random())
+    self.sent += 1
+  ## Generate load until stopped.
+  # @param self The Robot instance.
+  def run(self):
+    next = time.time()
+    while self.running:
+      self.operate()
+      if self.rate:
+        next += 1.0 / self.rate
+        delay = next - time.time()
+        if delay > 0:
+          time.sleep(delay)
+
+## Run a scenario with a number of robots.
+# @param scenario The scenario name.
+# @param workdir Directory for generated files.
+# @param count The number of robots.
+# @param options The command line options.
+def run(scenario, workdir, count, options):
+  # The daemon may still be working through a backlog when it is stopped,
+  # so its output goes to a file rather than the report
+  output = open(os.path.join(workdir, 'playernsd-%s-%d.log' %
+    (scenario, count)), 'w')
+  args = scenario_args(scenario, workdir)
+  if options.udp:
+    args += ['--udp-port', str(free_port())]
+  address, family = None, socket.AF_INET
+  if options.unix:
+    address, family = os.path.join(workdir, 'playernsd.sock'), socket.AF_UNIX
+    args += ['--unix', address]
+  daemon = Daemon(args, output=output)
+  address = address or daemon.address
+  try:
+    names = ['robot%d' % i for i in range(count)]
+    per = options.gateway
+    gateways = [Gateway(address, family) for i in
+      range(per and (count + per - 1) / per or 0)]
+    robots = [Robot(address, n, names, options.rate, options.size, i,
+      options.compress, per and gateways[i / per] or None, options.udp,
+      family) for i, n in enumerate(names)]
+    cpu, start = daemon.cpu(), time.time()
+    for r in robots:
+      r.start()
+    time.sleep(options.duration)
+    for r in robots:
+      r.running = False
+    elapsed = time.time() - start
+    cpu = daemon.cpu() - cpu
+    rss = daemon.rss()
+    # Let deliveries in flight arrive
+    time.sleep(options.linger)
+    latencies = sorted(l for r in robots for l in r.latencies)
+    for r in robots:
+      r.client.close()
+    for g in gateways:
+      g.close()
+  finally:
+    daemon.stop()
+    output.close()
+  return {'scenario': scenario, 'clients': count,
+    'sent': sum(r.sent for r in robots),
+    'received': sum(r.received for r in robots),
+    'rate': sum(r.received for r in robots) / elapsed,
+    'p50': percentile(latencies, 50) * 1000,
+    'p99': percentile(latencies, 99) * 1000,
+    'cpu': cpu / elapsed * 100, 'rss': rss}
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser(usage='usage: %prog [options]')
+  parser.add_option('-c', '--clients', type='string', dest='clients',
+    default='1,2,4,8,16,32', help='comma separated client counts [default: %default]')
+  parser.add_option('-S', '--scenario', type='string', dest='scenarios',
+    default='none,passthrough,lineofsight,fakesim',
+    help='comma separated scenarios [default: %default]')
+  parser.add_option('-d', '--duration', type='float', dest='duration',
+    default=5.0, help='seconds to run each test [default: %default]')
+  parser.add_option('-r', '--rate', type='float', dest='rate', default=50.0,
+    help='operations per second per client, 0 for unlimited [default: %default]')
+  parser.add_option('-b', '--size', type='int', dest='size', default=64,
+    help='message payload size in bytes [default: %default]')
+  parser.add_option('--linger', type='float', dest='linger', default=1.0,
+    help='seconds to wait for deliveries after a test [default: %default]')
+  parser.add_option('-z', '--compress', action='store_true', dest='compress',
+    default=False, help='ask for compressed binary messages')
+  parser.add_option('-x', '--unix', action='store_true', dest='unix',
+    default=False, help='connect over a unix domain socket instead of TCP')
+  parser.add_option('-u', '--udp', action='store_true', dest='udp',
+    default=False, help='send binary messages in datagrams')
+  parser.add_option('-g', '--gateway', type='int', dest='gateway', default=0,
+    metavar='N', help='connect N clients over each gateway connection, '
+    '0 for a connection each [default: %default]')
+  (options, args) = parser.parse_args()
+  workdir = tempfile.mkdtemp(prefix='playernsd-loadgen-')
+  print '%-12s %7s %8s %8s %10s %8s %8s %6s %8s' % ('scenario', 'clients',
+    'sent', 'received', 'msgs/s', 'p50 ms', 'p99 ms', 'cpu %', 'rss KiB')
+  for scenario in options.scenarios.split(','):
+    if scenario == 'lineofsight' and not has_module('Image'):
+      print '%-12s skipped (the Python Imaging Library is not installed)' % \
+        scenario
+      continue
+    for count in map(int, options.clients.split(',')):
+      r = run(scenario, workdir, count, options)
+      print '%(scenario)-12s %(clients)7d %(sent)8d %(received)8d ' \
+        '%(rate)10.1f %(p50)8.2f %(p99)8.2f %(cpu)6.1f %(rss)8d' % r
+      sys.stdout.flush()
+  print 'Daemon output is in ' + workdir
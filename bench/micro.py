@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file micro.py
+# Micro-benchmarks of the daemon's hot paths: the handle() framing parser,
+# ClientManager.broadcast, Simulation.prop_substitution, Writer packing,
+# Simulation.run frame parsing and lineofsight's trace.
+#
+# Results can be saved as a JSON baseline in bench/baselines and compared
+# against later runs, flagging benchmarks that got slower than a threshold.
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import platform
+import tempfile
+import optparse
+import threading
+from Queue import Queue
+from collections import OrderedDict
+from struct import *
+
+from common import ROOT, synthetic_map, has_module
+import playernsd.__main__ as daemon
+from playernsd.simulation import Simulation, Writer, MessageType
+
+## Directory the baselines are stored in.
+BASELINES = os.path.join(ROOT, 'bench', 'baselines')
+
+## A socket that discards everything sent to it.
+class NullSocket():
+  def send(self, data, flags=0):
+    return len(data)
+  def sendall(self, data):
+    pass
+  def shutdown(self, how):
+    pass
+
+## A socket that returns a canned byte stream in chunks, then end of file.
+class StreamSocket(NullSocket):
+  ## Initialise the socket.
+  # @param self The StreamSocket instance.
+  # @param chunks The list of chunks to return from recv.
+  def __init__(self, chunks):
+    self.chunks = iter(chunks)
+  def recv(self, n):
+    return next(self.chunks, '')
+
+## A stream that discards everything written to it.
+class NullStream():
+  def write(self, data):
+    pass
+
+## A stand-in for the simulation writer, for running Simulation.run alone.
+class NullWriter():
+  def disconnect(self, socket):
+    pass
+  def stop(self):
+    pass
+  def join(self):
+    pass
+
+## A request handler that is not set up by a server.
+class Handler(daemon.TCPRequestHandler):
+  def __init__(self, request, client_address):
+    self.request = request
+    self.client_address = client_address
+
+## Create a client manager with a number of registered clients.
+# @param count The number of clients.
+# @return List of client addresses.
+def clients(count):
+  daemon.simulation = None
+  daemon.client_manager = daemon.ClientManager(1.0, 3, None)
+  addresses = []
+  for i in range(count):
+    ca = ('127.0.0.1', 10000 + i)
+    daemon.client_manager.add_client(ca, NullSocket())
+    daemon.client_manager.register_client(ca, 'robot%d' % i, daemon.VERSION)
+    addresses.append(ca)
+  return addresses
+
+## Benchmark the handle() parser on a canned stream of commands.
+# @return The function to time and the number of commands it handles.
+def bench_handle():
+  ca = clients(2)[0]
+  stream = ''
+  for i in range(250):
+    stream += 'msgtext robot1\n' + 'x' * 60 + '\n'
+    stream += 'msgbin robot1 64\n' + '\0' * 64
+    stream += 'ping\n'
+    stream += 'propget x\n'
+  chunks = [stream[i:i+daemon.MAX_READ]
+    for i in range(0, len(stream), daemon.MAX_READ)]
+  def run():
+    Handler(StreamSocket(chunks), ca).handle()
+  return run, 1000
+
+## Benchmark the handle() parser on binary messages sent one by one.
+# @return The function to time and the number of messages it handles.
+def bench_msgbin():
+  ca = clients(11)[0]
+  stream = ''
+  for i in range(1000):
+    stream += 'msgbin robot%d 64\n' % (i % 10 + 1) + '\0' * 64
+  chunks = [stream[i:i+daemon.MAX_READ]
+    for i in range(0, len(stream), daemon.MAX_READ)]
+  def run():
+    Handler(StreamSocket(chunks), ca).handle()
+  return run, 1000
+
+## Benchmark the handle() parser on binary messages sent in batches of 10.
+# @return The function to time and the number of messages it handles.
+def bench_msgbatch():
+  ca = clients(11)[0]
+  body = ''
+  for i in range(10):
+    body += 'msgbin robot%d 64\n' % (i + 1) + '\0' * 64
+  stream = ('msgbatch 10 %d\n' % len(body) + body) * 100
+  chunks = [stream[i:i+daemon.MAX_READ]
+    for i in range(0, len(stream), daemon.MAX_READ)]
+  def run():
+    Handler(StreamSocket(chunks), ca).handle()
+  return run, 1000
+
+## Benchmark a broadcast to 64 clients without a simulation.
+# @return The function to time and the number of broadcasts.
+def bench_broadcast():
+  clients(64)
+  msg = 'msgbin robot0 64\n' + '\0' * 64
+  def run():
+    for i in range(100):
+      daemon.client_manager.broadcast(msg)
+  return run, 100
+
+## Benchmark messages between virtual clients in the daemon's process.
+# @return The function to time and the number of messages.
+def bench_inproc():
+  clients(0)
+  sender = daemon.client_manager.connect('robot0')
+  receiver = daemon.client_manager.connect('robot1')
+  msg = '\0' * 64
+  def run():
+    for i in range(1000):
+      sender.send('robot1', msg)
+    for i in range(1000):
+      receiver.recv()
+  return run, 1000
+
+## Create a simulation with a number of clients without starting it.
+# @param count The number of clients.
+def simulation(count):
+  sim = Simulation.__new__(Simulation)
+  sim.cidi = [0]
+  sim.cidt = [0]
+  sim.ids = ['__broadcast__']
+  sim.names = {'__broadcast__':0}
+  sim.cidn = 1
+  sim.count = 0
+  for i in range(count):
+    sim.new_client('robot%d' % i, i + 1)
+  return sim
+
+## Benchmark property name substitution with 64 clients.
+# @return The function to time and the number of substitutions.
+def bench_prop_substitution():
+  sim = simulation(64)
+  def run():
+    for i in range(1000):
+      sim.prop_substitution(5, 'self.position')
+      sim.prop_substitution(0, 'robot63.position')
+      sim.prop_substitution(0, 'channel.loss')
+  return run, 3000
+
+## Benchmark packing frames for the simulation executable.
+# @return The function to time and the number of frames.
+def bench_writer():
+  writer = Writer(NullStream())
+  msg = '\0' * 64
+  def run():
+    writer.send_queue = Queue()
+    for i in range(1000):
+      writer.send(1, 2, msg)
+      writer.prop_set('__node1.position', '1.0 2.0 0.0')
+  return run, 2000
+
+## Benchmark parsing frames from the simulation executable.
+# @return The function to time and the number of frames.
+def bench_sim_run():
+  msg = '\0' * 64
+  frames = []
+  for i in range(2000):
+    frames.append(pack('<BIII', MessageType.RECV, 1 + i % 64,
+      1 + (i + 1) % 64, len(msg)) + msg)
+    if i % 20 == 0:
+      frames.append(pack('<BII', MessageType.RECVMANY, 1, 63) +
+        pack('<63I', *range(2, 65)) + pack('<I', len(msg)) + msg)
+      propval = 'robot2.position\0' + '1.0 2.0 0.0\0'
+      frames.append(pack('<BII', MessageType.PROPVAL, 2, len(propval)) +
+        propval)
+  f = tempfile.TemporaryFile()
+  f.write(''.join(frames))
+  class Process():
+    stdout = f
+  received = []
+  def run():
+    sim = simulation(64)
+    sim.p = Process()
+    sim.writer = NullWriter()
+    sim.stepped = threading.Event()
+    sim.marked = OrderedDict()
+    sim.marked_lock = threading.Lock()
+    sim.recv_callback = lambda _from, to, msg: None
+    sim.recv_many_callback = received.extend
+    sim.prop_val_callback = lambda _from, prop, val: None
+    f.seek(0)
+    sim.run()
+  return run, len(frames)
+
+## Benchmark lineofsight's trace on fixed synthetic maps.
+# @return The function to time and the number of traces.
+def bench_trace():
+  import imp
+  module = imp.load_source('lineofsight',
+    os.path.join(ROOT, 'examples', 'lineofsight.py'))
+  workdir = tempfile.mkdtemp(prefix='playernsd-micro-')
+  sims = []
+  for seed in (1, 2):
+    path = os.path.join(workdir, 'map%d.png' % seed)
+    synthetic_map(path, seed=seed)
+    sims.append(module.Simulation(['lineofsight.py', 'image=' + path,
+      'width=100', 'height=100'], None, None))
+  points = [((-40, -40), (40, 40)), ((-45, 0), (45, 0)),
+    ((0, -45), (0, 45)), ((-10, 30), (35, -20))]
+  def run():
+    for i in range(25):
+      for sim in sims:
+        for p0, p1 in points:
+          sim.trace(p0, p1)
+  return run, 25 * len(sims) * len(points)
+
+## The benchmarks by name, with the modules they need.
+BENCHMARKS = [('handle', bench_handle, None),
+  ('msgbin', bench_msgbin, None),
+  ('msgbatch', bench_msgbatch, None),
+  ('broadcast', bench_broadcast, None),
+  ('inproc', bench_inproc, None),
+  ('prop_substitution', bench_prop_substitution, None),
+  ('writer', bench_writer, None),
+  ('sim_run', bench_sim_run, None),
+  ('trace', bench_trace, 'Image')]
+
+## Run the benchmarks.
+# @param pattern Only run benchmarks whose name contains this.
+# @param repeat The number of times to time each benchmark.
+# @return Dictionary of benchmark name to seconds per operation.
+def run(pattern, repeat):
+  results = {}
+  for name, setup, module in BENCHMARKS:
+    if pattern and pattern not in name:
+      continue
+    if module and not has_module(module):
+      print '%-18s skipped (needs %s)' % (name, module)
+      continue
+    fn, ops = setup()
+    best = None
+    for i in range(repeat):
+      start = time.time()
+      fn()
+      elapsed = time.time() - start
+      if best == None or elapsed < best:
+        best = elapsed
+    results[name] = best / ops
+    print '%-18s %10.2f us/op' % (name, results[name] * 1e6)
+    sys.stdout.flush()
+  return results
+
+## Get the path of a baseline.
+# @param name The baseline name or path.
+def baseline_path(name):
+  if os.path.sep in name or name.endswith('.json'):
+    return name
+  return os.path.join(BASELINES, name + '.json')
+
+## Compare results with a baseline.
+# @param baseline The baseline results.
+# @param results The current results.
+# @param threshold Slowdown in percent that is flagged.
+# @return The names of the benchmarks that got slower.
+def compare(baseline, results, threshold):
+  slower = []
+  print '%-18s %12s %12s %8s' % ('benchmark', 'baseline us', 'current us',
+    'change')
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    change = (results[name] / baseline[name] - 1) * 100
+    flag = ''
+    if change > threshold:
+      flag = ' SLOWER'
+      slower.append(name)
+    print '%-18s %12.2f %12.2f %+7.1f%%%s' % (name, baseline[name] * 1e6,
+      results[name] * 1e6, change, flag)
+  return slower
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser(usage='usage: %prog [options]')
+  parser.add_option('-k', type='string', dest='pattern', default='',
+    help='only run benchmarks whose name contains PATTERN', metavar='PATTERN')
+  parser.add_option('-n', '--repeat', type='int', dest='repeat', default=20,
+    help='times to run each benchmark, the best is kept [default: %default]')
+  parser.add_option('-s', '--save', type='string', dest='save',
+    help='save the results as baseline NAME', metavar='NAME')
+  parser.add_option('-c', '--compare', type='string', dest='compare',
+    help='compare the results with baseline NAME', metavar='NAME')
+  parser.add_option('-a', '--against', type='string', dest='against',
+    help='compare with baseline NAME instead of running the benchmarks',
+    metavar='NAME')
+  parser.add_option('-t', '--threshold', type='float', dest='threshold',
+    default=10.0, help='slowdown in percent to flag [default: %default]')
+  (options, args) = parser.parse_args()
+  logging.getLogger('playernsd').setLevel(logging.ERROR)
+  logging.getLogger('playernsd').addHandler(logging.NullHandler())
+  if options.against:
+    with open(baseline_path(options.against)) as f:
+      results = json.load(f)['results']
+  else:
+    results = run(options.pattern, options.repeat)
+  if options.save:
+    if not os.path.isdir(BASELINES):
+      os.makedirs(BASELINES)
+    with open(baseline_path(options.save), 'w') as f:
+      json.dump({'python': platform.python_version(),
+        'machine': platform.machine(), 'processor': platform.processor(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results},
+        f, indent=2, sort_keys=True, separators=(',', ': '))
+      f.write('\n')
+  if options.compare:
+    with open(baseline_path(options.compare)) as f:
+      baseline = json.load(f)['results']
+    if compare(baseline, results, options.threshold):
+      sys.exit(1)
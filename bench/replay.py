@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file replay.py
+# Replays a traffic capture (made with playernsd --capture) against a
+# running daemon, using one virtual client per captured client, and reports
+# the throughput and delivery latency.
+#
+# The latency of a delivery is measured from the time the last command
+# captured before it was replayed to the time the delivery is received.
+
+import os
+import sys
+import time
+import socket
+import optparse
+import threading
+
+from common import percentile
+from playernsd.capture import CaptureReader, Opcode
+
+## Frames sent by the daemon by itself, which are not counted as deliveries.
+UNSOLICITED = ('ping\n', 'error missedping\n')
+
+## Virtual client replaying the captured traffic of one client.
+class VirtualClient(threading.Thread):
+  ## Initialise the virtual client.
+  # @param self The VirtualClient instance.
+  # @param replay The Replay instance.
+  # @param events List of (index, timestamp, opcode, payload) of the client.
+  # @param expected List of (end offset, cause index) of the deliveries.
+  def __init__(self, replay, events, expected):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.replay = replay
+    self.events = events
+    self.expected = expected
+    self.received = 0
+    self.latencies = []
+    self.sock = None
+  ## Receive deliveries and match them against the expected ones.
+  # @param self The VirtualClient instance.
+  def reader(self):
+    next = 0
+    while True:
+      try:
+        data = self.sock.recv(65536)
+      except socket.error:
+        break
+      if not data:
+        break
+      now = time.time()
+      pings = data.count('ping\n')
+      if pings:
+        try:
+          self.sock.sendall('pong\n' * pings)
+        except socket.error:
+          break
+      self.received += len(data) - pings * len('ping\n')
+      while next < len(self.expected) and \
+          self.expected[next][0] <= self.received:
+        sent = self.replay.sent.get(self.expected[next][1])
+        if sent:
+          self.latencies.append(now - sent)
+        next += 1
+  ## Replay the events of the client.
+  # @param self The VirtualClient instance.
+  def run(self):
+    reader = None
+    for index, timestamp, opcode, payload in self.events:
+      self.replay.wait_until(timestamp)
+      if opcode == Opcode.CONNECT:
+        self.sock = socket.create_connection(self.replay.address)
+        reader = threading.Thread(target=self.reader)
+        reader.daemon = True
+        reader.start()
+      elif opcode == Opcode.IN and self.sock:
+        self.replay.sent[index] = time.time()
+        self.sock.sendall(payload)
+        self.replay.count(len(payload))
+      elif opcode == Opcode.DISCONNECT and self.sock:
+        break
+    if self.sock:
+      time.sleep(self.replay.linger)
+      self.sock.close()
+    if reader:
+      reader.join(1.0)
+
+## Replay of a trace file.
+class Replay():
+  ## Load a trace file.
+  # @param self The Replay instance.
+  # @param path The path of the trace file.
+  # @param address The (host, port) of the daemon.
+  # @param speed The replay speed (1 is real time, 0 as fast as possible).
+  # @param linger Seconds to wait for deliveries before disconnecting.
+  def __init__(self, path, address, speed, linger):
+    self.address = address
+    self.speed = speed
+    self.linger = linger
+    self.sent = {}
+    self.commands = 0
+    self.bytes = 0
+    self.__lock = threading.Lock()
+    events = {}
+    expected = {}
+    offsets = {}
+    cause = None
+    self.start_time = None
+    reader = CaptureReader(path)
+    for index, (timestamp, handle, opcode, payload) in enumerate(reader):
+      if self.start_time == None:
+        self.start_time = timestamp
+      if opcode == Opcode.OUT:
+        if payload in UNSOLICITED:
+          continue
+        offsets[handle] = offsets.get(handle, 0) + len(payload)
+        expected.setdefault(handle, []).append((offsets[handle], cause))
+      else:
+        if opcode == Opcode.IN:
+          cause = index
+        events.setdefault(handle, []).append(
+          (index, timestamp, opcode, payload))
+    reader.close()
+    self.clients = [VirtualClient(self, events[h], expected.get(h, []))
+      for h in sorted(events)]
+  ## Wait until a captured timestamp is due.
+  # @param self The Replay instance.
+  # @param timestamp The captured timestamp.
+  def wait_until(self, timestamp):
+    if self.speed > 0:
+      delay = self.begin + (timestamp - self.start_time) / self.speed - \
+        time.time()
+      if delay > 0:
+        time.sleep(delay)
+  ## Count a replayed command.
+  # @param self The Replay instance.
+  # @param length The length of the command data.
+  def count(self, length):
+    with self.__lock:
+      self.commands += 1
+      self.bytes += length
+  ## Run the replay and print the report.
+  # @param self The Replay instance.
+  def run(self):
+    self.begin = time.time()
+    for c in self.clients:
+      c.start()
+    for c in self.clients:
+      c.join()
+    elapsed = time.time() - self.begin
+    latencies = sorted(l for c in self.clients for l in c.latencies)
+    expected = sum(len(c.expected) for c in self.clients)
+    print 'clients:     %d' % len(self.clients)
+    print 'elapsed:     %.3f s' % elapsed
+    print 'sent:        %d chunks, %d bytes (%.1f chunks/s, %.1f KiB/s)' % (
+      self.commands, self.bytes, self.commands / elapsed,
+      self.bytes / elapsed / 1024)
+    print 'deliveries:  %d of %d' % (len(latencies), expected)
+    print 'latency:     p50 %.3f ms, p99 %.3f ms, max %.3f ms' % (
+      percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+      (latencies[-1] if latencies else float('nan')) * 1000)
+
+if __name__ == "__main__":
+  parser = optparse.OptionParser(usage="usage: %prog [options] tracefile")
+  parser.add_option("-i", "--ip", type="string", dest="ip",
+                    default='127.0.0.1', help="daemon IP", metavar="IP")
+  parser.add_option("-p", "--port", type="int", dest="port", default=9999,
+                    help="daemon port", metavar="PORT")
+  parser.add_option("-s", "--speed", type="float", dest="speed", default=1.0,
+                    help="replay speed, 1 for real time or 0 for as fast as "
+                    "possible")
+  parser.add_option("--linger", type="float", dest="linger", default=1.0,
+                    help="seconds to wait for deliveries before disconnecting")
+  (options, args) = parser.parse_args()
+  if len(args) != 1:
+    parser.error('a trace file is needed')
+  Replay(args[0], (options.ip, options.port), options.speed,
+    options.linger).run()
+
+# vim: ai:ts=2:sw=2:sts=2:
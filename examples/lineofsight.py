@@ -33,11 +33,12 @@ import sys
 import thread
 import logging
 import time
-import Image
 from Queue import Queue
 from threading import Thread
 from struct import *
 from math import *
+from playernsd.occupancy import OccupancyMap
+from playernsd.handles import Handles
 
 log = logging.getLogger('playernsd')
 
@@ -49,29 +50,37 @@ class Simulation(Thread):
   # @param recv_callback The callback to call when a message is recevied.
   # @param prop_val_callback The callback to call when a property
   #        value is received.
-  def __init__(self, args, recv_callback, prop_val_callback):
+  # @param recv_many_callback The callback to call with a batch of
+  #        received messages.
+  def __init__(self, args, recv_callback, prop_val_callback,
+      recv_many_callback=None):
     self.recv_callback = recv_callback
+    self.recv_many_callback = recv_many_callback
     self.prop_val_callback = prop_val_callback
-    self.clients = []
+    ## The handle of each client, by client id.
+    self.clients = {}
+    self.handles = Handles()
+    self.allocated = set()
     self.positions = {}
     self.properties = {}
-    self.image = self.width = self.height = None
+    self.map = self.width = self.height = None
     for a in args[1:]:
       p,v = a.split('=')
       if p == 'image':
-        self.image = Image.open(v)
-        self.map = self.image.load()
+        # Decoded once, and memory-mapped from then on
+        self.map = OccupancyMap(v)
+        self.size = self.map.size
       elif p == 'width':
         self.width = float(v)
-        self.scale_x =  float(self.image.size[0]) / float(self.width)
+        self.scale_x =  float(self.size[0]) / float(self.width)
       elif p == 'height':
         self.height = float(v)
-        self.scale_y =  float(self.image.size[1]) / float(self.height)
+        self.scale_y =  float(self.size[1]) / float(self.height)
       else:
         raise Exception('lineofsight script doesn\'t understand argument '+ p)
-    if self.image == None or self.width == None or self.height == None:
+    if self.map == None or self.width == None or self.height == None:
       raise Exception('lineofsight needs arguments -o image=img,width=#,height=#')
-    log.debug('SIMINIT: imagesize: (%f, %f), scaledsize: (%f, %f)' % (self.image.size[0], self.image.size[1], self.width, self.height))
+    log.debug('SIMINIT: imagesize: (%f, %f), scaledsize: (%f, %f)', self.size[0], self.size[1], self.width, self.height)
     Thread.__init__(self)
   ## Add new client.
   #
@@ -79,8 +88,13 @@ class Simulation(Thread):
   # maximum clients.
   # @param self The simulation::Simulation instance.
   # @param clientid Client ID of client added.
-  def new_client(self, clientid):
-    self.clients.append(clientid)
+  # @param handle The integer handle of the client, None when the
+  #        script is run without the daemon's handles.
+  def new_client(self, clientid, handle=None):
+    if handle == None:
+      handle = self.handles.alloc()
+      self.allocated.add(handle)
+    self.clients[clientid] = handle
     # We need to have at least an initial position.
     #self.positions[clientid] = (0, 0)
   ## Remove a client after its disconnected.
@@ -89,7 +103,10 @@ class Simulation(Thread):
   # @param self The simulation::Simulation instance.
   # @param clientid Client ID of client to be removed.
   def remove_client(self, clientid):
-    self.clients.remove(clientid)
+    handle = self.clients.pop(clientid)
+    if handle in self.allocated:
+      self.allocated.discard(handle)
+      self.handles.release(handle)
   ## Tracing a line to check for intersections.
   #
   # This is for detecting if the robot can send a message (or not).
@@ -97,16 +114,14 @@ class Simulation(Thread):
   # @param p0 Source point.
   # @param p1 Destination point.
   def trace(self, p0, p1):
-    print 'trace', str(p0), str(p1)
-    x0 = p0[0] * self.scale_x + self.image.size[0] / 2
-    y0 = self.image.size[1]/2 - p0[1] * self.scale_y
-    x1 = p1[0] * self.scale_x + self.image.size[0] / 2
-    y1 = self.image.size[1]/2 - p1[1] * self.scale_y
-    print 'trace', x0, y0, x1, y1
+    x0 = p0[0] * self.scale_x + self.size[0] / 2
+    y0 = self.size[1]/2 - p0[1] * self.scale_y
+    x1 = p1[0] * self.scale_x + self.size[0] / 2
+    y1 = self.size[1]/2 - p1[1] * self.scale_y
 
-    if x0 < 0 or x0 >= self.image.size[0] or y0 < 0 or y0 >= self.image.size[1]:
+    if x0 < 0 or x0 >= self.size[0] or y0 < 0 or y0 >= self.size[1]:
       return None
-    if x1 < 0 or x1 >= self.image.size[0] or y1 < 0 or y1 >= self.image.size[1]:
+    if x1 < 0 or x1 >= self.size[0] or y1 < 0 or y1 >= self.size[1]:
       return None
 
     dx = abs(x1 - x0)
@@ -142,8 +157,7 @@ class Simulation(Thread):
 
     for n in range(n, 0, -1):
       # if is a wall
-      #print x, y, self.map[x, y]
-      if self.map[x, y] == 0 or self.map[x, y] == (0, 0) or self.map[x, y] == (0, 0, 0) or self.map[x, y] == (0, 0, 0, 0) or self.map[x, y] == (0, 0, 0, 255):
+      if self.map.wall(x, y):
         walls.append((x, y))
 
       if error > 0:
@@ -153,24 +167,24 @@ class Simulation(Thread):
         x += x_inc
         error += dy
     return walls
-  ## Send a message with line of sight taken into account
+  ## Check whether a message can be sent with line of sight.
   # @param self The simulation::Simulation instance.
   # @param _from The client that the message comes from.
   # @param to The client that the messagesa is being sent to.
-  # @param msg The message to be sent.
-  def trace_send(self, _from, to, message):
+  # @return True if the target can be seen from the sender.
+  def can_send(self, _from, to):
     # Can't send if one of the client robots is nowhere.
     if _from not in self.positions or to not in self.positions:
-      return
+      return False
     # Can you see the target? Trace walls...
     walls = self.trace(self.positions[_from], self.positions[to])
     if walls == []:
-      # Direct to a single client, message.
-      self.recv_callback(_from, to, message);
+      return True
     elif walls == None:
       log.debug('SIMSEND: Trace failed.')
     else:
-      log.debug('SIMSEND: Sent message from %s to %s but wall(s) detected at %s' % (_from, to, str(walls)))
+      log.debug('SIMSEND: Sent message from %s to %s but wall(s) detected at %s', _from, to, walls)
+    return False
   ## Send a message simulated.
   # @param self The simulation::Simulation instance.
   # @param _from The client that the message comes from.
@@ -179,11 +193,34 @@ class Simulation(Thread):
   def send(self, _from, to, message):
     # Need to handle special case of broadcasting to individual clients.
     if to == '__broadcast__':
-      for c in self.clients:
-        if c != _from:
-          self.trace_send(_from, c, message);
+      # a copy, as clients are added and removed by other threads
+      recipients = [c for c in list(self.clients)
+        if c != _from and self.can_send(_from, c)]
+      if not recipients:
+        return
+      if self.recv_many_callback:
+        self.recv_many_callback([(_from, recipients, message)])
+      else:
+        for c in recipients:
+          self.recv_callback(_from, c, message);
+    elif self.can_send(_from, to):
+      # Direct to a single client, message.
+      self.recv_callback(_from, to, message);
+  ## Send a message to the members of a group that can be seen.
+  # @param self The simulation::Simulation instance.
+  # @param _from The client that the message comes from.
+  # @param group The name of the group.
+  # @param members The clients in the group, other than the sender.
+  # @param msg The message to be sent.
+  def send_group(self, _from, group, members, message):
+    recipients = [c for c in members if self.can_send(_from, c)]
+    if not recipients:
+      return
+    if self.recv_many_callback:
+      self.recv_many_callback([(_from, recipients, message)])
     else:
-      self.trace_send(_from, to, message)
+      for c in recipients:
+        self.recv_callback(_from, c, message);
   ## Getting a property value from the target executable.
   # @param self The simulation::Simulation instance.
   # @param _from The client that asked this.
@@ -197,9 +234,10 @@ class Simulation(Thread):
     # Split property into parts (using '.' separator).
     if p.find('.') != -1:
       parts = p.split('.')
-      if parts[0] in self.clients:
+      handle = self.clients.get(parts[0])
+      if handle != None:
         if parts[1] == 'index':
-          self.prop_val_callback(_from, prop, self.clients.index(parts[0]) + 1)
+          self.prop_val_callback(_from, prop, handle)
           return
     # Check properties dictionary for other stored information.
     if p in self.properties:
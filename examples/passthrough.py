@@ -36,6 +36,7 @@ import time
 from Queue import Queue
 from threading import Thread
 from struct import *
+from playernsd.handles import Handles
 
 log = logging.getLogger('playernsd')
 
@@ -47,10 +48,17 @@ class Simulation(Thread):
   # @param recv_callback The callback to call when a message is recevied.
   # @param prop_val_callback The callback to call when a property
   #        value is received.
-  def __init__(self, args, recv_callback, prop_val_callback):
+  # @param recv_many_callback The callback to call with a batch of
+  #        received messages.
+  def __init__(self, args, recv_callback, prop_val_callback,
+      recv_many_callback=None):
     self.recv_callback = recv_callback
+    self.recv_many_callback = recv_many_callback
     self.prop_val_callback = prop_val_callback
-    self.clients = []
+    ## The handle of each client, by client id.
+    self.clients = {}
+    self.handles = Handles()
+    self.allocated = set()
     self.properties = {}
     Thread.__init__(self)
   ## Add new client.
@@ -59,15 +67,23 @@ class Simulation(Thread):
   # maximum clients.
   # @param self The simulation::Simulation instance.
   # @param clientid Client ID of client added.
-  def new_client(self, clientid):
-    self.clients.append(clientid)
+  # @param handle The integer handle of the client, None when the
+  #        script is run without the daemon's handles.
+  def new_client(self, clientid, handle=None):
+    if handle == None:
+      handle = self.handles.alloc()
+      self.allocated.add(handle)
+    self.clients[clientid] = handle
   ## Remove a client after its disconnected.
   #
   # When clients disconnect, we can't send to them anymore unfortunately.
   # @param self The simulation::Simulation instance.
   # @param clientid Client ID of client to be removed.
   def remove_client(self, clientid):
-    self.clients.remove(clientid)
+    handle = self.clients.pop(clientid)
+    if handle in self.allocated:
+      self.allocated.discard(handle)
+      self.handles.release(handle)
   ## Send a message simulated.
   # @param self The simulation::Simulation instance.
   # @param _from The client that the message comes from.
@@ -76,12 +92,47 @@ class Simulation(Thread):
   def send(self, _from, to, message):
     # Need to handle special case of broadcasting to individual clients.
     if to == '__broadcast__':
-      for c in self.clients:
-        if c != _from:
+      # a copy, as clients are added and removed by other threads
+      recipients = [c for c in list(self.clients) if c != _from]
+      if self.recv_many_callback:
+        self.recv_many_callback([(_from, recipients, message)])
+      else:
+        for c in recipients:
           self.recv_callback(_from, c, message);
     else:
       # Direct to a single client, message.
       self.recv_callback(_from, to, message);
+  ## Send a batch of messages simulated, delivered as one batch.
+  # @param self The simulation::Simulation instance.
+  # @param batch List of (from, to, msg) tuples.
+  def send_batch(self, batch):
+    out = []
+    for _from, to, message in batch:
+      if to == '__broadcast__':
+        out.append((_from, [c for c in list(self.clients) if c != _from],
+          message))
+      else:
+        out.append((_from, to, message))
+    if self.recv_many_callback:
+      self.recv_many_callback(out)
+    else:
+      for _from, to, message in out:
+        for c in (to if isinstance(to, list) else [to]):
+          self.recv_callback(_from, c, message)
+  ## Send a message to the members of a group.
+  # @param self The simulation::Simulation instance.
+  # @param _from The client that the message comes from.
+  # @param group The name of the group.
+  # @param members The clients in the group, other than the sender.
+  # @param msg The message to be sent.
+  def send_group(self, _from, group, members, message):
+    if not members:
+      return
+    if self.recv_many_callback:
+      self.recv_many_callback([(_from, members, message)])
+    else:
+      for c in members:
+        self.recv_callback(_from, c, message);
   ## Getting a property value from the target executable.
   # @param self The simulation::Simulation instance.
   # @param _from The client that asked this.
@@ -94,9 +145,10 @@ class Simulation(Thread):
       p = prop
     # Split property into parts (using '.' separator).
     parts = p.split('.')
-    if parts[0] in self.clients:
+    handle = self.clients.get(parts[0])
+    if handle != None:
       if parts[1] == 'index':
-        self.prop_val_callback(_from, prop, self.clients.index(parts[0]) + 1)
+        self.prop_val_callback(_from, prop, handle)
         return
     # Check properties dictionary for other stored information.
     if p in self.properties:
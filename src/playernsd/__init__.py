@@ -32,3 +32,81 @@
 #
 # Contains utility functions for playernsd.
 
+
+import inspect
+
+## A message payload carrying what the daemon needs for its delivery
+# through the simulation.
+#
+# Simulations see an ordinary string.  One that hands the same string to
+# the receive callback keeps the attributes, also across the pipe of a
+# playernsd::processsim::ProcessSimulation; a message the simulation makes
+# anew is delivered as an ordinary message.
+class Message(str):
+  ## The tag of a state message, which replaces a queued message from the
+  # same sender with the same tag.
+  tag = None
+  ## Whether the message came in a datagram, so that it is delivered in
+  # datagrams too.
+  datagram = False
+
+## Create a simulation instance.
+#
+# The batch delivery callback is only passed to simulation classes whose
+# constructor accepts it, so older simulation scripts keep working.
+# @param cls The simulation class.
+# @param args The arguments for the simulation.
+# @param recv_callback The callback to call when a message is received.
+# @param prop_val_callback The callback to call when a property
+#        value is received.
+# @param recv_many_callback The callback to call with a batch of
+#        received messages.
+# @return The simulation instance.
+def new_simulation(cls, args, recv_callback, prop_val_callback,
+    recv_many_callback):
+  if 'recv_many_callback' in inspect.getargspec(cls.__init__)[0]:
+    return cls(args, recv_callback, prop_val_callback, recv_many_callback)
+  return cls(args, recv_callback, prop_val_callback)
+
+## Add a client to a simulation.
+#
+# The client's handle is only passed to simulations whose new_client
+# accepts it, so older simulation scripts keep working.
+# @param sim The simulation instance.
+# @param clientid The client id.
+# @param handle The integer handle of the client.
+def new_client(sim, clientid, handle):
+  if 'handle' in inspect.getargspec(sim.new_client)[0]:
+    sim.new_client(clientid, handle)
+  else:
+    sim.new_client(clientid)
+
+## Send a message to the members of a group in a simulation.
+#
+# Simulations without a send_group method are sent the message for each
+# member in turn.
+# @param sim The simulation instance.
+# @param _from The client id of the sender.
+# @param group The name of the group.
+# @param members The client ids of the members, other than the sender.
+# @param msg The message.
+def send_group(sim, _from, group, members, msg):
+  if hasattr(sim, 'send_group'):
+    sim.send_group(_from, group, members, msg)
+  else:
+    for m in members:
+      sim.send(_from, m, msg)
+
+## Send a batch of messages in a simulation.
+#
+# Simulations without a send_batch method are sent the messages one by
+# one.
+# @param sim The simulation instance.
+# @param batch List of (from, to, msg) tuples, where to is a client id or
+#        '__broadcast__'.
+def send_batch(sim, batch):
+  if hasattr(sim, 'send_batch'):
+    sim.send_batch(batch)
+  else:
+    for _from, to, msg in batch:
+      sim.send(_from, to, msg)
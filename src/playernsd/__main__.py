@@ -61,17 +61,66 @@
 # @li @b error message\\n
 # @li @b msgtext src\\nMESSAGE\\n
 # @li @b msgbin src length\\nBINARYDATA
+# @li @b msgbinz src length\\nCOMPRESSEDDATA
 # @li @b propval var VALUE\n
+# @li @b tick step time\\n
+# @li @b stats length\\nMETRICS
+# @li @b profile FILENAME\\n
+# @li @b gateway\\n
+# @li @b sub handle length\\nFRAMES
 #
 # @subsection subsec_client_messages Client messages
-# @li @b greetings CLIENTID playernsd VERSION\\n
+# @li @b greetings CLIENTID playernsd VERSION [zlib[:DICTIONARY]] [udp]\\n
 # @li @b ping\\n
 # @li @b pong\\n
 # @li @b error message\\n
 # @li @b msgtext [dest]\\nMESSAGE\\n
 # @li @b msgbin [dest] length\\nBINARYDATA
+# @li @b msgstate tag [dest] length\\nBINARYDATA
+# @li @b msgbatch count length\\nMESSAGES
+# @li @b join group\\n
+# @li @b leave group\\n
 # @li @b propget var\\n
 # @li @b propset var VALUE\\n
+# @li @b tock step\\n
+# @li @b stats\\n
+# @li @b profile cpu|mem [seconds]\\n
+# @li @b gateway\\n
+# @li @b sub handle length\\nCOMMANDS
+#
+# A dest of @b \@group sends the message to the other members of a group
+# joined with @b join.
+#
+# A @b msgbatch carries count messages in its length bytes, each
+# @b msgtext [dest] length\\nMESSAGE or @b msgbin [dest] length\\nBINARYDATA
+# (the text of a @b msgtext may not hold a newline), and they are delivered
+# as if sent one by one.
+#
+# A client that greets with @b zlib gets @b registered @b zlib back, and
+# from then on long binary messages may be delivered as @b msgbinz, with
+# the payload compressed by zlib.  With @b zlib:DICTIONARY, the payloads
+# are compressed with a shared dictionary the daemon was given with
+# --compress-dict; the name is left out of the reply if the daemon doesn't
+# have the dictionary, and then the payloads are compressed without it.
+#
+# If the daemon is run with --udp-port, a client that greets with @b udp
+# gets @b udp:PORT:TOKEN back in @b registered.  Datagrams sent to that
+# port start with the token and a command line: @b TOKEN @b subscribe\\n
+# (answered with a @b subscribed\\n datagram), @b TOKEN @b unsubscribe\\n or
+# @b TOKEN @b msgbin [dest] length\\nBINARYDATA.  A message sent in a
+# datagram is routed like any other, and is delivered as a @b msgbin
+# datagram to recipients that have subscribed (over TCP to the others).
+# Datagrams may be lost, so this is meant for frequent state updates.
+#
+# A connection that starts with @b gateway (answered with @b gateway)
+# carries many clients: from then on, everything on it is a @b sub frame
+# (or @b ping, @b pong or @b bye for the connection itself).  The gateway
+# host picks a handle for each of its clients, and a @b sub frame holds
+# whole commands of that client, starting with its @b greetings; the
+# frames the client is sent come back wrapped in @b sub frames with the
+# same handle.  A @b sub frame with a length of 0 closes the client, sent
+# by either side.  Clients on a gateway connection are never pinged on
+# their own.
 
 import SocketServer
 import socket
@@ -83,8 +132,28 @@ import logging
 import os
 import shlex
 import imp
+import signal
+from Queue import Queue
+from playernsd import new_simulation, new_client, send_batch, send_group
+from playernsd import Message
+from playernsd import datagram
+from playernsd.datagram import DatagramServer
+from playernsd.gateway import FrameSocket, SubOutbox
+from playernsd.handles import Handles
+from playernsd.inproc import VirtualClient, message_frame, size
 from playernsd.timer import PeriodicTimer
+from playernsd.unixserver import UnixServer
 from playernsd.remoteclient import RemoteClient
+from playernsd.outbox import Outbox, Policy, BLOCK_TIMEOUT
+from playernsd.stream import Stream
+from playernsd.compress import Compressor
+from playernsd import compress
+from playernsd.lockstep import Lockstep
+from playernsd import stats
+from playernsd import logqueue
+from playernsd.logqueue import Payload, QueueHandler, QueueListener
+from playernsd.profiler import StackSampler, MemoryProfiler
+from playernsd.capture import Capture, Opcode
 
 # Global config variables
 ## Name of daemon
@@ -100,10 +169,14 @@ PORT = 9999
 LOGFILE = NAME + '.log'
 ## Verbosity level (1 is default)
 VERBOSE = 1
-## Maximum number of bytes to send (from client) (4096 is default)
-MAX_SEND = 4096
-## Maximum number of bytes to read (4096+64 is default)
-MAX_READ = MAX_SEND + 64
+## Maximum number of bytes in a binary message (from client) (1MiB is default)
+MAX_SEND = 1048576
+## Maximum number of bytes to read at once for commands (4160 is default)
+MAX_READ = 4160
+## Maximum number of bytes to read at once for binary payloads (64KiB is default)
+PAYLOAD_READ = 65536
+## Binary messages at least this long are passed on as they are received
+STREAM_THRESHOLD = 65536
 ## The timeout before a ping, i.e. the interval the client manager checks
 CLIENT_TIMEOUT = 1.0
 ## The minimum number of pings missed before the client is disconnected
@@ -111,11 +184,107 @@ CLIENT_TIMEOUT = 1.0
 # immediately.
 MISSED_PING = 3
 
+## Maximum number of message bytes queued for a client (0 is no limit)
+QUEUE_BYTES = 1048576
+## Maximum number of messages queued for a client (0 is no limit)
+QUEUE_MSGS = 1024
+## What to do with messages for a client whose queue is full
+QUEUE_POLICY = Policy.DROP_OLDEST
+## Seconds a sender may be held up by the block policy before the client
+# that is behind is disconnected
+QUEUE_TIMEOUT = BLOCK_TIMEOUT
+## Maximum number of clients on a gateway connection
+GATEWAY_CLIENTS = 1024
+## Port to receive datagrams on (0 disables UDP)
+UDP_PORT = 0
+## Binary messages at least this long are compressed for clients that ask
+COMPRESS_THRESHOLD = compress.THRESHOLD
+## The zlib compression level
+COMPRESS_LEVEL = compress.LEVEL
+## Shared compression dictionaries by name
+COMPRESS_DICTS = {}
+
+## Simulated time per lockstep step in seconds (0 disables lockstep)
+LOCKSTEP = 0.0
+## Wall clock seconds to wait for all clients to acknowledge a step
+STEP_DEADLINE = 1.0
+## Port to serve metrics over HTTP on (0 disables it)
+STATS_PORT = 0
+## Directory to write profiles to
+PROFILE_DIR = '.'
+## Number of seconds to sample stacks for when profiling
+PROFILE_SECONDS = 10.0
+## Addresses allowed to use administrative commands
+ADMIN_ADDRESSES = ('127.0.0.1', '::1')
+## Path of the unix domain socket to listen on, '@' and a name for an
+# abstract socket (None for no unix socket)
+UNIX_PATH = None
+
+## Maximum number of payload bytes shown in log messages (0 is no limit)
+LOG_PAYLOAD = logqueue.PAYLOAD_LIMIT
+## Only log every n-th payload
+LOG_SAMPLE = logqueue.SAMPLE
+## Maximum number of log records waiting to be written (0 is no limit)
+LOG_QUEUE = logqueue.QUEUE_SIZE
+
 ## Format for logging messages
 LOG_FORMAT = '%(asctime)-15s %(levelname)-6s: %(message)s'
 
 ## Globals
 properties = {}
+## The playernsd logger
+log = logging.getLogger('playernsd')
+## The lockstep instance when running in lockstep
+lockstep = None
+## The traffic capture instance when capturing
+capture = None
+## The playernsd::datagram::DatagramServer instance when UDP is enabled
+datagrams = None
+## The playernsd::unixserver::UnixServer instance when listening on a
+# unix socket
+unix_server = None
+## The memory profiler instance
+memory_profiler = MemoryProfiler([
+  ('buffers', 'simulation.py', 'send'),
+  ('buffers', 'simulation.py', 'prop_get'),
+  ('buffers', 'simulation.py', 'prop_set'),
+  ('buffers', '__main__.py', 'write'),
+  ('buffers', '__main__.py', 'recv_sim'),
+  ('buffers', '__main__.py', 'recv_many_sim'),
+  ('client_manager', '__main__.py', None),
+  ('client_manager', 'remoteclient.py', None),
+  ('simulation', 'simulation.py', None),
+  ('simulation', 'processsim.py', None)])
+
+## Check whether a client may use administrative commands.
+#
+# Clients on the unix socket are on the daemon's host, but are only
+# trusted if they run as the same user as the daemon (or as root).
+# @param ca The client address.
+def is_admin(ca):
+  if ca[0] == 'unix':
+    return ca[3] in (0, os.getuid())
+  return ca[0] in ADMIN_ADDRESSES
+
+## Start a profile of the daemon.
+# @param kind The kind of profile, 'cpu' or 'mem'.
+# @param seconds The number of seconds to sample stacks for.
+# @return The file the profile is written to, or None if unavailable.
+def profile(kind, seconds=None):
+  now = time.time()
+  stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + \
+    '.%03d' % (now * 1000 % 1000)
+  if kind == 'cpu':
+    path = os.path.join(PROFILE_DIR, NAME + '-' + stamp + '.collapsed')
+    sampler = StackSampler(seconds or PROFILE_SECONDS, path)
+    sampler.daemon = True
+    sampler.start()
+    return path
+  elif kind == 'mem' and memory_profiler.available():
+    path = os.path.join(PROFILE_DIR, NAME + '-' + stamp + '.memory')
+    memory_profiler.snapshot(path)
+    return path
+  return None
 
 ## Get the value for a property.
 # @param key The key of the property to get the value for.
@@ -132,6 +301,21 @@ def propset(key, value):
   else: # Ask ns3
     pass
 
+## Get the payload of a msgtext or msgbin message.
+# @param msg The message including its header line.
+# @param tag The tag of a state message, if it is one.
+# @return The payload, as a playernsd::Message carrying the tag if there is
+#         one.
+def payload(msg, tag=None):
+  if msg.startswith('msgtext'):
+    msg = msg[msg.find('\n')+1:-1]
+  else:
+    msg = msg[msg.find('\n')+1:]
+  if tag != None:
+    msg = Message(msg)
+    msg.tag = tag
+  return msg
+
 ## The client manager class for handling client connections.
 #
 # The client manager class periodically checks clients by pinging them
@@ -148,13 +332,51 @@ class ClientManager():
     self.__timed_out_lock = threading.Lock()
     self.__clients = {}
     self.__clientids = {}
+    self.__handles = Handles()
+    # The clients by handle, for the simulations addressed by handle
+    self.__byhandle = [None]
     self.__timed_out = []
     self.__ping_pong = {}
     self.__t = PeriodicTimer(timeout, self.__timeout_check, [self])
     ## The number of missed pings allowed
     self.missed_ping = missed_ping
     self.__sim = simulation
+    # Whether the simulation is addressed by handle rather than by client
+    # id (see playernsd::simulation::Simulation)
+    self.__by_handle = getattr(simulation, 'by_handle', False)
+    # The address of a broadcast in the simulation
+    self.__everyone = '__broadcast__'
+    if self.__by_handle:
+      self.__everyone = 0
     self.__t.daemon = True
+    self.__prop_gets = {}
+    self.__groups = {}
+    self.__group_lock = threading.Lock()
+    self.__compressors = {}
+    # The clients by datagram token
+    self.__tokens = {}
+    self.__delivery = stats.registry.histogram('playernsd_delivery_seconds',
+      'Time taken to write a delivery to a client socket.')
+    self.__roundtrip = stats.registry.histogram(
+      'playernsd_sim_roundtrip_seconds',
+      'Time from a propget sent to the simulation to its propval.')
+    stats.registry.gauge('playernsd_clients',
+      'Number of connected clients.', lambda: len(self.__clients))
+    stats.registry.gauge('playernsd_groups',
+      'Number of groups with members.', lambda: len(self.__groups))
+    stats.registry.gauge('playernsd_client_queued_bytes',
+      'Message bytes queued for a client.',
+      lambda: [({'client': v.name}, v.outbox.queued_bytes)
+        for v in self.__clients.values() if v.name != None
+        # the clients of a gateway connection share its outbox
+        and hasattr(v.outbox, 'queued_bytes')])
+    for attr, doc in (('bytes_in', 'Bytes received from a client.'),
+        ('bytes_out', 'Bytes sent to a client.'),
+        ('msgs_in', 'Commands received from a client.'),
+        ('msgs_out', 'Messages sent to a client.')):
+      stats.registry.gauge('playernsd_client_' + attr + '_total', doc,
+        lambda attr=attr: [({'client': v.name}, getattr(v, attr))
+          for v in self.__clients.values() if v.name != None], 'counter')
   ## Start the timeout poller
   # @param self The instance of playernsd::ClientManager.
   def start(self):
@@ -167,19 +389,50 @@ class ClientManager():
   # @param self The instance of playernsd::ClientManager.
   # @param address The address of the client.
   # @param client The associated playernsd:RemoteClient object.
-  def add_client(self, address, client):
+  # @param outbox What the client's deliveries are put in, if not a new
+  #        playernsd::outbox::Outbox writing to the socket.
+  def add_client(self, address, client, outbox=None):
+    c = RemoteClient(None, address, None, client)
+    if outbox == None:
+      outbox = Outbox(client,
+        lambda data, count, seconds: self.sent(address, data, count, seconds),
+        lambda e: self.lost(address, e), QUEUE_BYTES, QUEUE_MSGS,
+        QUEUE_POLICY, QUEUE_TIMEOUT)
+    c.outbox = outbox
     with self.__client_lock:
-      self.__clients[address] = RemoteClient(None, address, None, client)
+      self.__clients[address] = c
       self.__ping_pong[address] = 1
+    if capture:
+      capture.connect(address)
   ## Register a client with name and protocol version.
   # @param name The name of the client.
   # @param address The addres sof the client.
   def register_client(self, address, name, version):
-    self.__clients[address].name = name
-    self.__clients[address].version = version
-    self.__clientids[name] = self.__clients[address]
+    c = self.__clients[address]
+    c.name = name
+    c.version = version
+    c.handle = self.__handles.alloc()
+    if c.handle >= len(self.__byhandle):
+      self.__byhandle.extend([None] * (c.handle + 1 - len(self.__byhandle)))
+    self.__byhandle[c.handle] = c
+    self.__clientids[name] = c
     if self.__sim:
-      self.__sim.new_client(name)
+      new_client(self.__sim, name, c.handle)
+  ## Connect a virtual client living in the daemon's process.
+  # @param self The instance of playernsd::ClientManager.
+  # @param name The client id.
+  # @return The playernsd::inproc::VirtualClient instance.
+  def connect(self, name):
+    return VirtualClient(self, name, VERSION, QUEUE_BYTES, QUEUE_MSGS,
+      QUEUE_POLICY, QUEUE_TIMEOUT)
+  ## Compress the binary messages delivered to a client.
+  # @param address The address of the client.
+  # @param dictionary The name of the shared dictionary, or None.
+  def compress(self, address, dictionary=None):
+    if dictionary not in self.__compressors:
+      self.__compressors[dictionary] = Compressor('client', COMPRESS_LEVEL,
+        COMPRESS_THRESHOLD, dictionary and COMPRESS_DICTS[dictionary])
+    self.__clients[address].compressor = self.__compressors[dictionary]
   ## Check if the address is handled by the client manager.
   # @param identifier The identifier to refer uniquely to a client.
   def has_client(self, identifier):
@@ -206,11 +459,59 @@ class ClientManager():
   # @param address The address of the client.
   def remove_client(self, address):
     with self.__client_lock:
-      if self.__clients[address].name in self.__clientids:
+      for group in list(self.__clients[address].groups):
+        self.leave(address, group)
+      c = self.__clients[address]
+      if c.name in self.__clientids:
         if self.__sim:
-          self.__sim.remove_client(self.__clients[address].name)
-        del self.__clientids[self.__clients[address].name]
+          self.__sim.remove_client(self.sim_address(c))
+        if lockstep:
+          lockstep.remove_client(c.name)
+        del self.__clientids[c.name]
+        self.__prop_gets.pop(c.name, None)
+        # The simulation has let go of the handle, so it can be reused
+        self.__byhandle[c.handle] = None
+        self.__handles.release(c.handle)
+      if c.token:
+        del self.__tokens[c.token]
+      self.__clients[address].outbox.close()
       del self.__clients[address]
+    if capture:
+      capture.disconnect(address)
+  ## Add a client to a group.
+  # @param self The instance of playernsd::ClientManager.
+  # @param address The address of the client.
+  # @param group The name of the group.
+  def join(self, address, group):
+    c = self.__clients[address]
+    with self.__group_lock:
+      self.__groups.setdefault(group, set()).add(c.name)
+      c.groups.add(group)
+  ## Remove a client from a group; a group without members is forgotten.
+  # @param self The instance of playernsd::ClientManager.
+  # @param address The address of the client.
+  # @param group The name of the group.
+  def leave(self, address, group):
+    c = self.__clients[address]
+    with self.__group_lock:
+      members = self.__groups.get(group)
+      if members != None:
+        members.discard(c.name)
+        if not members:
+          del self.__groups[group]
+      c.groups.discard(group)
+  ## Check whether a group has any members.
+  # @param self The instance of playernsd::ClientManager.
+  # @param group The name of the group.
+  def has_group(self, group):
+    return group in self.__groups
+  ## Get the client ids of the members of a group.
+  # @param self The instance of playernsd::ClientManager.
+  # @param group The name of the group.
+  # @return List of client ids (empty for an unknown group).
+  def get_group(self, group):
+    with self.__group_lock:
+      return list(self.__groups.get(group, ()))
   ## Get a list of client ids.
   def get_clientid_list(self):
     l = []
@@ -229,6 +530,19 @@ class ClientManager():
   def is_timed_out(self, address):
     return address in self.__timed_out or \
       self.__ping_pong[address] < -self.missed_ping
+  ## Get the address of a client in the simulation.
+  # @param self The playernsd::ClientManager instance.
+  # @param c The playernsd::remoteclient::RemoteClient of the client, or
+  #        its client id.
+  # @return The handle of the client if the simulation is addressed by
+  #         handle, otherwise the client id (None for a client that has
+  #         gone).
+  def sim_address(self, c):
+    if not self.__by_handle:
+      return isinstance(c, str) and c or c.name
+    if isinstance(c, str):
+      c = self.__clientids.get(c)
+    return c and c.handle
   ## Send a message to a client.
   #
   # This is a wrapper function to send a message to a client.
@@ -239,17 +553,171 @@ class ClientManager():
   # @param msg The message to be sent.
   # @param s The socket to send the message to.
   # @param ca The client address to send the message to.
-  def send(self, msg, s, ca):
+  # @param tag The tag of a state message (see playernsd::ClientManager::state_key).
+  def send(self, msg, s, ca, tag=None):
     if VERBOSE > 1:
       self.log(ca, 'SEND(' + str(len(msg)) + ')', msg)
     # read the type of message, and see if the message should be
     # simulated
-    command = msg.split(' ')
+    command = msg[:msg.find('\n')].split(' ')
     if simulation and (command[0] == 'msgtext' or command[0] == 'msgbin'):
-      self.__sim.send(command[1], self.__clientids(ca),
-        msg[msg.find('\n')+1:])
+      self.__sim.send(self.sim_address(command[1]),
+        self.sim_address(self.__clients[ca]), payload(msg, tag))
+      return
+    if s == None and (command[0] == 'msgbin' or command[0] == 'msgtext'):
+      # a virtual client is handed the message tuple
+      msg = (command[0], command[1], payload(msg))
+    elif command[0] == 'msgbin':
+      c = self.__clients.get(ca)
+      if c and c.compressor:
+        msg = self.frame(c, command[1], payload(msg))
+    if tag != None:
+      self.write(s, ca, msg, key=(command[1], tag))
+    else:
+      self.write(s, ca, msg)
+  ## Make the frame delivering a binary message to a client.
+  # @param self The playernsd::ClientManager instance.
+  # @param c The playernsd::RemoteClient instance of the recipient.
+  # @param _from The client id of the sender.
+  # @param msg The payload of the message.
+  # @return A msgbin frame, or a msgbinz frame if the client asked for
+  #         compression and the payload compresses (the message tuple for
+  #         a virtual client).
+  def frame(self, c, _from, msg):
+    if c.socket == None:
+      return ('msgbin', _from, msg)
+    if c.compressor:
+      z = c.compressor.compress(msg)
+      if z != None:
+        return 'msgbinz ' + _from + ' ' + str(len(z)) + '\n' + z
+    return 'msgbin ' + _from + ' ' + str(len(msg)) + '\n' + msg
+  ## Get the conflation key of a message delivered by the simulation.
+  #
+  # State messages are delivered as ordinary msgbin messages, but a state
+  # message still queued for a client is replaced by a newer one from the
+  # same sender with the same tag.  The tag is carried through the
+  # simulation by the playernsd::Message payload.
+  # @param self The playernsd::ClientManager instance.
+  # @param _from The client id of the sender.
+  # @param msg The payload of the message.
+  # @return The conflation key, or None for an ordinary message.
+  def state_key(self, _from, msg):
+    tag = getattr(msg, 'tag', None)
+    if tag != None:
+      return (_from, tag)
+    return None
+  ## Queue data to be written to a client socket.
+  #
+  # The data is written by the client's outbox, which sends control frames
+  # ahead of message deliveries.
+  # @param self The playernsd::ClientManager instance.
+  # @param s The socket to write to.
+  # @param ca The client address of the socket.
+  # @param data The data to be written.
+  # @param count The number of messages in the data.
+  # @param key The key replacing a queued message with the same key.
+  # @return False if the data was dropped.
+  def write(self, s, ca, data, count=1, key=None):
+    c = self.__clients.get(ca)
+    if not c:
+      return False
+    if c.outbox.put(data, count, key=key):
+      return True
+    if QUEUE_POLICY == Policy.BUSY:
+      # Tell the sender of a dropped delivery
+      if isinstance(data, Stream):
+        data = data.header
+      if isinstance(data, tuple):
+        sender = self.__clientids.get(data[1])
+      else:
+        sender = self.__clientids.get(data[:data.find('\n')].split(' ')[1])
+      if sender:
+        self.write(sender.socket, sender.address, 'error busy\n')
+    return False
+  ## Open streams passing on a binary message as it is received.
+  # @param self The playernsd::ClientManager instance.
+  # @param _from The client id of the sender.
+  # @param ca The client address of the recipient, or None to broadcast.
+  # @param length The message length.
+  # @param group The name of the group the message is for, if any.
+  # @return List of playernsd::stream::Stream instances to write the
+  #         message to, or None if the message can't be streamed.
+  def open_stream(self, _from, ca, length, group=None):
+    if simulation:
+      # the simulation gets the message whole, so that a slow sender
+      # doesn't hold up everything else sent to the simulation
+      return None
+    if group != None:
+      clients = [self.__clientids[m] for m in self.get_group(group)
+        if m != _from and m in self.__clientids]
+    elif ca:
+      clients = [self.__clients[ca]]
+    else:
+      clients = [v for v in self.__clients.values() if v.name != _from]
+    if [c for c in clients if c.compressor]:
+      # a msgbinz frame starts with the compressed length, so clients that
+      # compress get the message whole
+      return None
+    header = 'msgbin ' + _from + ' ' + str(length) + '\n'
+    streams = []
+    for c in clients:
+      stream = Stream(header, length)
+      if self.write(c.socket, c.address, stream):
+        streams.append(stream)
+    return streams
+  ## Keep the delivery statistics of data written to a client socket.
+  # @param self The playernsd::ClientManager instance.
+  # @param ca The client address of the socket.
+  # @param data The data written, or the message tuple handed to a virtual
+  #        client.
+  # @param count The number of messages in the data.
+  # @param seconds The time taken to write the data.
+  def sent(self, ca, data, count, seconds):
+    self.__delivery.observe(seconds)
+    if capture:
+      capture.record(ca, Opcode.OUT,
+        isinstance(data, tuple) and message_frame(data) or data)
+    c = self.__clients.get(ca)
+    if c:
+      c.bytes_out += size(data)
+      c.msgs_out += count
+  ## Mark a client whose socket failed as timed out.
+  # @param self The playernsd::ClientManager instance.
+  # @param ca The client address of the socket.
+  # @param e The socket error.
+  def lost(self, ca, e):
+    with self.__timed_out_lock:
+      if ca in self.__clients and ca not in self.__timed_out:
+        self.__timed_out.append(ca)
+        log.warn('Lost connection to ' + str(ca) + ' ' + str(e))
+  ## Get a property for a client, from the daemon or the simulation.
+  # @param self The playernsd::ClientManager instance.
+  # @param prop The name of the property.
+  # @param ca The client address that this request comes from.
+  def prop_get(self, prop, ca):
+    val = propget(prop)
+    if val != None:
+      self.send('propval ' + prop + ' ' + val + '\n',
+        self.__clients[ca].socket, ca)
+    else: # Ask NS3
+      self.prop_get_sim(prop, ca)
+  ## Set a property for a client, in the daemon or the simulation.
+  # @param self The playernsd::ClientManager instance.
+  # @param prop The name of the property.
+  # @param val The value of the property.
+  # @param ca The client address that this request comes from.
+  def prop_set(self, prop, val, ca):
+    if propget(prop) != None:
+      propset(prop, val)
     else:
-      s.send(msg)
+      self.prop_set_sim(prop, val, ca)
+  ## Acknowledge a lockstep step for a client.
+  # @param self The playernsd::ClientManager instance.
+  # @param ca The client address.
+  # @param step The step number.
+  def tock(self, ca, step):
+    if lockstep and self.is_registered(ca):
+      lockstep.ack(self.__clients[ca].name, step)
   ## Get a property from the simulation
   #
   # This function requests a value from the simulation.
@@ -258,10 +726,11 @@ class ClientManager():
   # @param prop The name of the property.
   def prop_get_sim(self, prop, ca):
     if self.__sim:
-      cid = self.__clients[ca].name
-      self.__sim.prop_get(cid, prop)
+      c = self.__clients[ca]
+      self.__prop_gets.setdefault(c.name, []).append(time.time())
+      self.__sim.prop_get(self.sim_address(c), prop)
     else:
-      self.__clients[ca].socket.send('propval ' + prop + ' ' + '\n')
+      self.write(self.__clients[ca].socket, ca, 'propval ' + prop + ' ' + '\n')
   ## Set a property in the simulation
   #
   # This function sets a value from the simulation.
@@ -271,22 +740,127 @@ class ClientManager():
   # @param val The value of the property.
   def prop_set_sim(self, prop, val, ca):
     if self.__sim:
-      cid = self.__clients[ca].name
-      self.__sim.prop_set(cid, prop, val)
+      self.__sim.prop_set(self.sim_address(self.__clients[ca]), prop, val)
   ## Broadcast a message to all clients.
   #
   # This is a wrapper function to broadcast a message to all clients.
   # @param self The playernsd::ClientManager instance.
   # @param msg The message to be sent to all clients.
-  def broadcast(self, msg):
+  # @param tag The tag of a state message.
+  def broadcast(self, msg, tag=None):
+    command = msg[:msg.find('\n')].split(' ')
+    if simulation:
+      self.__sim.send(self.sim_address(command[1]), self.__everyone,
+        payload(msg, tag))
+      return
+    # the message is parsed once for all of the clients
+    key = tag != None and (command[1], tag) or None
+    compress = command[0] == 'msgbin' and self.__compressors
+    message = None
+    for v in self.__clients.values():
+      if command[1] != v.name:
+        if VERBOSE > 1:
+          self.log(v.address, 'SEND(' + str(len(msg)) + ')', msg)
+        if v.socket == None:
+          # a virtual client is handed the message tuple
+          if not message:
+            message = (command[0], command[1], payload(msg))
+          self.write(None, v.address, message, key=key)
+        elif compress and v.compressor:
+          self.write(v.socket, v.address,
+            self.frame(v, command[1], payload(msg)), key=key)
+        else:
+          self.write(v.socket, v.address, msg, key=key)
+  ## Route a message from a virtual client.
+  #
+  # This does what playernsd::ClientManager::send, broadcast and send_group
+  # do with a frame, with the message itself, so that the frame is only
+  # made for the recipients that have a socket.
+  # @param self The playernsd::ClientManager instance.
+  # @param kind 'msgbin' or 'msgtext'.
+  # @param _from The client id of the sender.
+  # @param to The client id, '@' and a group name, or None to broadcast.
+  # @param msg The message.
+  # @param tag The tag of a state message.
+  def route(self, kind, _from, to, msg, tag=None):
     if simulation:
-      command = msg.split(' ')
-      self.__sim.send(command[1], '__broadcast__',
-        msg[msg.find('\n')+1:])
+      if tag != None:
+        msg = Message(msg)
+        msg.tag = tag
+      if to == None:
+        self.__sim.send(self.sim_address(_from), self.__everyone, msg)
+      elif to.startswith('@'):
+        self.sim_group(_from, to[1:],
+          [m for m in self.get_group(to[1:]) if m != _from], msg)
+      else:
+        self.__sim.send(self.sim_address(_from), self.sim_address(to), msg)
+      return
+    if to == None:
+      recipients = [v for v in self.__clients.values() if v.name != _from]
+    elif to.startswith('@'):
+      recipients = [self.__clientids.get(m) for m in self.get_group(to[1:])
+        if m != _from]
     else:
-      for v in self.__clients.itervalues():
-        if msg.split(' ')[1] != v.name:
-          self.send(msg, v.socket, v.address)
+      recipients = [self.__clientids.get(to)]
+    key = tag != None and (_from, tag) or None
+    message = (kind, _from, msg)
+    frame = None
+    for c in recipients:
+      if not c:
+        continue
+      if VERBOSE > 1:
+        self.log(c.address, 'SEND(' + str(len(msg)) + ')', msg)
+      if c.socket == None:
+        self.write(None, c.address, message, key=key)
+      elif kind == 'msgbin' and c.compressor:
+        self.write(c.socket, c.address, self.frame(c, _from, msg), key=key)
+      else:
+        if frame == None:
+          frame = message_frame(message)
+        self.write(c.socket, c.address, frame, key=key)
+  ## Send a message to the members of a group other than the sender.
+  #
+  # A simulation is given the group message in one call when it has a
+  # send_group method, so that it can decide the delivery to all of the
+  # members at once; otherwise it is sent to each member in turn.
+  # @param self The playernsd::ClientManager instance.
+  # @param msg The message to be sent.
+  # @param group The name of the group.
+  # @param tag The tag of a state message.
+  def send_group(self, msg, group, tag=None):
+    command = msg[:msg.find('\n')].split(' ')
+    members = [m for m in self.get_group(group) if m != command[1]]
+    if simulation:
+      self.sim_group(command[1], group, members, payload(msg, tag))
+    else:
+      for m in members:
+        c = self.__clientids.get(m)
+        if c:
+          self.send(msg, c.socket, c.address, tag)
+  ## Send a message to the members of a group in the simulation.
+  # @param self The playernsd::ClientManager instance.
+  # @param _from The client id of the sender.
+  # @param group The name of the group.
+  # @param members The client ids of the members, other than the sender.
+  # @param msg The payload of the message.
+  def sim_group(self, _from, group, members, msg):
+    if self.__by_handle:
+      members = [a for a in map(self.sim_address, members) if a]
+    send_group(self.__sim, self.sim_address(_from), group, members, msg)
+  ## Send a message to all registered clients directly.
+  #
+  # This bypasses the simulation and is used for daemon messages such
+  # as lockstep ticks.
+  # @param self The playernsd::ClientManager instance.
+  # @param msg The message to be sent.
+  def send_registered(self, msg):
+    with self.__client_lock:
+      clients = [v for v in self.__clients.itervalues() if v.name != None]
+    for v in clients:
+      try:
+        self.send(msg, v.socket, v.address)
+      except socket.error, e:
+        log.warn('Lost connection to ' + str(v.address) + ' ' + str(e))
   ## Receive a message from a client.
   #
   # This is a wrapper function to receive a message from a client and
@@ -294,21 +868,267 @@ class ClientManager():
   # @param self The playernsd::ClientManager instance.
   # @param s The socket to send the message to.
   # @param ca The client address to send the message to.
+  # @param size The maximum number of bytes to read (MAX_READ if None).
   # @return The message received from the client.
-  def recv(self, s, ca):
-    data = s.recv(MAX_READ)
+  def recv(self, s, ca, size=None):
+    data = s.recv(size or MAX_READ)
+    if ca in self.__clients:
+      self.__clients[ca].bytes_in += len(data)
+    if capture and data:
+      capture.record(ca, Opcode.IN, data)
     if VERBOSE > 1:
       self.log(ca, 'RECV(' + str(len(data)) + ')', data)
     return data
   ## Receive a message from the simulation.
   def recv_sim(self, _from, to, msg):
-    self.__clientids[to].socket.send('msgbin ' + _from + ' ' + str(len(msg)) + '\n' + msg)
+    if self.__by_handle:
+      sender, c = self.__byhandle[_from], self.__byhandle[to]
+      if not sender or not c:
+        return
+      _from = sender.name
+    else:
+      c = self.__clientids[to]
+    if c.udp and getattr(msg, 'datagram', False):
+      self.deliver_datagram(c, _from, msg)
+      return
+    self.write(c.socket, c.address, self.frame(c, _from, msg),
+      key=self.state_key(_from, msg))
+  ## Receive a batch of messages from the simulation.
+  #
+  # The messages are grouped by recipient, so that each client has all
+  # of its frames written with a single send.  State messages are written
+  # on their own, so that they can be replaced while queued.  Virtual
+  # clients are handed the messages one by one.
+  # @param self The playernsd::ClientManager instance.
+  # @param batch List of (from, to, msg) tuples, where to is either a
+  #        client id or a list of client ids (handles if the simulation
+  #        is addressed by handle).
+  def recv_many_sim(self, batch):
+    frames = {}
+    order = []
+    if self.__by_handle:
+      byhandle = self.__byhandle
+      lookup = byhandle.__getitem__
+    else:
+      byhandle = None
+      lookup = self.__clientids.get
+    for _from, to, msg in batch:
+      if byhandle:
+        sender = byhandle[_from]
+        if not sender:
+          continue
+        _from = sender.name
+      frame = self.bin_frame(_from, msg)
+      key = self.state_key(_from, msg)
+      datagram = getattr(msg, 'datagram', False)
+      if not isinstance(to, list):
+        to = [to]
+      for t in to:
+        c = lookup(t)
+        if c and c.udp and datagram:
+          self.deliver_datagram(c, _from, msg)
+        elif c and c.socket == None:
+          self.write(None, c.address, ('msgbin', _from, msg), key=key)
+        elif c:
+          if c not in frames:
+            frames[c] = []
+            order.append(c)
+          frames[c].append((frame, key))
+    self.write_many(frames, order)
+  ## Make the frame of a binary message delivered to several clients.
+  # @param self The playernsd::ClientManager instance.
+  # @param _from The client id of the sender.
+  # @param msg The payload of the message.
+  # @return The msgbin frame, or (from, msg) if the frame depends on
+  #         whether the recipient compresses.
+  def bin_frame(self, _from, msg):
+    if self.__compressors and len(msg) >= COMPRESS_THRESHOLD:
+      return (_from, msg)
+    return 'msgbin ' + _from + ' ' + str(len(msg)) + '\n' + msg
+  ## Write frames grouped by recipient.
+  #
+  # Each client has all of its frames written with a single send.  State
+  # messages are written on their own, so that they can be replaced while
+  # queued.
+  # @param self The playernsd::ClientManager instance.
+  # @param frames Dictionary of playernsd::remoteclient::RemoteClient to
+  #        list of (frame, key) tuples, where the frame may be a (from, msg)
+  #        tuple (see playernsd::ClientManager::bin_frame).
+  # @param order The clients in the order to write to them.
+  def write_many(self, frames, order):
+    for c in order:
+      joined = []
+      for frame, key in frames[c]:
+        if isinstance(frame, tuple):
+          frame = self.frame(c, *frame)
+        if key:
+          if joined:
+            self.write(c.socket, c.address, ''.join(joined), len(joined))
+            joined = []
+          self.write(c.socket, c.address, frame, key=key)
+        else:
+          joined.append(frame)
+      if joined:
+        self.write(c.socket, c.address, ''.join(joined), len(joined))
+  ## Send a batch of messages from a client.
+  #
+  # A simulation is given the batch in one call when it has a send_batch
+  # method; otherwise each message is sent in turn.  Group messages are
+  # sent to it as group messages in between, splitting the batch.  Without
+  # a simulation, the frames for each recipient are written together (and
+  # virtual clients are handed the messages one by one).
+  # @param self The playernsd::ClientManager instance.
+  # @param _from The client id of the sender.
+  # @param batch List of (kind, to, msg) tuples, where kind is 'msgtext' or
+  #        'msgbin' and to is a client id, '@' and a group name, or None to
+  #        broadcast.
+  def send_batch(self, _from, batch):
+    if simulation:
+      out = []
+      sender = self.sim_address(_from)
+      for kind, to, msg in batch:
+        if to == None:
+          out.append((sender, self.__everyone, msg))
+        elif to.startswith('@'):
+          if out:
+            send_batch(self.__sim, out)
+            out = []
+          self.sim_group(_from, to[1:],
+            [m for m in self.get_group(to[1:]) if m != _from], msg)
+        elif self.sim_address(to):
+          out.append((sender, self.sim_address(to), msg))
+      if out:
+        send_batch(self.__sim, out)
+      return
+    frames = {}
+    order = []
+    for kind, to, msg in batch:
+      if kind == 'msgtext':
+        frame = 'msgtext ' + _from + '\n' + msg + '\n'
+      else:
+        frame = self.bin_frame(_from, msg)
+      if to == None:
+        recipients = [v for v in self.__clients.values() if v.name != _from]
+      elif to.startswith('@'):
+        recipients = [self.__clientids.get(m) for m in self.get_group(to[1:])
+          if m != _from]
+      else:
+        recipients = [self.__clientids.get(to)]
+      for c in recipients:
+        if c and c.socket == None:
+          self.write(None, c.address, (kind, _from, msg))
+        elif c:
+          if c not in frames:
+            frames[c] = []
+            order.append(c)
+          frames[c].append((frame, None))
+    self.write_many(frames, order)
+  ## Give a client a token for its datagrams.
+  # @param self The playernsd::ClientManager instance.
+  # @param address The address of the client.
+  # @return The token.
+  def datagram_token(self, address):
+    c = self.__clients[address]
+    if not c.token:
+      c.token = os.urandom(16).encode('hex')
+      self.__tokens[c.token] = c
+    return c.token
+  ## Handle a datagram from a client.
+  # @param self The playernsd::ClientManager instance.
+  # @param token The token the datagram starts with.
+  # @param address The (host, port) the datagram came from.
+  # @param command The words of the command line after the token.
+  # @param data The rest of the datagram.
+  def recv_datagram(self, token, address, command, data):
+    c = self.__tokens.get(token)
+    cmd = command[0]
+    if not c:
+      datagrams.dropped.inc()
+    elif cmd == 'subscribe' and len(command) == 1:
+      c.udp = address
+      datagrams.sendto('subscribed\n', address)
+    elif cmd == 'unsubscribe' and len(command) == 1:
+      c.udp = None
+      datagrams.sendto('unsubscribed\n', address)
+    elif cmd == 'msgbin' and len(command) in (2, 3) and \
+        command[-1] == str(len(data)):
+      c.bytes_in += len(data)
+      c.msgs_in += 1
+      self.send_datagram(c.name, len(command) == 3 and command[1] or None,
+        data)
+    else:
+      datagrams.dropped.inc()
+  ## Send a message that came in a datagram.
+  #
+  # The message is routed like one sent over TCP, but is delivered in a
+  # datagram to the recipients that have subscribed.
+  # @param self The playernsd::ClientManager instance.
+  # @param _from The client id of the sender.
+  # @param to The client id, '@' and a group name, or None to broadcast.
+  # @param msg The message.
+  def send_datagram(self, _from, to, msg):
+    if to != None and ((to.startswith('@') and not self.has_group(to[1:]))
+        or (not to.startswith('@') and to not in self.__clientids)):
+      datagrams.dropped.inc()
+      return
+    if simulation:
+      # the message carries its transport through the simulation
+      msg = Message(msg)
+      msg.datagram = True
+      if to == None:
+        self.__sim.send(self.sim_address(_from), self.__everyone, msg)
+      elif to.startswith('@'):
+        self.sim_group(_from, to[1:],
+          [m for m in self.get_group(to[1:]) if m != _from], msg)
+      else:
+        self.__sim.send(self.sim_address(_from), self.sim_address(to), msg)
+      return
+    if to == None:
+      recipients = [v for v in self.__clients.values()
+        if v.name not in (None, _from)]
+    elif to.startswith('@'):
+      recipients = [self.__clientids.get(m) for m in self.get_group(to[1:])
+        if m != _from]
+    else:
+      recipients = [self.__clientids[to]]
+    for c in recipients:
+      if c and c.udp:
+        self.deliver_datagram(c, _from, msg)
+      elif c:
+        self.write(c.socket, c.address, self.frame(c, _from, msg))
+  ## Deliver a message to a client in a datagram.
+  #
+  # Messages too long for a datagram are delivered over TCP.
+  # @param self The playernsd::ClientManager instance.
+  # @param c The playernsd::remoteclient::RemoteClient of the recipient.
+  # @param _from The client id of the sender.
+  # @param msg The message.
+  def deliver_datagram(self, c, _from, msg):
+    frame = 'msgbin ' + _from + ' ' + str(len(msg)) + '\n' + msg
+    if len(frame) <= datagram.MAX_SEND:
+      try:
+        datagrams.sendto(frame, c.udp)
+        c.bytes_out += len(frame)
+        c.msgs_out += 1
+        return
+      except socket.error, e:
+        log.warn('Sending a datagram to ' + str(c.udp) + ' failed: ' + str(e))
+    self.write(c.socket, c.address, self.frame(c, _from, msg))
   ## Receive a property value from the simulation.
   def prop_val_sim(self, _from, prop, val):
     #if val == "":
       #self.send('error propnotexist\n') # TODO: Handle empty strings separately?
     #else:
-    self.__clientids[_from].socket.send('propval ' + prop + ' ' + str(val) + '\n')
+    if self.__by_handle:
+      c = self.__byhandle[_from]
+      if not c:
+        return
+      _from = c.name
+    else:
+      c = self.__clientids[_from]
+    if self.__prop_gets.get(_from):
+      self.__roundtrip.observe(time.time() - self.__prop_gets[_from].pop(0))
+    self.write(c.socket, c.address, 'propval ' + prop + ' ' + str(val) + '\n')
   ## Create a log message.
   #
   # This is used internally to log sent and received messages.
@@ -318,10 +1138,8 @@ class ClientManager():
   # @param tag Tag indicating the log level.
   # @param msg The message to be logged.
   def log(self, ca, tag, msg):
-    if len(msg):
-      logmsg = tag + ': ' + msg.encode(sys.stdout.encoding,
-        'backslashreplace').replace('\n', '\\n')
-      log.debug(self.get_id(ca) + ' ' + logmsg)
+    if len(msg) and log.isEnabledFor(logging.DEBUG) and logqueue.sample():
+      log.debug('%s %s: %s', self.get_id(ca), tag, Payload(msg))
   ## Get id of client or else return '__unregistered'
   def get_id(self, ca):
     if ca in self.__clients and self.__clients[ca].name != None:
@@ -333,20 +1151,18 @@ class ClientManager():
   # @param args Additional arguments.
   # @param args Additional keyword arguments.
   def __timeout_check(self, args, kwargs):
+    # Socket errors are reported by the outboxes (see lost)
     with self.__client_lock:
       for k,v in self.__clients.iteritems():
-        try:
-          self.send('ping\n', v.socket, k)
-          self.__ping_pong[k] -= 1
-          if self.__ping_pong[k] < -self.missed_ping:
-            log.warn(str(k) + ' has missed at least ' +
-              str(-self.__ping_pong[k]+1) + ' pings, closing connection')
-            self.send('error missedping\n', v.socket, k)
-            v.socket.shutdown(1)
-        except socket.error, msg:
-          if not self.is_timed_out(k):
-            self.__timed_out.append(k)
-            log.warn('Lost connection to ' + str(k) + ' ' + str(msg))
+        self.send('ping\n', v.socket, k)
+        self.__ping_pong[k] -= 1
+        if self.__ping_pong[k] < -self.missed_ping:
+          log.warn(str(k) + ' has missed at least ' +
+            str(-self.__ping_pong[k]+1) + ' pings, closing connection')
+          self.send('error missedping\n', v.socket, k)
+          # shut the socket down now, rather than after what is queued,
+          # which a client that doesn't read never takes
+          v.outbox.shutdown()
   ## Stop the client manager thread
   #
   # This is used to gracefully close the client manager and simulation threads.
@@ -367,12 +1183,18 @@ class RequestState:
   COMMAND = 0
   MSGTEXT = 1
   MSGBIN = 2
+  STREAM = 3
+  SKIP = 4
+  BATCH = 5
 
 ## The TCP request handler class interacts with clients.
 #
 # The TCP request handler class deals with all the connections, messages 
 # received and replies with the clients.
 class TCPRequestHandler(SocketServer.BaseRequestHandler):
+  ## Handlers of the clients on a gateway connection by handle, or None
+  # if the connection is not a gateway
+  subs = None
   ## Send a message to a client.
   #
   # This is a wrapper function to send a message to a client.
@@ -383,19 +1205,28 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
   # @param msg The message to be sent.
   # @param s The socket to send the message to.
   # @param ca The client address to send the message to.
-  def send(self, msg, s=None, ca=None):
+  # @param tag The tag of a state message.
+  def send(self, msg, s=None, ca=None, tag=None):
     if not s:
       s = self.request
     if not ca:
       ca = self.client_address
-    client_manager.send(msg, s, ca)
+    client_manager.send(msg, s, ca, tag)
   ## Broadcast a message to all clients.
   #
   # This is a wrapper function to broadcast a message to all clients.
   # @param self The playernsd::TCPRequestHandler instance.
   # @param msg The message to be sent to all clients.
-  def broadcast(self, msg):
-    client_manager.broadcast(msg)
+  # @param tag The tag of a state message.
+  def broadcast(self, msg, tag=None):
+    client_manager.broadcast(msg, tag)
+  ## Send a message to the other members of a group.
+  # @param self The playernsd::TCPRequestHandler instance.
+  # @param msg The message to be sent.
+  # @param group The name of the group.
+  # @param tag The tag of a state message.
+  def multicast(self, msg, group, tag=None):
+    client_manager.send_group(msg, group, tag)
   ## Receive a message from a client.
   #
   # This is a wrapper function to receive a message from a client and
@@ -403,13 +1234,73 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
   # @param self The playernsd::TCPRequestHandler instance.
   # @param s The socket to send the message to.
   # @param ca The client address to send the message to.
+  # @param size The maximum number of bytes to read (MAX_READ if None).
   # @return The message received from the client.
-  def recv(self, s=None, ca=None):
+  def recv(self, s=None, ca=None, size=None):
     if not s:
       s = self.request
     if not ca:
       ca = self.client_address
-    return client_manager.recv(s, ca)
+    return client_manager.recv(s, ca, size)
+  ## Deliver a binary message from the client.
+  # @param self The playernsd::TCPRequestHandler instance.
+  # @param msgbin The message.
+  # @param broadcast Whether to broadcast the message.
+  # @param s The socket of the recipient (unless broadcasting).
+  # @param ca The client address of the recipient (unless broadcasting).
+  # @param tag The tag of a state message.
+  # @param group The name of the group the message is for, if any.
+  def deliver(self, msgbin, broadcast, s, ca, tag, group=None):
+    msg = 'msgbin ' + client_manager.get_client(self.client_address).name + \
+      ' ' + str(len(msgbin)) + '\n' + msgbin
+    if group != None:
+      self.multicast(msg, group, tag)
+    elif broadcast:
+      self.broadcast(msg, tag)
+    else:
+      self.send(msg, s, ca, tag)
+  ## Deliver the messages of a batch from the client.
+  #
+  # The batch is parsed in one pass.  Messages for unknown clients or
+  # groups are left out, but the batch is dropped whole if it is malformed.
+  # @param self The playernsd::TCPRequestHandler instance.
+  # @param data The messages.
+  # @param count The number of messages.
+  def deliver_batch(self, data, count):
+    batch = []
+    errors = []
+    pos = 0
+    for i in xrange(count):
+      nlpos = data.find('\n', pos)
+      command = data[pos:nlpos].split(' ')
+      if nlpos == -1 or command[0] not in ('msgtext', 'msgbin') or \
+          len(command) not in (2, 3) or not command[-1].isdigit():
+        self.send('error invalidparam\n')
+        return
+      pos = nlpos + 1 + int(command[-1])
+      msg = data[nlpos+1:pos]
+      to = len(command) == 3 and command[1] or None
+      if pos > len(data) or (command[0] == 'msgtext' and '\n' in msg):
+        self.send('error invalidparam\n')
+        return
+      if to == None:
+        batch.append((command[0], to, msg))
+      elif to.startswith('@'):
+        if client_manager.has_group(to[1:]):
+          batch.append((command[0], to, msg))
+        else:
+          errors.append('error unknowngroup\n')
+      elif client_manager.has_client(to):
+        batch.append((command[0], to, msg))
+      else:
+        errors.append('error unknownclient\n')
+    if pos != len(data):
+      self.send('error invalidparam\n')
+      return
+    for error in errors:
+      self.send(error)
+    client_manager.send_batch(
+      client_manager.get_client(self.client_address).name, batch)
   ## Setup a connection with a client.
   #
   # This is called whenever a new client connects.
@@ -417,8 +1308,8 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
   def setup(self):
     ca = self.client_address
     log.info(client_manager.get_id(ca) + ' Connected!')
-    self.send('greetings ' + ca[0] + ' ' + NAME + ' ' + VERSION + '\n')
     client_manager.add_client(ca, self.request)
+    self.send('greetings ' + ca[0] + ' ' + NAME + ' ' + VERSION + '\n')
     self.__state = RequestState.COMMAND
   ## Function that handles all client requests.
   #
@@ -427,7 +1318,11 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
   def handle(self):
     msgbin = ''
     msg_len = 0
+    msg_tag = None
+    msg_group = None
     data = ''
+    ## Streams the binary message being received is passed on to
+    self.streams = []
     __state = RequestState.COMMAND
     lastlen = 0
     while True:
@@ -438,20 +1333,32 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
         if client_manager.is_timed_out(ca):
           return
         # Check state if we're currently reading binary msg
-        if __state == RequestState.MSGBIN:
-          if msg_len > len(data):
-            data += self.recv()
-          readlen = len(data)
-          msgbin += data[:msg_len]
+        if __state in (RequestState.MSGBIN, RequestState.STREAM,
+            RequestState.SKIP, RequestState.BATCH):
+          if not data:
+            # never read past the payload, so nothing is left over to copy
+            received = self.recv(size=min(msg_len, PAYLOAD_READ))
+            # Connection closed by the client
+            if len(received) == 0:
+              return
+            data = received
+          chunk = data[:msg_len]
           data = data[msg_len:]
-          msg_len -= readlen
-          if msg_len <= 0:
-            if msg_broadcast:
-              self.broadcast('msgbin ' + client_manager.get_client(ca).name + ' ' +
-                str(len(msgbin)) + '\n' + msgbin)
-            else:
-              self.send('msgbin ' + client_manager.get_client(ca).name + ' ' +
-                str(len(msgbin)) + '\n' + msgbin, msg_cs, msg_ca)
+          msg_len -= len(chunk)
+          if __state in (RequestState.MSGBIN, RequestState.BATCH):
+            msgbin.append(chunk)
+          elif __state == RequestState.STREAM:
+            # pass the chunk on straight away
+            for stream in self.streams:
+              stream.write(chunk)
+          if msg_len == 0:
+            if __state == RequestState.MSGBIN:
+              self.deliver(''.join(msgbin), msg_broadcast, msg_cs, msg_ca,
+                msg_tag, msg_group)
+            elif __state == RequestState.BATCH:
+              self.deliver_batch(''.join(msgbin), msg_count)
+            msgbin = ''
+            self.streams = []
             __state = RequestState.COMMAND
           continue
         elif __state == RequestState.MSGTEXT:
@@ -459,10 +1366,11 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
           nlpos = data.find('\n')
           if nlpos == -1:
             # None found, grab some new data
-            data += self.recv()
-            # Anything to do?
-            if len(data) == 0:
-              continue
+            received = self.recv()
+            # Connection closed by the client
+            if len(received) == 0:
+              return
+            data += received
             # Look for new lines in new data
             nlpos = data.find('\n')
             # None found: *shouldn't happen unless really slow connection*
@@ -475,10 +1383,12 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
           # Remove that from the data
           data = data[nlpos+1:]
           # Send the message off
-          if msg_broadcast:
-            self.broadcast('msgtext ' + client_manager.get_client(ca).name + '\n' + msgtext)
-          else:
-            self.send('msgtext ' + client_manager.get_client(ca).name + '\n' + msgtext, msg_cs, msg_ca)
+          if msg_group != None:
+            self.multicast('msgtext ' + client_manager.get_client(ca).name + '\n' + msgtext + '\n', msg_group)
+          elif msg_broadcast:
+            self.broadcast('msgtext ' + client_manager.get_client(ca).name + '\n' + msgtext + '\n')
+          elif msg_ca != None: # else the recipient is unknown, skip the text
+            self.send('msgtext ' + client_manager.get_client(ca).name + '\n' + msgtext + '\n', msg_cs, msg_ca)
           __state = RequestState.COMMAND
           continue
         elif __state == RequestState.COMMAND:
@@ -486,10 +1396,11 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
           nlpos = data.find('\n')
           if nlpos == -1:
             # None found, grab some new data
-            data += self.recv()
-            # Anything to do?
-            if len(data) == 0:
-              continue
+            received = self.recv()
+            # Connection closed by the client
+            if len(received) == 0:
+              return
+            data += received
             # Look for new lines in new data
             nlpos = data.find('\n')
             # None found: *shouldn't happen unless really slow connection*
@@ -505,6 +1416,13 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
         data = data[nlpos+1:]
         # We don't need the command after we know what it is
         cmd = command.pop(0)
+        if client_manager.has_client(ca):
+          client_manager.get_client(ca).msgs_in += 1
+        start = time.time()
+      except socket.error, msg:
+        log.error(msg)
+        return
+      try:
         if cmd == 'greetings':
           # check parameter count
           if len(command) < 3:
@@ -512,7 +1430,10 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
             continue
           # store the client's id for the address
           cid = command.pop(0)
-          if client_manager.is_registered(ca):
+          if cid.startswith('@'):
+            # '@' addresses a group, so it can't start a client id
+            self.send('error invalidparam\n')
+          elif client_manager.is_registered(ca):
             # if already registered, don't register again (send error back)
             self.send('error alreadyregistered\n')
           elif client_manager.is_registered(cid):
@@ -530,7 +1451,20 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
               # terminate the connection
               return
             client_manager.register_client(ca, cid, command[1])
-            self.send("registered\n")
+            # acknowledge the features that the daemon supports
+            registered = 'registered'
+            for feature in command[2:]:
+              if feature == 'zlib' or (feature.startswith('zlib:') and
+                  feature[5:] in COMPRESS_DICTS):
+                client_manager.compress(ca, feature[5:] or None)
+                registered += ' ' + feature
+              elif feature.startswith('zlib:'):
+                client_manager.compress(ca)
+                registered += ' zlib'
+              elif feature == 'udp' and datagrams:
+                registered += ' udp:' + str(datagrams.port) + ':' + \
+                  client_manager.datagram_token(ca)
+            self.send(registered + '\n')
         elif cmd == 'listclients':
           # list all the client ids
           clientslist = 'listclients '
@@ -540,30 +1474,50 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
           self.send(clientslist + '\n')
         elif cmd == 'propget':
           # get a property value
-          val = propget(command[0])
-          if val != None:
-            self.send('propval ' + command[0] + ' ' + val + '\n')
-          else: # Ask NS3
-            client_manager.prop_get_sim(command[0], self.client_address)
+          client_manager.prop_get(command[0], ca)
         elif cmd == 'propset':
           # set a property using a key & value
           # TODO: is ' '.join safe?
           key = command.pop(0)
-          val = propget(key)
-          if val != None:
-            propset(key, ' '.join(command))
-          else:
-            client_manager.prop_set_sim(key, ' '.join(command), self.client_address)
+          client_manager.prop_set(key, ' '.join(command), ca)
         elif cmd == 'ping':
           self.send('pong\n')
         elif cmd == 'pong':
           client_manager.pong(ca)
+        elif cmd == 'tock':
+          # acknowledge a lockstep step
+          if len(command) != 1 or not command[0].isdigit():
+            self.send('error invalidparam\n')
+          else:
+            client_manager.tock(ca, int(command[0]))
+        elif cmd == 'gateway':
+          # carry many clients over this connection
+          if client_manager.is_registered(ca) or self.subs != None or \
+              isinstance(self.request, FrameSocket):
+            self.send('error alreadyregistered\n')
+          else:
+            self.subs = {}
+            if capture:
+              # the clients on the connection are captured instead
+              capture.disconnect(ca)
+            self.send('gateway\n')
         elif cmd == 'bye':
           return
-        elif not client_manager.has_client(ca):
+        elif not client_manager.is_registered(ca):
           # if client has not registered
           self.send('error notregistered\n')
+        elif cmd == 'join' or cmd == 'leave':
+          # join or leave a group
+          if len(command) != 1:
+            self.send('error invalidparamcount\n')
+          elif not command[0] or command[0].startswith('@'):
+            self.send('error invalidparam\n')
+          elif cmd == 'join':
+            client_manager.join(ca, command[0])
+          else:
+            client_manager.leave(ca, command[0])
         elif cmd == 'msgtext':
+          msg_group = None
           if len(command) == 0: # zero param == broadcast
             # prepare to send message next loop iteration
             msg_broadcast = True
@@ -571,7 +1525,16 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
           elif len(command) == 1: # two params == to a particular client
             # send a message to a client
             cid = command.pop(0)
-            if client_manager.has_client(cid):
+            if cid.startswith('@'):
+              # or to a group
+              if client_manager.has_group(cid[1:]):
+                msg_group = cid[1:]
+              else:
+                self.send('error unknowngroup\n')
+                msg_ca = None
+              msg_broadcast = False
+              __state = RequestState.MSGTEXT
+            elif client_manager.has_client(cid):
               _ca = client_manager.get_client(cid).address
               # prepare to send message next loop iteration
               msg_ca = client_manager.get_client(cid).address
@@ -579,64 +1542,208 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
               msg_broadcast = False
               __state = RequestState.MSGTEXT
             else:
+              # skip the text of the message
               self.send('error unknownclient\n')
+              msg_ca = None
+              msg_broadcast = False
+              __state = RequestState.MSGTEXT
           else: # else error that the param count is invalid
             self.send('error invalidparamcount\n')
-        elif cmd == 'msgbin':
-          if len(command) == 1: # one param == broadcast
-            msglen = command.pop(0)
-            if msglen.isdigit() or msglen > MAX_SEND:
-              # check if all of the message is in the existing buffer
+        elif cmd == 'msgbin' or cmd == 'msgstate':
+          # a state message has a tag, and is delivered as a msgbin that
+          # replaces an older one with the same tag still queued
+          msg_tag = None
+          msg_group = None
+          if cmd == 'msgstate' and len(command) > 0:
+            msg_tag = command.pop(0)
+          if len(command) == 1 or len(command) == 2:
+            # one param == broadcast, two params == to a particular client
+            # (or group)
+            msglen = command.pop()
+            cid = len(command) and command.pop() or None
+            if cid != None and cid.startswith('@'):
+              msg_group = cid[1:]
+              cid = None
+            if not msglen.isdigit(): # error that the parameter is invalid (expected integer)
+              self.send('error invalidparam\n')
+            elif int(msglen) > MAX_SEND or \
+                (cid != None and not client_manager.has_client(cid)) or \
+                (msg_group != None and not client_manager.has_group(msg_group)):
+              # error that the message is too long or the client or group
+              # is unknown, and skip the message
+              if int(msglen) > MAX_SEND:
+                self.send('error toolarge\n')
+              elif msg_group != None:
+                self.send('error unknowngroup\n')
+              else:
+                self.send('error unknownclient\n')
               msg_len = int(msglen)
+              if msg_len > 0:
+                __state = RequestState.SKIP
+            else:
+              msg_len = int(msglen)
+              msg_broadcast = cid == None and msg_group == None
+              msg_cs = msg_ca = None
+              if cid != None:
+                msg_ca = client_manager.get_client(cid).address
+                msg_cs = client_manager.get_client(msg_ca).socket
+              # check if all of the message is in the existing buffer
               if len(data) >= msg_len:
                 msgbin = data[:msg_len]
                 data = data[msg_len:]
-                self.broadcast('msgbin ' + client_manager.get_client(ca).name + ' ' +
-                  msglen + '\n' + msgbin)
+                self.deliver(msgbin, msg_broadcast, msg_cs, msg_ca, msg_tag,
+                  msg_group)
               else:
-                # Receive the required data in next iteration
-                msgbin = data
-                msg_len -= len(data)
-                data = ''
-                msg_broadcast = True
-                __state = RequestState.MSGBIN
-            else:
-              self.send('error invalidparam\n')
-          elif len(command) == 2: # two params == to a particular client
-            # send a binary message to a client
-            cid = command.pop(0)
-            if client_manager.has_client(cid):
-              _ca = client_manager.get_client(cid).address
-              _cs = client_manager.get_client(_ca).socket
-              msglen = command.pop(0)
-              if msglen.isdigit() or msglen > MAX_SEND:
-                # check if all of the message is in the existing buffer
-                msg_len = int(msglen)
-                if len(data) >= msg_len:
-                  msgbin = data[:msg_len]
-                  data = data[msg_len:]
-                  self.send('msgbin ' + client_manager.get_client(ca).name + ' ' + msglen +
-                    '\n' + msgbin, _cs, _ca)
+                # Receive the rest in the next iterations, passing long
+                # messages on as they arrive
+                streams = None
+                if msg_len >= STREAM_THRESHOLD and msg_tag == None:
+                  streams = client_manager.open_stream(
+                    client_manager.get_client(ca).name, msg_ca, msg_len,
+                    msg_group)
+                if streams != None:
+                  self.streams = streams
+                  __state = RequestState.STREAM
                 else:
-                  # Receive the required data in next iteration
-                  msgbin = data
-                  msg_len -= len(data)
-                  msg_cs = _cs
-                  msg_ca = _ca
-                  msg_broadcast = False
+                  msgbin = []
                   __state = RequestState.MSGBIN
-              else: # error that the parameter is invalid (expected integer)
-                self.send('error invalidparam\n')
-            else: # error that the client is unknown
-              self.send('error unknownclient\n')
           else: # else error that the param count is invalid
             self.send('error invalidparamcount\n')
+        elif cmd == 'msgbatch':
+          # several messages in one frame
+          if len(command) != 2:
+            self.send('error invalidparamcount\n')
+          elif not command[0].isdigit() or not command[1].isdigit():
+            self.send('error invalidparam\n')
+          else:
+            msg_count = int(command[0])
+            msg_len = int(command[1])
+            if msg_len > MAX_SEND:
+              # skip the messages
+              self.send('error toolarge\n')
+              if msg_len > 0:
+                __state = RequestState.SKIP
+            elif len(data) >= msg_len:
+              batch = data[:msg_len]
+              data = data[msg_len:]
+              self.deliver_batch(batch, msg_count)
+            else:
+              msgbin = []
+              __state = RequestState.BATCH
+        elif cmd == 'profile':
+          # start a profile (only for local clients)
+          if not is_admin(ca):
+            self.send('error notallowed\n')
+          elif len(command) == 0 or len(command) > 2:
+            self.send('error invalidparamcount\n')
+          elif command[0] not in ('cpu', 'mem') or \
+              (len(command) == 2 and not command[1].isdigit()):
+            self.send('error invalidparam\n')
+          else:
+            path = profile(command[0],
+              len(command) == 2 and float(command[1]) or None)
+            if path:
+              self.send('profile ' + path + '\n')
+            else:
+              self.send('error notavailable\n')
+        elif cmd == 'stats':
+          # report the daemon statistics
+          body = stats.registry.render()
+          self.send('stats ' + str(len(body)) + '\n' + body)
         else:
           log.warn(client_manager.get_id(ca) + ' Unknown command "' + cmd + '".')
           self.send('error unknowncmd\n')
+          cmd = 'unknown'
       except socket.error, msg:
         log.error(msg)
         return
+      finally:
+        stats.registry.histogram('playernsd_command_seconds',
+          'Time taken to handle a command.', command=cmd).observe(
+          time.time() - start)
+      if self.subs != None:
+        # the rest of the connection is gateway frames
+        return self.gateway(data)
+  ## Read the frames of a gateway connection.
+  #
+  # Each frame is handled in this thread by the handler of the client it
+  # is for.
+  # @param self The playernsd::TCPRequestHandler instance.
+  # @param data The data received after the gateway command.
+  def gateway(self, data):
+    ca = self.client_address
+    try:
+      while True:
+        nlpos = data.find('\n')
+        while nlpos == -1:
+          if client_manager.is_timed_out(ca):
+            return
+          received = self.recv()
+          # Connection closed by the gateway host
+          if len(received) == 0:
+            return
+          data += received
+          nlpos = data.find('\n')
+        command = data[:nlpos].split(' ')
+        data = data[nlpos+1:]
+        cmd = command.pop(0)
+        if cmd == 'sub':
+          if len(command) != 2 or not command[0].isdigit() or \
+              not command[1].isdigit():
+            self.send('error invalidparam\n')
+            return
+          length = int(command[1])
+          if length > MAX_SEND + MAX_READ:
+            self.send('error toolarge\n')
+            return
+          while len(data) < length:
+            received = self.recv(size=min(length - len(data), PAYLOAD_READ))
+            if len(received) == 0:
+              return
+            data += received
+          self.feed(int(command[0]), data[:length])
+          data = data[length:]
+        elif cmd == 'ping':
+          self.send('pong\n')
+        elif cmd == 'pong':
+          client_manager.pong(ca)
+        elif cmd == 'bye':
+          return
+        else:
+          log.warn(client_manager.get_id(ca) + ' Unknown gateway command "' +
+            cmd + '".')
+          self.send('error unknowncmd\n')
+    except socket.error, msg:
+      log.error(msg)
+  ## Handle a frame for a client on a gateway connection.
+  # @param self The playernsd::TCPRequestHandler instance.
+  # @param handle The handle of the client.
+  # @param frame The commands of the client, or '' to close it.
+  def feed(self, handle, frame):
+    sub = self.subs.get(handle)
+    if sub and not sub.outbox.running:
+      # the daemon has closed the client, so the handle starts a new one
+      self.close_sub(handle)
+      sub = None
+    if not frame:
+      if sub:
+        self.close_sub(handle)
+      return
+    if not sub:
+      if len(self.subs) >= GATEWAY_CLIENTS:
+        self.send('sub ' + str(handle) + ' 0\n')
+        return
+      sub = self.subs[handle] = SubRequestHandler(self, handle)
+    sub.request.feed(frame)
+    sub.handle()
+    if not sub.request.drained:
+      # the client said bye or was turned away
+      self.close_sub(handle)
+  ## Close a client on a gateway connection.
+  # @param self The playernsd::TCPRequestHandler instance.
+  # @param handle The handle of the client.
+  def close_sub(self, handle):
+    self.subs.pop(handle).finish()
   ## Function that finalises communications with the client
   #
   # This will clear up references to disconnected clients and makes
@@ -647,9 +1754,57 @@ class TCPRequestHandler(SocketServer.BaseRequestHandler):
     # Shorthand for client address
     ca = self.client_address
     log.info(client_manager.get_id(ca) + ' Disconnected!')
+    # fill in a binary message cut off part way
+    for stream in self.streams:
+      stream.abort()
+    # close the clients on a gateway connection
+    for handle in list(self.subs or ()):
+      self.close_sub(handle)
     # delete the items
     client_manager.remove_client(ca)
 
+## The request handler of a client on a gateway connection.
+#
+# Its commands are read from the frames for it, and the frames it is sent
+# are wrapped and queued for the gateway connection.
+class SubRequestHandler(TCPRequestHandler):
+  ## Set up a client on a gateway connection.
+  # @param self The playernsd::SubRequestHandler instance.
+  # @param host The playernsd::TCPRequestHandler of the gateway connection.
+  # @param handle The handle of the client on the gateway connection.
+  def __init__(self, host, handle):
+    self.host = host
+    self.request = FrameSocket()
+    self.client_address = host.client_address + (handle,)
+    self.setup()
+  ## Register the client, sharing the queue of the gateway connection.
+  # @param self The playernsd::SubRequestHandler instance.
+  def setup(self):
+    ca = self.client_address
+    outbox = client_manager.get_client(self.host.client_address).outbox
+    ## The playernsd::gateway::SubOutbox of the client
+    self.outbox = SubOutbox(outbox, ca[-1],
+      lambda: client_manager.pong(ca),
+      lambda data, count, seconds: client_manager.sent(ca, data, count,
+        seconds))
+    # each client gets as much room as it would on its own connection
+    if outbox.max_bytes:
+      outbox.max_bytes += QUEUE_BYTES
+    if outbox.max_msgs:
+      outbox.max_msgs += QUEUE_MSGS
+    log.info(client_manager.get_id(ca) + ' Connected!')
+    client_manager.add_client(ca, self.request, self.outbox)
+    self.send('greetings ' + ca[0] + ' ' + NAME + ' ' + VERSION + '\n')
+    self.streams = []
+  ## Remove the client, giving back its room in the queue.
+  # @param self The playernsd::SubRequestHandler instance.
+  def finish(self):
+    TCPRequestHandler.finish(self)
+    if self.outbox.outbox.max_bytes:
+      self.outbox.outbox.max_bytes -= QUEUE_BYTES
+    if self.outbox.outbox.max_msgs:
+      self.outbox.outbox.max_msgs -= QUEUE_MSGS
+
 # server host is a tuple ('host', port)
 if __name__ == "__main__":
   ## Instance of option parser to parse command line arguments passed
@@ -659,39 +1814,159 @@ if __name__ == "__main__":
   parser.add_option("-p", "--port", type="int",
                     dest="port", default=PORT,
                     help="don't print status messages to stdout")
+  parser.add_option("--unix", type="string", dest="unix", default=UNIX_PATH,
+                    metavar="PATH",
+                    help="also listen on the unix domain socket PATH ('@' "
+                    "and a name for an abstract socket)")
+  parser.add_option("--no-tcp", action="store_false", dest="tcp",
+                    default=True, help="don't listen on TCP (needs --unix)")
   parser.add_option("-v", "--verbose", action="store_const", const=2, dest="verbose",
                     default=VERBOSE, help="verbose logging")
   parser.add_option("-q", "--quiet", action="store_const", const=0, dest="verbose",
                     default=VERBOSE, help="quiet logging")
   parser.add_option("-l", type="string", dest="logfile", default=LOGFILE,
                     help="specify logfile", metavar="FILE")
+  parser.add_option("--log-payload", type="int", dest="log_payload",
+                    default=LOG_PAYLOAD, metavar="BYTES",
+                    help="truncate logged payloads to BYTES (0 for no limit)")
+  parser.add_option("--log-sample", type="int", dest="log_sample",
+                    default=LOG_SAMPLE, metavar="N",
+                    help="only log every N-th payload in verbose logging")
+  parser.add_option("--log-queue", type="int", dest="log_queue",
+                    default=LOG_QUEUE, metavar="N",
+                    help="drop log records beyond N waiting to be written "
+                      "(0 for no limit) [default: %default]")
+  parser.add_option("--max-send", type="int", dest="max_send",
+                    default=MAX_SEND, metavar="BYTES",
+                    help="maximum length of a binary message [default: %default]")
+  parser.add_option("--compress-threshold", type="int",
+                    dest="compress_threshold", default=COMPRESS_THRESHOLD,
+                    metavar="BYTES",
+                    help="compress binary messages at least this long for clients that ask [default: %default]")
+  parser.add_option("--compress-level", type="int", dest="compress_level",
+                    default=COMPRESS_LEVEL, metavar="LEVEL",
+                    help="zlib compression level [default: %default]")
+  parser.add_option("--compress-dict", type="string", dest="compress_dicts",
+                    action="append", default=[], metavar="NAME=FILE",
+                    help="shared compression dictionary clients can ask for by name (repeatable)")
+  parser.add_option("--compress-sim", action="store_true",
+                    dest="compress_sim", default=False,
+                    help="compress messages sent to a simulator executable")
+  parser.add_option("--sim-sendmany", action="store_true",
+                    dest="sim_sendmany", default=False,
+                    help="send group messages to a simulator executable as single SENDMANY frames")
+  parser.add_option("--sim-reuse-nodes", action="store_true",
+                    dest="sim_reuse_nodes", default=False,
+                    help="tell a simulator executable when a client leaves and give its node to a later client")
   parser.add_option("-o", type="string", dest="sim_options", default='',
-                    help="options to simulation")
+                    help="comma separated options to simulation")
   parser.add_option("-m", "--environment-image", type="string", dest="envimage",
                     help="environment image for line-of-sight communication")
+  parser.add_option("-s", "--lockstep", type="float", dest="lockstep",
+                    default=LOCKSTEP, metavar="SECONDS",
+                    help="run in lockstep, advancing simulated time by "
+                    "SECONDS once all clients acknowledge a step")
+  parser.add_option("--step-deadline", type="float", dest="step_deadline",
+                    default=STEP_DEADLINE, metavar="SECONDS",
+                    help="wall clock time to wait for clients each step")
+  parser.add_option("--udp-port", type="int", dest="udp_port",
+                    default=UDP_PORT, metavar="PORT",
+                    help="receive messages in datagrams on UDP PORT "
+                    "(0 disables UDP) [default: %default]")
+  parser.add_option("--stats-port", type="int", dest="stats_port",
+                    default=STATS_PORT, metavar="PORT",
+                    help="serve metrics over HTTP on localhost:PORT")
+  parser.add_option("--profile-dir", type="string", dest="profile_dir",
+                    default=PROFILE_DIR, metavar="DIR",
+                    help="write profiles (on SIGUSR1/SIGUSR2) to DIR")
+  parser.add_option("--profile-seconds", type="float", dest="profile_seconds",
+                    default=PROFILE_SECONDS, metavar="SECONDS",
+                    help="sample stacks for SECONDS when profiling")
+  parser.add_option("--trace-memory", action="store_true", dest="trace_memory",
+                    default=False,
+                    help="trace memory allocations from startup")
+  parser.add_option("--capture", type="string", dest="capture",
+                    metavar="FILE", help="capture all traffic to FILE")
+  parser.add_option("--queue-bytes", type="int", dest="queue_bytes",
+                    default=QUEUE_BYTES, metavar="BYTES",
+                    help="maximum message bytes queued per client, 0 for no limit [default: %default]")
+  parser.add_option("--queue-msgs", type="int", dest="queue_msgs",
+                    default=QUEUE_MSGS, metavar="N",
+                    help="maximum messages queued per client, 0 for no limit [default: %default]")
+  parser.add_option("--queue-policy", type="choice", dest="queue_policy",
+                    choices=Policy.ALL, default=QUEUE_POLICY,
+                    help="what to do when a client's queue is full: " +
+                    ", ".join(Policy.ALL) + " [default: %default]")
+  parser.add_option("--queue-timeout", type="float", dest="queue_timeout",
+                    default=QUEUE_TIMEOUT, metavar="SECONDS",
+                    help="disconnect a client that holds up a sender for SECONDS with the block policy [default: %default]")
+  parser.add_option("-P", "--process", action="store_true", dest="process",
+                    default=False,
+                    help="run a python simulation script in a separate process")
+  parser.add_option("--pool", type="string", dest="pool", metavar="SOCKET",
+                    help="attach to a warm simulator of the pool listening on SOCKET instead of starting one")
+  parser.add_option("--controller", type="string", dest="controllers",
+                    action="append", default=[], metavar="SCRIPT",
+                    help="run SCRIPT's run(connect) in the daemon, connecting virtual clients with connect(name) (repeatable)")
+  parser.add_option("--shards", type="int", dest="shards", default=1,
+                    metavar="K",
+                    help="spread the clients over K simulation instances [default: %default]")
+  parser.add_option("--shard-policy", type="string", dest="shard_policy",
+                    default='hash', metavar="POLICY",
+                    help="how clients are assigned to shards: hash, map:FILE, region:FILE or a python script [default: %default]")
   (options, args) = parser.parse_args()
   # If args is specified, load the script file
   simulation = None
-  if len(args) > 0:
-    if os.path.exists(args[0]):
-      # Get module extension
-      module, extension = os.path.splitext(args[0])
-      if options.sim_options.find(',') != -1:
-        fullargs = options.sim_options.split(',')
-      else:
-        fullargs = []
-      fullargs.insert(0, args[0])
+  lockstep = None
+  if len(args) > 0 or options.pool:
+    if options.pool or os.path.exists(args[0]):
       def recv_callback(_from, to, msg):
         client_manager.recv_sim(_from, to, msg)
       def prop_val_callback(_from, prop, val):
         client_manager.prop_val_sim(_from, prop, val)
+      def recv_many_callback(batch):
+        client_manager.recv_many_sim(batch)
+      if options.pool:
+        # The simulator command line is given to the pool
+        module, extension = None, None
+        fullargs = [options.pool]
+      else:
+        # Get module extension
+        module, extension = os.path.splitext(args[0])
+        if options.sim_options:
+          fullargs = options.sim_options.split(',')
+        else:
+          fullargs = []
+        fullargs.insert(0, args[0])
       if extension == '.py':
+        memory_profiler.rules.append(('simulation',
+          os.path.basename(args[0]), None))
+      if extension == '.py' and options.process:
+        # Run simulation script in a child process
+        from playernsd.processsim import ProcessSimulation as Simulation
+      elif extension == '.py':
         script = imp.load_source(module, args[0])
-        simulation = script.Simulation(fullargs, recv_callback, prop_val_callback)
+        Simulation = script.Simulation
+      elif options.pool:
+        # Attach to a warm simulator executable of a pool
+        from playernsd.simpool import PooledSimulation as Simulation
       else:
         # Run simulation with external binary
         from playernsd.simulation import Simulation
-        simulation = Simulation(fullargs, recv_callback, prop_val_callback)
+      if options.shards > 1:
+        # Run a simulation instance per shard
+        from playernsd.sharding import ShardedSimulation, new_policy
+        try:
+          policy = new_policy(options.shard_policy)
+        except (ValueError, IOError), e:
+          parser.error(str(e))
+        simulation = ShardedSimulation(options.shards, policy,
+          lambda recv, prop_val, recv_many: new_simulation(Simulation,
+            fullargs, recv, prop_val, recv_many),
+          recv_callback, prop_val_callback, recv_many_callback)
+      else:
+        simulation = new_simulation(Simulation, fullargs, recv_callback,
+          prop_val_callback, recv_many_callback)
     else:
       print 'Cannot load script file ' + args[0] + '.'
       sys.exit(1)
@@ -700,6 +1975,30 @@ if __name__ == "__main__":
   PORT = options.port
   LOGFILE = options.logfile
   VERBOSE = options.verbose
+  MAX_SEND = options.max_send
+  UNIX_PATH = options.unix
+  if not options.tcp and not UNIX_PATH:
+    parser.error('--no-tcp needs --unix')
+  COMPRESS_THRESHOLD = options.compress_threshold
+  COMPRESS_LEVEL = options.compress_level
+  for d in options.compress_dicts:
+    if '=' not in d:
+      parser.error('--compress-dict expects NAME=FILE')
+    name, path = d.split('=', 1)
+    COMPRESS_DICTS[name] = open(path, 'rb').read()
+  logqueue.PAYLOAD_LIMIT = LOG_PAYLOAD = options.log_payload
+  logqueue.SAMPLE = LOG_SAMPLE = options.log_sample
+  LOG_QUEUE = options.log_queue
+  LOCKSTEP = options.lockstep
+  STEP_DEADLINE = options.step_deadline
+  STATS_PORT = options.stats_port
+  UDP_PORT = options.udp_port
+  QUEUE_BYTES = options.queue_bytes
+  QUEUE_MSGS = options.queue_msgs
+  QUEUE_POLICY = options.queue_policy
+  QUEUE_TIMEOUT = options.queue_timeout
+  PROFILE_DIR = options.profile_dir
+  PROFILE_SECONDS = options.profile_seconds
   # Setup the logging facility
   ## The logging level
   loglevel = logging.DEBUG
@@ -708,7 +2007,6 @@ if __name__ == "__main__":
   elif VERBOSE == 1:
     loglevel = logging.INFO
   # Playernsd logging
-  log = logging.getLogger('playernsd')
   # Additional debug levels (for formatting)
   # Default level
   log.setLevel(loglevel)
@@ -717,26 +2015,84 @@ if __name__ == "__main__":
   hs = logging.StreamHandler()
   hs.setFormatter(formatter)
   hs.setLevel(loglevel)
-  log.addHandler(hs)
   # Logfile handler
   hf = logging.FileHandler(LOGFILE)
   hf.setFormatter(formatter)
   hf.setLevel(loglevel)
-  log.addHandler(hf)
+  # Records are formatted and written by a background thread
+  log_queue = Queue(LOG_QUEUE)
+  log.addHandler(QueueHandler(log_queue))
+  log_listener = QueueListener(log_queue, hs, hf)
+  log_listener.daemon = True
+  log_listener.start()
   try:
     # Say what we're listening to & that we're verbose
-    log.info('Listening on ' + IP + ':' + str(PORT) + '.')
+    if options.tcp:
+      log.info('Listening on ' + IP + ':' + str(PORT) + '.')
     log.info('Verbosity=' + logging.getLevelName(loglevel) + ' logging' + '.')
+    # Create the unix socket server, with the same protocol
+    if UNIX_PATH:
+      unix_server = UnixServer(UNIX_PATH, TCPRequestHandler)
+      unix_thread = threading.Thread(target=unix_server.serve_forever)
+      unix_thread.daemon = True
+      unix_thread.start()
+      log.info('Listening on unix socket ' + UNIX_PATH + '.')
     # Create the socket server
-    SocketServer.TCPServer.allow_reuse_address = True
-    server = SocketServer.ThreadingTCPServer((IP, PORT), TCPRequestHandler)
-    # Start a thread with the server -- that thread will then start one
-    # more thread for each request
-    server_thread = threading.Thread(target=server.serve_forever)
-    # Exit the server thread when the main thread terminates
-    server_thread.daemon = True
-    server_thread.start()
-    log.info('Server thread started.')
+    if options.tcp:
+      SocketServer.TCPServer.allow_reuse_address = True
+      # Client threads must not keep the daemon alive when it quits
+      SocketServer.ThreadingTCPServer.daemon_threads = True
+      server = SocketServer.ThreadingTCPServer((IP, PORT), TCPRequestHandler)
+      # Start a thread with the server -- that thread will then start one
+      # more thread for each request
+      server_thread = threading.Thread(target=server.serve_forever)
+      # Exit the server thread when the main thread terminates
+      server_thread.daemon = True
+      server_thread.start()
+      log.info('Server thread started.')
+    # Capture the traffic
+    if options.capture:
+      capture = Capture(options.capture)
+      log.info('Capturing traffic to ' + options.capture + '.')
+    # Profile on signals
+    if options.trace_memory:
+      if memory_profiler.available():
+        memory_profiler.start()
+      else:
+        log.warn('Memory tracing needs the tracemalloc module.')
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profile('cpu'))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profile('mem'))
+    # Shut down cleanly when terminated, so captures are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Serve the metrics
+    if STATS_PORT:
+      stats.serve(('127.0.0.1', STATS_PORT))
+      log.info('Serving metrics on 127.0.0.1:' + str(STATS_PORT) + '.')
+    # Compress the messages to a simulator executable
+    if options.compress_sim:
+      shards = getattr(simulation, 'shards', [simulation])
+      if all(hasattr(s, 'writer') for s in shards):
+        for s in shards:
+          s.writer.compressor = Compressor('pipe', COMPRESS_LEVEL,
+            COMPRESS_THRESHOLD)
+      else:
+        log.warn('--compress-sim needs a simulator executable.')
+    # Send group messages to a simulator executable in SENDMANY frames
+    if options.sim_sendmany:
+      shards = getattr(simulation, 'shards', [simulation])
+      if all(hasattr(s, 'writer') for s in shards):
+        for s in shards:
+          s.writer.sendmany = True
+      else:
+        log.warn('--sim-sendmany needs a simulator executable.')
+    # Reuse the nodes of a simulator executable
+    if options.sim_reuse_nodes:
+      shards = getattr(simulation, 'shards', [simulation])
+      if all(hasattr(s, 'writer') for s in shards):
+        for s in shards:
+          s.reuse_nodes = True
+      else:
+        log.warn('--sim-reuse-nodes needs a simulator executable.')
     # Start the simulation
     if simulation:
       simulation.daemon = True
@@ -747,11 +2103,41 @@ if __name__ == "__main__":
     client_manager.daemon = True
     client_manager.start()
     log.info('Client manager thread started.')
+    # Receive datagrams
+    if UDP_PORT:
+      datagrams = DatagramServer((IP, UDP_PORT), client_manager.recv_datagram)
+      datagrams.daemon = True
+      datagrams.start()
+      log.info('Receiving datagrams on UDP port ' + str(datagrams.port) + '.')
+    # Start stepping simulated time
+    if LOCKSTEP > 0:
+      lockstep = Lockstep(LOCKSTEP, STEP_DEADLINE, client_manager, simulation)
+      lockstep.daemon = True
+      lockstep.start()
+      log.info('Lockstep thread started (step=' + str(LOCKSTEP) + 's).')
+    # Run the controllers with virtual clients
+    for path in options.controllers:
+      module = os.path.splitext(os.path.basename(path))[0]
+      controller = imp.load_source(module, path)
+      t = threading.Thread(target=controller.run,
+        args=(client_manager.connect,), name=module)
+      t.daemon = True
+      t.start()
+      log.info('Controller ' + path + ' started.')
     # Main thread loop
     while True:
       time.sleep(0.1)
   except (KeyboardInterrupt, SystemExit):
     log.info('Received keyboard interrupt, quitting threads.\n')
+    if lockstep:
+      lockstep.stop()
     client_manager.stop()
+    if datagrams:
+      datagrams.stop()
+    if unix_server:
+      unix_server.server_close()
+    if capture:
+      capture.close()
+    log_listener.stop()
 
 # vim: ai:ts=2:sw=2:sts=2:
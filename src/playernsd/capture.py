@@ -0,0 +1,144 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file capture.py
+# The capture classes that record the traffic of the daemon to a binary
+# trace file and read it back for replaying.
+#
+# A trace file starts with the playernsd::capture::MAGIC bytes followed by
+# records, each a fixed size little endian header (timestamp as a double,
+# client handle, opcode and payload length) followed by the payload.  The
+# file is only ever appended to, so it can be memory mapped and read while
+# it is being written.
+
+import os
+import mmap
+import time
+import threading
+from struct import *
+
+## Magic bytes at the start of a trace file.
+MAGIC = 'PNSDCAP1'
+## Record header format (timestamp, client handle, opcode, length).
+HEADER = '<dIBI'
+## Record header size.
+HEADER_SIZE = calcsize(HEADER)
+## Size of the buffer for writing records.
+BUFFER_SIZE = 65536
+
+## Opcodes of the records.
+class Opcode:
+  ## A client connected; the payload is its address.
+  CONNECT = 0
+  ## Data received from a client.
+  IN = 1
+  ## Data delivered to a client.
+  OUT = 2
+  ## A client disconnected.
+  DISCONNECT = 3
+
+## Capture that appends records to a trace file.
+class Capture():
+  ## Open a trace file for capturing.
+  # @param self The playernsd::capture::Capture instance.
+  # @param path The path of the trace file.
+  def __init__(self, path):
+    self.__lock = threading.Lock()
+    self.__handles = {}
+    self.__next = 1
+    self.__file = open(path, 'ab', BUFFER_SIZE)
+    if self.__file.tell() == 0:
+      self.__file.write(MAGIC)
+  ## Record a new client connection.
+  # @param self The playernsd::capture::Capture instance.
+  # @param address The client address.
+  def connect(self, address):
+    with self.__lock:
+      self.__handles[address] = self.__next
+      self.__next += 1
+    self.record(address, Opcode.CONNECT, str(address))
+  ## Record a client disconnecting.
+  # @param self The playernsd::capture::Capture instance.
+  # @param address The client address.
+  def disconnect(self, address):
+    self.record(address, Opcode.DISCONNECT, '')
+    with self.__lock:
+      self.__handles.pop(address, None)
+  ## Append a record.
+  # @param self The playernsd::capture::Capture instance.
+  # @param address The client address.
+  # @param opcode The playernsd::capture::Opcode of the record.
+  # @param payload The payload of the record.
+  def record(self, address, opcode, payload):
+    header = pack(HEADER, time.time(), self.__handles.get(address, 0),
+      opcode, len(payload))
+    with self.__lock:
+      self.__file.write(header)
+      self.__file.write(payload)
+  ## Flush and close the trace file.
+  # @param self The playernsd::capture::Capture instance.
+  def close(self):
+    with self.__lock:
+      self.__file.close()
+
+## Reader of the records in a trace file.
+class CaptureReader():
+  ## Open a trace file for reading.
+  # @param self The playernsd::capture::CaptureReader instance.
+  # @param path The path of the trace file.
+  def __init__(self, path):
+    self.__file = open(path, 'rb')
+    size = os.fstat(self.__file.fileno()).st_size
+    if size < len(MAGIC):
+      raise ValueError(path + ' is not a playernsd trace file')
+    self.__map = mmap.mmap(self.__file.fileno(), size,
+      access=mmap.ACCESS_READ)
+    if self.__map[:len(MAGIC)] != MAGIC:
+      raise ValueError(path + ' is not a playernsd trace file')
+  ## Iterate over the records.
+  #
+  # A record cut short at the end of the file (still being written) ends
+  # the iteration.
+  # @param self The playernsd::capture::CaptureReader instance.
+  # @return Iterator of (timestamp, handle, opcode, payload) tuples.
+  def __iter__(self):
+    pos = len(MAGIC)
+    size = len(self.__map)
+    while pos + HEADER_SIZE <= size:
+      timestamp, handle, opcode, length = unpack_from(HEADER, self.__map, pos)
+      pos += HEADER_SIZE
+      if pos + length > size:
+        break
+      yield timestamp, handle, opcode, self.__map[pos:pos+length]
+      pos += length
+  ## Close the trace file.
+  # @param self The playernsd::capture::CaptureReader instance.
+  def close(self):
+    self.__map.close()
+    self.__file.close()
@@ -0,0 +1,146 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file compress.py
+# The compressor and decompressor classes for msgbin payloads, which are
+# compressed with zlib on the connections that ask for it.
+#
+# A shared dictionary is text that is typical of the payloads, such as the
+# field names of a message format.  It is known to both ends in advance and
+# makes short payloads compress much better.  The zlib module of python 2
+# can't set a dictionary, so both ends instead put it in the history of a
+# compressor or decompressor and use a copy of that for every payload.  The
+# last 32KiB of a dictionary are used.
+
+import time
+import zlib
+from playernsd import stats
+
+## Payloads shorter than this are not compressed (512 is default).
+THRESHOLD = 512
+## The zlib compression level (6 is default).
+LEVEL = 6
+
+## The paths compressors have been created for.
+paths = set()
+
+## Get the compression ratio of every path from the statistics.
+# @return List of (labels, bytes sent per byte of payload) pairs.
+def ratios():
+  values = []
+  for path in sorted(paths):
+    raw = stats.registry.counter('playernsd_compress_raw_bytes_total',
+      'Bytes of payloads considered for compression.', path=path).value
+    sent = stats.registry.counter('playernsd_compress_bytes_total',
+      'Bytes of those payloads as sent, compressed or not.', path=path).value
+    if raw:
+      values.append(({'path': path}, float(sent) / raw))
+  return values
+
+## Put a dictionary in the history of a new compressor.
+# @param dictionary The dictionary.
+# @param level The compression level.
+# @return The (compressor, compressed dictionary) pair.
+def prime(dictionary, level=LEVEL):
+  c = zlib.compressobj(level)
+  return c, c.compress(dictionary) + c.flush(zlib.Z_SYNC_FLUSH)
+
+## Compressor of payloads for one path (the clients or the simulation pipe).
+class Compressor():
+  ## Initialise the compressor.
+  # @param self The playernsd::compress::Compressor instance.
+  # @param path The name of the path, for the statistics.
+  # @param level The compression level.
+  # @param threshold The minimum payload length to compress.
+  # @param dictionary The shared dictionary (optional).
+  def __init__(self, path, level=LEVEL, threshold=THRESHOLD,
+      dictionary=None):
+    ## The compression level.
+    self.level = level
+    ## The minimum payload length to compress.
+    self.threshold = threshold
+    self.__primed = None
+    if dictionary:
+      self.__primed = prime(dictionary, level)[0]
+    # The last payload and its compressed form, as broadcasts compress
+    # the same payload for every client
+    self.__last = (None, None)
+    self.__raw = stats.registry.counter('playernsd_compress_raw_bytes_total',
+      'Bytes of payloads considered for compression.', path=path)
+    self.__sent = stats.registry.counter('playernsd_compress_bytes_total',
+      'Bytes of those payloads as sent, compressed or not.', path=path)
+    self.__seconds = stats.registry.histogram('playernsd_compress_seconds',
+      'Time taken to compress a payload.', path=path)
+    paths.add(path)
+    stats.registry.gauge('playernsd_compress_ratio',
+      'Bytes sent per byte of payload considered for compression.', ratios)
+  ## Compress a payload.
+  # @param self The playernsd::compress::Compressor instance.
+  # @param data The payload.
+  # @return The compressed payload, or None if the payload is too short or
+  #         doesn't get any shorter.
+  def compress(self, data):
+    if len(data) < self.threshold:
+      return None
+    last = self.__last
+    if last[0] == data:
+      return last[1]
+    start = time.time()
+    if self.__primed:
+      c = self.__primed.copy()
+      z = c.compress(data) + c.flush()
+    else:
+      z = zlib.compress(data, self.level)
+    self.__seconds.observe(time.time() - start)
+    if len(z) >= len(data):
+      z = None
+    self.__raw.inc(len(data))
+    self.__sent.inc(z and len(z) or len(data))
+    self.__last = (data, z)
+    return z
+
+## Decompressor of payloads compressed by a playernsd::compress::Compressor.
+class Decompressor():
+  ## Initialise the decompressor.
+  # @param self The playernsd::compress::Decompressor instance.
+  # @param dictionary The shared dictionary (optional).
+  def __init__(self, dictionary=None):
+    self.__primed = None
+    if dictionary:
+      self.__primed = zlib.decompressobj()
+      self.__primed.decompress(prime(dictionary)[1])
+  ## Decompress a payload.
+  # @param self The playernsd::compress::Decompressor instance.
+  # @param data The compressed payload.
+  # @return The payload.
+  def decompress(self, data):
+    if self.__primed:
+      d = self.__primed.copy()
+      return d.decompress(data) + d.flush()
+    return zlib.decompress(data)
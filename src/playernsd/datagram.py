@@ -0,0 +1,113 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file datagram.py
+# The UDP listener for messages that are small, frequent and may be lost,
+# such as poses and heartbeats.
+#
+# Each datagram from a client starts with the token it was given in reply
+# to its greetings, followed by a command line: @b subscribe (to have
+# messages sent over UDP delivered to the address the datagram came from),
+# @b unsubscribe, or @b msgbin [dest] length and the payload.  Datagrams
+# that can't be taken apart are dropped without a reply.
+
+import socket
+import logging
+from threading import Thread
+from playernsd import stats
+
+log = logging.getLogger('playernsd')
+
+## Largest datagram received.
+MAX_SIZE = 65535
+## Largest datagram sent; longer deliveries go over TCP instead.
+MAX_SEND = 65507
+## Size of the socket receive buffer, so bursts aren't dropped.
+RCVBUF = 1048576
+
+## Thread receiving the datagrams of clients.
+class DatagramServer(Thread):
+  ## Bind the UDP socket.
+  # @param self The playernsd::datagram::DatagramServer instance.
+  # @param address The (host, port) to listen on.
+  # @param callback The callback called with (token, address, command,
+  #        payload) for each datagram, where command is the list of words
+  #        after the token.
+  def __init__(self, address, callback):
+    Thread.__init__(self)
+    self.callback = callback
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+    self.socket.bind(address)
+    ## The port listened on.
+    self.port = self.socket.getsockname()[1]
+    self.__running = True
+    self.__in = stats.registry.counter('playernsd_datagrams_in_total',
+      'Datagrams received from clients.')
+    self.__out = stats.registry.counter('playernsd_datagrams_out_total',
+      'Datagrams sent to clients.')
+    ## Counter of the datagrams dropped.
+    self.dropped = stats.registry.counter(
+      'playernsd_datagrams_dropped_total',
+      'Datagrams from clients that were dropped.')
+  ## Send a datagram.
+  # @param self The playernsd::datagram::DatagramServer instance.
+  # @param data The datagram.
+  # @param address The (host, port) to send it to.
+  def sendto(self, data, address):
+    self.socket.sendto(data, address)
+    self.__out.inc()
+  ## Receive datagrams until stopped.
+  # @param self The playernsd::datagram::DatagramServer instance.
+  def run(self):
+    while self.__running:
+      try:
+        data, address = self.socket.recvfrom(MAX_SIZE)
+      except socket.error, e:
+        if self.__running:
+          log.warn('Receiving a datagram failed: ' + str(e))
+        continue
+      self.__in.inc()
+      nlpos = data.find('\n')
+      command = data[:max(nlpos, 0)].split(' ')
+      if nlpos == -1 or len(command) < 2:
+        self.dropped.inc()
+        continue
+      try:
+        self.callback(command[0], address, command[1:], data[nlpos+1:])
+      except Exception, e:
+        # such as a recipient that has just gone; keep on receiving
+        self.dropped.inc()
+        log.warn('Handling a datagram from ' + str(address) + ' failed: ' +
+          str(e), exc_info=True)
+  ## Stop receiving.
+  # @param self The playernsd::datagram::DatagramServer instance.
+  def stop(self):
+    self.__running = False
+    self.socket.close()
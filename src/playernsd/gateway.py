@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file gateway.py
+# The parts of a gateway connection carrying many clients over one socket.
+#
+# Once a connection has sent @b gateway, everything on it is wrapped in
+# frames of @b sub HANDLE LENGTH, with the handle picked by the gateway
+# host for each of its clients.  A frame from the host holds whole
+# commands of that client; a frame to the host holds whole frames the
+# client would be sent over its own connection.  A frame with no data
+# closes the client, in either direction.
+
+from playernsd.outbox import classify
+from playernsd.stream import Stream
+
+## Stand-in for the socket of a client of a gateway connection.
+#
+# The commands in a frame are read from it, and then it reads as closed.
+class FrameSocket():
+  ## Initialise the socket.
+  # @param self The playernsd::gateway::FrameSocket instance.
+  def __init__(self):
+    self.__data = ''
+    self.__pos = 0
+    ## Whether everything fed in has been read.
+    self.drained = True
+  ## Feed in the commands of a frame.
+  # @param self The playernsd::gateway::FrameSocket instance.
+  # @param data The commands.
+  def feed(self, data):
+    self.__data = data
+    self.__pos = 0
+    self.drained = False
+  ## Read from the frame.
+  # @param self The playernsd::gateway::FrameSocket instance.
+  # @param size The maximum number of bytes to read.
+  # @return The data, or '' once the frame has been read.
+  def recv(self, size):
+    data = self.__data[self.__pos:self.__pos + size]
+    self.__pos += len(data)
+    if not data:
+      self.drained = True
+    return data
+
+## The stand-in for playernsd::outbox::Outbox of a client of a gateway
+# connection.
+#
+# Frames are wrapped and put in the outbox of the gateway connection, so
+# the deliveries to all of its clients are written together.
+class SubOutbox():
+  ## Initialise the outbox.
+  # @param self The playernsd::gateway::SubOutbox instance.
+  # @param outbox The playernsd::outbox::Outbox of the gateway connection.
+  # @param handle The handle of the client on the gateway connection.
+  # @param pong_callback The callback answering a ping.
+  # @param sent_callback The callback called with (data, count, seconds)
+  #        after data has been queued.
+  def __init__(self, outbox, handle, pong_callback, sent_callback):
+    self.outbox = outbox
+    self.handle = handle
+    self.pong_callback = pong_callback
+    self.sent_callback = sent_callback
+    ## Whether the client is still open.
+    self.running = True
+  ## Queue data for the client.
+  # @param self The playernsd::gateway::SubOutbox instance.
+  # @param data The frame (or frames), a playernsd::stream::Stream, or
+  #        None to shut down.
+  # @param count The number of messages in the data.
+  # @param lane The lane to queue the data in (by default from the data).
+  # @param key The key of a bulk frame that replaces a queued frame with the
+  #        same key (None for no conflation).
+  # @return False if the data was dropped.
+  def put(self, data, count=1, lane=None, key=None):
+    if not self.running:
+      return False
+    if data == None:
+      self.close()
+      return True
+    if data == 'ping\n':
+      # the gateway connection itself is pinged
+      self.pong_callback()
+      return True
+    if isinstance(data, Stream):
+      header = data.header
+      data.header = self.wrap(len(header) + data.length) + header
+      if not self.outbox.put(data, count):
+        data.header = header
+        return False
+    elif not self.outbox.put(self.wrap(len(data)) + data, count,
+        lane == None and classify(data) or lane,
+        key != None and (self.handle, key) or None):
+      return False
+    self.sent_callback(data, count, 0.0)
+    return True
+  ## Get the header of a frame to the gateway host.
+  # @param self The playernsd::gateway::SubOutbox instance.
+  # @param length The length of the wrapped data.
+  def wrap(self, length):
+    return 'sub ' + str(self.handle) + ' ' + str(length) + '\n'
+  ## Shut down, as there is nothing of the client's own to flush.
+  # @param self The playernsd::gateway::SubOutbox instance.
+  def shutdown(self):
+    self.close()
+  ## Close the client, telling the gateway host.
+  # @param self The playernsd::gateway::SubOutbox instance.
+  def close(self):
+    if self.running:
+      self.running = False
+      self.outbox.put(self.wrap(0))
@@ -0,0 +1,69 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file handles.py
+# The allocator of the integer handles identifying clients.
+
+from collections import deque
+from threading import Lock
+
+## Allocator of small integer handles, reusing the released ones.
+#
+# Released handles are reused oldest first, so that a handle stays unused
+# for as long as possible before it is given to another client, and
+# anything still in flight for the client that had it is long gone.
+class Handles():
+  ## Initialise the allocator.
+  # @param self The playernsd::handles::Handles instance.
+  # @param first The first handle to give out.
+  def __init__(self, first=1):
+    self.__lock = Lock()
+    self.__next = first
+    self.__free = deque()
+  ## Get a handle that isn't in use.
+  # @param self The playernsd::handles::Handles instance.
+  # @return The handle.
+  def alloc(self):
+    with self.__lock:
+      if self.__free:
+        return self.__free.popleft()
+      handle = self.__next
+      self.__next += 1
+      return handle
+  ## Give a handle back to be reused.
+  # @param self The playernsd::handles::Handles instance.
+  # @param handle The handle.
+  def release(self, handle):
+    with self.__lock:
+      self.__free.append(handle)
+  ## Get the number of handles given out so far, in use or not.
+  # @param self The playernsd::handles::Handles instance.
+  # @return One more than the highest handle given out.
+  def __len__(self):
+    return self.__next
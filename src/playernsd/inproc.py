@@ -0,0 +1,435 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file inproc.py
+# Virtual clients for controllers running in the daemon's process.
+#
+# A virtual client is registered with the client manager like a socket
+# client and its messages are routed the same way, through the simulation
+# if there is one, but nothing is sent over a socket: the messages for it
+# are handed over as tuples through a queue, bounded like the outbox of a
+# socket client.
+
+import itertools
+import socket
+import threading
+import time
+from collections import deque
+from playernsd import stats
+from playernsd.outbox import Lane, Policy, BLOCK_TIMEOUT, classify
+from playernsd.stream import Stream
+
+## Get the frame a message tuple would be written to a socket as.
+# @param message The ('msgbin', src, payload) or ('msgtext', src, text)
+#        tuple.
+# @return The frame.
+def message_frame(message):
+  kind, src, msg = message
+  if kind == 'msgtext':
+    return 'msgtext ' + src + '\n' + msg + '\n'
+  return 'msgbin ' + src + ' ' + str(len(msg)) + '\n' + msg
+
+## Get the number of bytes of queued data, counted against queue limits.
+# @param data A message tuple, frames or a playernsd::stream::Stream.
+def size(data):
+  if isinstance(data, tuple):
+    return len(data[2])
+  return len(data)
+
+## An error reported to a virtual client, named as in the protocol
+# (such as unknownclient).
+class ClientError(Exception):
+  pass
+
+## The stand-in for playernsd::outbox::Outbox of a virtual client.
+#
+# Messages are queued as the tuples they are received as.  Control frames,
+# the replies of the daemon, are parsed straight away, ahead of the queued
+# messages, and pings are answered straight away.  Like
+# an outbox, the queue holds at most max_bytes and max_msgs of messages,
+# beyond which the policy decides, and a queued message with a key is
+# replaced by a newer one with the same key.  A playernsd::stream::Stream
+# is read by the receiver when its turn comes, so the messages are received
+# in the order they were delivered.
+class Inbox():
+  ## Initialise the inbox.
+  # @param self The playernsd::inproc::Inbox instance.
+  # @param pong_callback The callback answering a ping.
+  # @param sent_callback The callback called with (data, count, seconds)
+  #        after data has been received.
+  # @param error_callback The callback called with socket.timeout when a
+  #        sender held up by Policy.BLOCK gives up on the client.
+  # @param max_bytes The maximum number of message bytes queued (0 is no
+  #        limit).
+  # @param max_msgs The maximum number of messages queued (0 is no limit).
+  # @param policy The playernsd::outbox::Policy when the limit is reached.
+  # @param timeout The seconds a sender is held up by Policy.BLOCK.
+  def __init__(self, pong_callback, sent_callback, error_callback,
+      max_bytes=0, max_msgs=0, policy=Policy.DROP_OLDEST,
+      timeout=BLOCK_TIMEOUT):
+    self.pong_callback = pong_callback
+    self.sent_callback = sent_callback
+    self.error_callback = error_callback
+    self.max_bytes = max_bytes
+    self.max_msgs = max_msgs
+    self.policy = policy
+    self.timeout = timeout
+    ## The queued [data, count, key] items of the messages.
+    self.bulk = deque()
+    # The queued items that have a key, by key
+    self.__keyed = {}
+    ## The number of message bytes queued.
+    self.queued_bytes = 0
+    ## The number of messages queued.
+    self.queued_msgs = 0
+    # The message tuples parsed and not yet received
+    self.__parsed = deque()
+    self.__dropped = stats.registry.counter('playernsd_queue_dropped_total',
+      'Messages dropped because the queue of a client was full.',
+      policy=policy)
+    self.__conflated = stats.registry.counter(
+      'playernsd_queue_conflated_total',
+      'Queued state messages replaced by a newer one.')
+    self.__blocked = stats.registry.counter('playernsd_queue_blocked_total',
+      'Senders held up because the queue of a client was full.')
+    self.__blocked_time = stats.registry.histogram(
+      'playernsd_queue_blocked_seconds',
+      'Time senders were held up because the queue of a client was full.')
+    self.__lock = threading.Lock()
+    self.__cond = threading.Condition(self.__lock)
+    self.__space = threading.Condition(self.__lock)
+    # Taken by a receiver until it has parsed what it took off the queue,
+    # so that the messages are received in order
+    self.__recv_lock = threading.Lock()
+    self.__running = True
+    # Set once a sender has been held up for longer than the timeout
+    self.__stalled = False
+  ## Deliver data written to the client.
+  # @param self The playernsd::inproc::Inbox instance.
+  # @param data The message tuple, the frame (or frames) or a
+  #        playernsd::stream::Stream.
+  # @param count The number of messages in the data.
+  # @param lane The lane of the data (by default from the data).
+  # @param key The key of a message that replaces a queued message with the
+  #        same key (None for no conflation).
+  # @return False if the data was dropped.
+  def put(self, data, count=1, lane=None, key=None):
+    if isinstance(data, tuple) or isinstance(data, Stream):
+      lane = Lane.BULK
+    elif lane == None:
+      lane = classify(data)
+    pings = 0
+    with self.__lock:
+      if not self.__running:
+        return False
+      if lane == Lane.CONTROL:
+        pings = self.parse(data)
+        self.__cond.notify_all()
+        stalled = None
+      elif key != None and key in self.__keyed:
+        item = self.__keyed[key]
+        self.queued_bytes += size(data) - size(item[0])
+        self.queued_msgs += count - item[1]
+        item[0] = data
+        item[1] = count
+        self.__conflated.inc()
+        return True
+      elif not self.fits(data, count) and not self.make_room(data, count):
+        stalled = self.__stalled
+      else:
+        item = [data, count, key]
+        self.bulk.append(item)
+        self.queued_bytes += size(data)
+        self.queued_msgs += count
+        if key != None:
+          self.__keyed[key] = item
+        self.__cond.notify()
+        return True
+    if stalled == None:
+      self.sent_callback(data, count, 0.0)
+      for i in xrange(pings):
+        self.pong_callback()
+      return True
+    if stalled:
+      self.close()
+      self.error_callback(socket.timeout('queue full for ' +
+        str(self.timeout) + 's'))
+    return False
+  ## Check whether a message fits in the queue (with the lock held).
+  # @param self The playernsd::inproc::Inbox instance.
+  # @param data The data.
+  # @param count The number of messages in the data.
+  def fits(self, data, count):
+    return not self.bulk or \
+      ((not self.max_bytes or self.queued_bytes + size(data) <= self.max_bytes)
+      and (not self.max_msgs or self.queued_msgs + count <= self.max_msgs))
+  ## Apply the policy to a message that doesn't fit (with the lock held).
+  # @param self The playernsd::inproc::Inbox instance.
+  # @param data The data.
+  # @param count The number of messages in the data.
+  # @return True if the data can now be queued.
+  def make_room(self, data, count):
+    if self.policy == Policy.BLOCK and not self.__stalled:
+      start = time.time()
+      self.__blocked.inc()
+      while self.__running and not self.fits(data, count):
+        remaining = start + self.timeout - time.time()
+        if remaining <= 0:
+          self.__stalled = True
+          break
+        self.__space.wait(remaining)
+      self.__blocked_time.observe(time.time() - start)
+      return self.__running and not self.__stalled
+    elif self.policy == Policy.DROP_OLDEST:
+      while not self.fits(data, count):
+        old, n, key = self.bulk.popleft()
+        if isinstance(old, Stream):
+          old.close()
+        self.queued_bytes -= size(old)
+        self.queued_msgs -= n
+        self.__keyed.pop(key, None)
+        self.__dropped.inc(n)
+      return True
+    self.__dropped.inc(count)
+    return False
+  ## Receive a message.
+  # @param self The playernsd::inproc::Inbox instance.
+  # @param timeout Seconds to wait for one, or None to wait until there is.
+  # @return The message tuple, or None if the time ran out or the inbox
+  #         was closed and everything in it has been received.
+  def get(self, timeout=None):
+    end = timeout != None and time.time() + timeout
+    with self.__recv_lock:
+      with self.__lock:
+        while not self.__parsed and not self.bulk:
+          if not self.__running:
+            return None
+          if end:
+            remaining = end - time.time()
+            if remaining <= 0:
+              return None
+            self.__cond.wait(remaining)
+          else:
+            self.__cond.wait()
+        if self.__parsed:
+          return self.__parsed.popleft()
+        data, count, key = self.bulk.popleft()
+        self.queued_bytes -= size(data)
+        self.queued_msgs -= count
+        self.__keyed.pop(key, None)
+        self.__space.notify()
+      if isinstance(data, Stream):
+        # read the payload as it arrives
+        chunks = iter(data)
+        data = ('msgbin', next(chunks).split(' ')[1], ''.join(chunks))
+      self.sent_callback(data, count, 0.0)
+      if isinstance(data, tuple):
+        return data
+      with self.__lock:
+        pings = self.parse(data)
+        msg = self.__parsed and self.__parsed.popleft() or None
+    for i in xrange(pings):
+      self.pong_callback()
+    return msg
+  ## Put the messages in frames in the parsed queue (with the lock held).
+  # @param self The playernsd::inproc::Inbox instance.
+  # @param data The frames.
+  # @return The number of pings in the frames.
+  def parse(self, data):
+    pings = 0
+    pos = 0
+    while pos < len(data):
+      nlpos = data.find('\n', pos)
+      line = data[pos:nlpos]
+      pos = nlpos + 1
+      if line.startswith('msgbin '):
+        kind, src, length = line.split(' ')
+        end = pos + int(length)
+        self.__parsed.append((kind, src, data[pos:end]))
+        pos = end
+      elif line.startswith('msgtext '):
+        end = data.find('\n', pos)
+        self.__parsed.append(('msgtext', line[8:], data[pos:end]))
+        pos = end + 1
+      elif line == 'ping':
+        pings += 1
+      else:
+        # propval, tick, error and the replies to other commands
+        self.__parsed.append(tuple(line.split(' ',
+          line.startswith('propval ') and 2 or -1)))
+    return pings
+  ## Stop delivering, leaving what has been delivered to be received.
+  # @param self The playernsd::inproc::Inbox instance.
+  def shutdown(self):
+    self.close()
+  ## Stop delivering, waking up anyone waiting to receive or to deliver.
+  # @param self The playernsd::inproc::Inbox instance.
+  def close(self):
+    with self.__lock:
+      self.__running = False
+      self.__cond.notify_all()
+      self.__space.notify_all()
+
+## A client of the daemon living in the daemon's process.
+#
+# Messages are received as tuples: ('msgbin', src, payload),
+# ('msgtext', src, text), ('propval', prop, value), and the words of other
+# replies, such as ('tick', step, time) or ('error', 'busy').
+class VirtualClient():
+  __addresses = itertools.count(1)
+  ## Register the client.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param manager The playernsd::ClientManager instance.
+  # @param name The client id.
+  # @param version The protocol version.
+  # @param max_bytes The maximum number of message bytes queued (0 is no
+  #        limit).
+  # @param max_msgs The maximum number of messages queued (0 is no limit).
+  # @param policy The playernsd::outbox::Policy when the limit is reached.
+  # @param timeout The seconds a sender is held up by Policy.BLOCK.
+  def __init__(self, manager, name, version, max_bytes=0, max_msgs=0,
+      policy=Policy.DROP_OLDEST, timeout=BLOCK_TIMEOUT):
+    if not name or name.startswith('@') or ' ' in name:
+      raise ClientError('invalidparam')
+    if manager.is_registered(name):
+      raise ClientError('clientidinuse')
+    self.manager = manager
+    self.name = name
+    ## The address the client is known by, in place of an IP and port.
+    self.address = ('inproc', next(VirtualClient.__addresses))
+    ## The playernsd::inproc::Inbox the messages are received from.
+    self.inbox = Inbox(lambda: manager.pong(self.address),
+      lambda data, count, seconds:
+        manager.sent(self.address, data, count, seconds),
+      lambda e: manager.lost(self.address, e), max_bytes, max_msgs, policy,
+      timeout)
+    manager.add_client(self.address, None, self.inbox)
+    manager.register_client(self.address, name, version)
+    ## The playernsd::remoteclient::RemoteClient record of the client.
+    self.client = manager.get_client(self.address)
+  ## Route a message from the client.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param kind 'msgbin' or 'msgtext'.
+  # @param to The client id, '@' and a group name, or None to broadcast.
+  # @param msg The message.
+  # @param tag The tag of a state message.
+  def route(self, kind, to, msg, tag=None):
+    self.client.msgs_in += 1
+    if to == None:
+      pass
+    elif to.startswith('@'):
+      if not self.manager.has_group(to[1:]):
+        raise ClientError('unknowngroup')
+    elif not self.manager.has_client(to):
+      raise ClientError('unknownclient')
+    self.manager.route(kind, self.name, to, msg, tag)
+  ## Send a binary message.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param to The client id, '@' and a group name, or None to broadcast.
+  # @param msg The message.
+  def send(self, to, msg):
+    self.route('msgbin', to, msg)
+  ## Send several messages at once.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param batch List of (kind, to, msg) tuples, where kind is 'msgbin' or
+  #        'msgtext' and to is a client id, '@' and a group name, or None
+  #        to broadcast.
+  def send_batch(self, batch):
+    for kind, to, msg in batch:
+      if kind not in ('msgbin', 'msgtext') or \
+          (kind == 'msgtext' and '\n' in msg):
+        raise ClientError('invalidparam')
+      if to == None:
+        pass
+      elif to.startswith('@'):
+        if not self.manager.has_group(to[1:]):
+          raise ClientError('unknowngroup')
+      elif not self.manager.has_client(to):
+        raise ClientError('unknownclient')
+    self.client.msgs_in += 1
+    self.manager.send_batch(self.name, batch)
+  ## Send a state message, which replaces an older one with the same tag
+  # still queued for a recipient.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param tag The tag.
+  # @param to The client id, '@' and a group name, or None to broadcast.
+  # @param msg The message.
+  def send_state(self, tag, to, msg):
+    self.route('msgbin', to, msg, tag)
+  ## Send a line of text.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param to The client id, '@' and a group name, or None to broadcast.
+  # @param text The text, without newlines.
+  def send_text(self, to, text):
+    if '\n' in text:
+      raise ClientError('invalidparam')
+    self.route('msgtext', to, text)
+  ## Ask for a property value, which is received as a propval message.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param prop The property name.
+  def propget(self, prop):
+    self.manager.prop_get(prop, self.address)
+  ## Set a property value.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param prop The property name.
+  # @param val The property value.
+  def propset(self, prop, val):
+    self.manager.prop_set(prop, val, self.address)
+  ## Join a group.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param group The name of the group.
+  def join(self, group):
+    self.manager.join(self.address, group)
+  ## Leave a group.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param group The name of the group.
+  def leave(self, group):
+    self.manager.leave(self.address, group)
+  ## Acknowledge a lockstep step.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param step The step number of the tick.
+  def tock(self, step):
+    self.manager.tock(self.address, int(step))
+  ## Get the ids of the registered clients.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @return List of client ids.
+  def listclients(self):
+    return [n for n in self.manager.get_clientid_list() if n != None]
+  ## Receive a message.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  # @param timeout Seconds to wait for one, or None to wait until there is.
+  # @return The message tuple, or None if the time ran out or the client
+  #         was closed.
+  def recv(self, timeout=None):
+    return self.inbox.get(timeout)
+  ## Disconnect the client.
+  # @param self The playernsd::inproc::VirtualClient instance.
+  def close(self):
+    if self.manager.has_client(self.address):
+      self.manager.remove_client(self.address)
@@ -0,0 +1,117 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file lockstep.py
+# The lockstep class that runs the simulation faster than real time, by
+# advancing simulated time only when all clients have finished a step.
+
+import logging
+import threading
+import time
+from threading import Thread
+
+log = logging.getLogger('playernsd')
+
+## Lockstep thread for advancing simulated time.
+#
+# Each step a tick with the step number and the simulated time is sent to
+# all registered clients.  Once every client has acknowledged the step
+# with a tock (or the step deadline passes), the simulation is advanced
+# by the step size and the next tick is sent.
+class Lockstep(Thread):
+  ## Initialise this class.
+  # @param self The playernsd::lockstep::Lockstep instance.
+  # @param step The simulated time per step in seconds.
+  # @param deadline The wall clock time in seconds to wait for clients to
+  #        acknowledge a step.
+  # @param client_manager The playernsd::ClientManager instance.
+  # @param simulation The simulation instance (or None).
+  def __init__(self, step, deadline, client_manager, simulation):
+    Thread.__init__(self)
+    ## The simulated time per step.
+    self.step = step
+    ## The wall clock deadline for each step.
+    self.deadline = deadline
+    ## The current step number.
+    self.stepn = 0
+    ## The current simulated time.
+    self.time = 0.0
+    self.__client_manager = client_manager
+    self.__sim = simulation
+    self.__cond = threading.Condition()
+    self.__pending = set()
+    self.__running = True
+  ## Acknowledge a step for a client.
+  # @param self The playernsd::lockstep::Lockstep instance.
+  # @param clientid Client ID of the client acknowledging the step.
+  # @param stepn The step number acknowledged.
+  def ack(self, clientid, stepn):
+    with self.__cond:
+      if stepn == self.stepn:
+        self.__pending.discard(clientid)
+        if not self.__pending:
+          self.__cond.notify()
+  ## Remove a client, so the current step does not wait for it.
+  # @param self The playernsd::lockstep::Lockstep instance.
+  # @param clientid Client ID of the client removed.
+  def remove_client(self, clientid):
+    self.ack(clientid, self.stepn)
+  ## Worker routine for stepping the simulation.
+  # @param self The playernsd::lockstep::Lockstep instance.
+  def run(self):
+    while self.__running:
+      with self.__cond:
+        clients = [c for c in self.__client_manager.get_clientid_list()
+          if c != None]
+        # Simulated time only passes once there are clients to step.
+        if not clients:
+          self.__cond.wait(self.deadline)
+          continue
+        self.stepn += 1
+        self.__pending = set(clients)
+      self.__client_manager.send_registered(
+        'tick ' + str(self.stepn) + ' ' + repr(self.time) + '\n')
+      end = time.time() + self.deadline
+      with self.__cond:
+        while self.__pending and self.__running:
+          remaining = end - time.time()
+          if remaining <= 0:
+            log.warn('Step ' + str(self.stepn) + ' deadline passed, ' +
+              'no tock from ' + ', '.join(sorted(self.__pending)))
+            break
+          self.__cond.wait(remaining)
+      self.time += self.step
+      if self.__sim and hasattr(self.__sim, 'advance'):
+        self.__sim.advance(self.time)
+  ## Stop the lockstep thread.
+  # @param self The playernsd::lockstep::Lockstep instance.
+  def stop(self):
+    with self.__cond:
+      self.__running = False
+      self.__cond.notify()
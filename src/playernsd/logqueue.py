@@ -0,0 +1,119 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file logqueue.py
+# The logging classes that move formatting and writing of log records off
+# the threads handling clients, as well as payload truncation and sampling.
+
+import logging
+import itertools
+from Queue import Queue, Full
+from threading import Thread
+from playernsd import stats
+
+## Maximum number of payload bytes shown in a log message (0 is no limit)
+PAYLOAD_LIMIT = 256
+## Only every n-th payload is logged (1 logs all of them)
+SAMPLE = 1
+## Maximum number of records queued, beyond which new records are dropped
+# (0 is no limit)
+QUEUE_SIZE = 10000
+## Counter of payloads seen, used for sampling
+sample_counter = itertools.count()
+
+## Check whether this payload should be logged when sampling.
+def sample():
+  return SAMPLE <= 1 or next(sample_counter) % SAMPLE == 0
+
+## Payload that is escaped and truncated only when it is formatted.
+#
+# Passing this as an argument to a log call defers the work until the
+# record is written by the playernsd::logqueue::QueueListener.
+class Payload(object):
+  __slots__ = ('data',)
+  ## Initialise the payload.
+  # @param data The payload data.
+  def __init__(self, data):
+    self.data = data
+  ## Format the payload, escaping unprintable characters.
+  def __str__(self):
+    if PAYLOAD_LIMIT and len(self.data) > PAYLOAD_LIMIT:
+      return self.data[:PAYLOAD_LIMIT].encode('string_escape') + \
+        '...(' + str(len(self.data)) + ' bytes)'
+    return self.data.encode('string_escape')
+
+## Logging handler that puts records on a queue.
+#
+# When the queue is full, as in a flood of log messages that the listener
+# can't keep up with, records are dropped and counted rather than held in
+# memory.
+class QueueHandler(logging.Handler):
+  ## Initialise the handler.
+  # @param self The playernsd::logqueue::QueueHandler instance.
+  # @param queue The queue to put records on.
+  def __init__(self, queue):
+    logging.Handler.__init__(self)
+    self.queue = queue
+    self.__dropped = stats.registry.counter('playernsd_log_dropped_total',
+      'Log records dropped because the log queue was full.')
+  ## Put a record on the queue.
+  # @param self The playernsd::logqueue::QueueHandler instance.
+  # @param record The log record.
+  def emit(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except Full:
+      self.__dropped.inc()
+
+## Listener thread that passes queued records to the real handlers.
+class QueueListener(Thread):
+  ## Initialise the listener.
+  # @param self The playernsd::logqueue::QueueListener instance.
+  # @param queue The queue to take records from.
+  # @param handlers The handlers that format and write the records.
+  def __init__(self, queue, *handlers):
+    Thread.__init__(self)
+    self.queue = queue
+    self.handlers = handlers
+  ## Worker routine that handles the queued records.
+  # @param self The playernsd::logqueue::QueueListener instance.
+  def run(self):
+    while True:
+      record = self.queue.get()
+      # None means quit thread.
+      if record == None:
+        break
+      for h in self.handlers:
+        if record.levelno >= h.level:
+          h.handle(record)
+  ## Stop the listener after the queued records are written.
+  # @param self The playernsd::logqueue::QueueListener instance.
+  def stop(self):
+    self.queue.put(None)
+    self.join()
@@ -0,0 +1,170 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file occupancy.py
+# Occupancy maps decoded once from an environment image into a file of one
+# bit per pixel, which later runs memory-map instead of decoding the image.
+#
+# The file is kept next to the image (or in the temporary directory if
+# that can't be written to), named after a hash of the image, so an edited
+# image gets a new file.  Cells are stored in square tiles, so that the
+# cells near a line are in a few pages; only the pages that are looked at
+# are read, which lets maps larger than memory be used.
+
+import os
+import mmap
+import hashlib
+import logging
+import binascii
+import tempfile
+from struct import pack, unpack_from
+
+log = logging.getLogger('playernsd')
+
+## Version of the file layout, part of the file name.
+VERSION = 1
+## Log2 of the width and height of a tile in cells.
+TILE_BITS = 8
+## Width and height of a tile in cells.
+TILE = 1 << TILE_BITS
+## Log2 of the size of a tile in bytes.
+TILE_BYTES_BITS = 2 * TILE_BITS - 3
+## Magic at the start of the file.
+MAGIC = 'PNSDOCC%d' % VERSION
+## Size of the file header; the tiles follow.
+HEADER_SIZE = 32
+## Translation of 8-bit pixels into cells, '1' for a wall.
+WALL_TABLE = '1' + '0' * 255
+
+## Check whether a pixel of the image is a wall.
+#
+# Black pixels are walls, whether or not they are opaque.
+# @param pixel The pixel value as given by PIL.
+# @return Whether the pixel is a wall.
+def is_wall(pixel):
+  return pixel == 0 or pixel in ((0, 0), (0, 0, 0), (0, 0, 0, 0),
+    (0, 0, 0, 255))
+
+## Get the hash of an image file.
+# @param path The path of the image.
+# @return The hash as a hex string.
+def image_hash(path):
+  h = hashlib.sha1()
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(1048576)
+      if not data:
+        break
+      h.update(data)
+  return h.hexdigest()[:16]
+
+## Get the path of the occupancy file of an image.
+# @param path The path of the image.
+# @return The path of the occupancy file.
+def cache_path(path):
+  directory = os.path.dirname(os.path.abspath(path))
+  if not os.access(directory, os.W_OK):
+    directory = tempfile.gettempdir()
+  return os.path.join(directory, '%s.%s.occ%d' %
+    (os.path.basename(path), image_hash(path), VERSION))
+
+## Get the cells of a strip of the image.
+# @param strip The strip as a PIL image.
+# @return A string of '1' for walls and '0' otherwise, row after row.
+def strip_cells(strip):
+  if strip.mode in ('L', 'P'):
+    tobytes = getattr(strip, 'tobytes', None) or strip.tostring
+    return tobytes().translate(WALL_TABLE)
+  return ''.join(is_wall(p) and '1' or '0' for p in strip.getdata())
+
+## Decode an image into an occupancy file.
+# @param path The path of the image.
+# @param out The path of the occupancy file.
+def build(path, out):
+  import Image
+  image = Image.open(path)
+  width, height = image.size
+  tiles_x = (width + TILE - 1) >> TILE_BITS
+  tiles_y = (height + TILE - 1) >> TILE_BITS
+  # Written under another name first, so a run never sees half a file
+  tmp = '%s.%d.tmp' % (out, os.getpid())
+  with open(tmp, 'wb') as f:
+    f.write(pack('<8sIII', MAGIC, width, height, TILE).ljust(HEADER_SIZE,
+      '\0'))
+    for ty in range(tiles_y):
+      y0 = ty << TILE_BITS
+      rows = min(TILE, height - y0)
+      cells = strip_cells(image.crop((0, y0, width, y0 + rows)))
+      for tx in range(tiles_x):
+        x0 = tx << TILE_BITS
+        x1 = min(width, x0 + TILE)
+        tile = []
+        for r in range(TILE):
+          # cells outside the image are free
+          row = r < rows and cells[r*width+x0:r*width+x1] or ''
+          bits = int(row.ljust(TILE, '0')[::-1], 2)
+          tile.append(binascii.unhexlify('%0*x' % (TILE / 4, bits))[::-1])
+        f.write(''.join(tile))
+  os.rename(tmp, out)
+
+## An occupancy map of an environment image.
+class OccupancyMap():
+  ## Map the occupancy file of an image, decoding the image if needed.
+  # @param self The playernsd::occupancy::OccupancyMap instance.
+  # @param path The path of the image.
+  def __init__(self, path):
+    ## The path of the occupancy file.
+    self.path = cache_path(path)
+    if not os.path.exists(self.path):
+      log.info('Decoding ' + path + ' into ' + self.path + '.')
+      build(path, self.path)
+    self.file = open(self.path, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, width, height, tile = unpack_from('<8sIII', self.map)
+    if magic != MAGIC or tile != TILE:
+      raise Exception('bad occupancy file ' + self.path)
+    ## The width and height of the map in cells (image pixels).
+    self.size = (width, height)
+    self.tiles_x = (width + TILE - 1) >> TILE_BITS
+  ## Check whether a cell is a wall.
+  # @param self The playernsd::occupancy::OccupancyMap instance.
+  # @param x The column of the cell.
+  # @param y The row of the cell.
+  # @return 1 if the cell is a wall, otherwise 0.
+  def wall(self, x, y):
+    mask = TILE - 1
+    offset = ((y & mask) << TILE_BITS) | (x & mask)
+    i = HEADER_SIZE + ((((y >> TILE_BITS) * self.tiles_x + (x >> TILE_BITS))
+      << TILE_BYTES_BITS) | (offset >> 3))
+    return ord(self.map[i]) >> (offset & 7) & 1
+  ## Unmap the occupancy file.
+  # @param self The playernsd::occupancy::OccupancyMap instance.
+  def close(self):
+    self.map.close()
+    self.file.close()
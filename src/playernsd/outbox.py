@@ -0,0 +1,411 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file outbox.py
+# The outbox class that queues the data sent to a client and writes it
+# from a thread of its own while there is a backlog, with control frames
+# ahead of bulk frames, a bound on the bulk data queued, and conflation of
+# state messages.
+
+import errno
+import socket
+import logging
+import threading
+import time
+from collections import deque
+from threading import Thread
+from playernsd import stats
+from playernsd.stream import Stream
+
+log = logging.getLogger('playernsd')
+
+## Maximum number of bytes of bulk frames written at once.
+BATCH_BYTES = 65536
+## Seconds a sender is held up by Policy.BLOCK before the client is given
+# up on.
+BLOCK_TIMEOUT = 1.0
+
+## Priority lanes of an outbox, in the order they are served.
+class Lane:
+  ## Replies and daemon messages such as ping, pong, propval and errors.
+  CONTROL = 0
+  ## Message deliveries (msgtext and msgbin).
+  BULK = 1
+
+## What to do with a bulk frame when the queue of a client is full.
+class Policy:
+  ## Wait until there is room, holding up the sender; a client that doesn't
+  # make room in time is disconnected.
+  BLOCK = 'block'
+  ## Drop the new frame.
+  DROP_NEWEST = 'drop-newest'
+  ## Drop queued frames, oldest first, until the new frame fits.
+  DROP_OLDEST = 'drop-oldest'
+  ## Drop the new frame and tell the sender with error busy.
+  BUSY = 'busy'
+  ## All of the policies.
+  ALL = (BLOCK, DROP_NEWEST, DROP_OLDEST, BUSY)
+
+## Get the lane for a frame sent to a client.
+# @param data The frame (or frames) to be sent.
+def classify(data):
+  if data.startswith('msgbin') or data.startswith('msgtext '):
+    return Lane.BULK
+  return Lane.CONTROL
+
+## Outbox writing queued frames to a client socket.
+#
+# Frames are always written whole.  Whenever a frame has been written,
+# all queued control frames go out before the next bulk frame, so a ping
+# waits for at most one bulk write however much bulk data is queued.
+#
+# When nothing is queued, data is written straight away by the caller
+# as far as the socket takes it without blocking, and only the rest is
+# left to the outbox thread.  The thread is started when there is such a
+# backlog and ends once it has written everything, so clients that keep
+# up with their deliveries don't have a thread of their own.
+#
+# The bulk lane holds at most max_bytes and max_msgs (a single frame is
+# always let through an empty lane); what happens to frames beyond that is
+# decided by the policy.  Control frames are never held back.  A sender held
+# up by Policy.BLOCK for longer than the timeout gives up on the client: the
+# outbox is shut down and the error callback called with socket.timeout.
+#
+# Bulk frames can be queued with a key; a queued frame is replaced by a
+# newer frame with the same key, so only the latest state is written.
+#
+# A playernsd::stream::Stream can be queued as a bulk frame too; it is
+# written as its payload arrives, with nothing else in between, once it is
+# ready.  Until then, control frames are still written.
+class Outbox():
+  ## Initialise the outbox.
+  # @param self The playernsd::outbox::Outbox instance.
+  # @param sock The socket of the client.
+  # @param sent_callback The callback called with (data, count, seconds)
+  #        after data has been written.
+  # @param error_callback The callback called with the socket error when
+  #        writing fails.
+  # @param max_bytes The maximum number of bulk bytes queued (0 is no limit).
+  # @param max_msgs The maximum number of bulk messages queued (0 is no
+  #        limit).
+  # @param policy The playernsd::outbox::Policy when the limit is reached.
+  # @param timeout The seconds a sender is held up by Policy.BLOCK.
+  def __init__(self, sock, sent_callback, error_callback, max_bytes=0,
+      max_msgs=0, policy=Policy.DROP_OLDEST, timeout=BLOCK_TIMEOUT):
+    self.socket = sock
+    self.sent_callback = sent_callback
+    self.error_callback = error_callback
+    self.max_bytes = max_bytes
+    self.max_msgs = max_msgs
+    self.policy = policy
+    self.timeout = timeout
+    ## The queued [data, count, key] items of each lane.
+    self.lanes = (deque(), deque())
+    # The queued bulk items that have a key, by key
+    self.__keyed = {}
+    ## The number of bytes queued in the bulk lane.
+    self.queued_bytes = 0
+    ## The number of messages queued in the bulk lane.
+    self.queued_msgs = 0
+    self.__dropped = stats.registry.counter('playernsd_queue_dropped_total',
+      'Messages dropped because the queue of a client was full.',
+      policy=policy)
+    self.__conflated = stats.registry.counter(
+      'playernsd_queue_conflated_total',
+      'Queued state messages replaced by a newer one.')
+    self.__blocked = stats.registry.counter('playernsd_queue_blocked_total',
+      'Senders held up because the queue of a client was full.')
+    self.__blocked_time = stats.registry.histogram(
+      'playernsd_queue_blocked_seconds',
+      'Time senders were held up because the queue of a client was full.')
+    # The lock is taken directly on the fast path, which is cheaper than
+    # entering the conditions sharing it
+    self.__lock = threading.Lock()
+    self.__cond = threading.Condition(self.__lock)
+    self.__space = threading.Condition(self.__lock)
+    self.__running = True
+    self.__waiting = False
+    # Set while some thread is writing to the socket
+    self.__busy = False
+    # A frame partially written by a caller: (data, offset, count, start)
+    self.__partial = None
+    # The stream being written
+    self.__stream = None
+    # The thread writing the backlog, while there is one
+    self.__thread = None
+    # Set once a sender has been held up for longer than the timeout
+    self.__stalled = False
+  ## Queue data to be sent.
+  # @param self The playernsd::outbox::Outbox instance.
+  # @param data The frame (or frames) to be sent.
+  # @param count The number of messages in the data.
+  # @param lane The lane to queue the data in (by default from the data).
+  # @param key The key of a bulk frame that replaces a queued frame with the
+  #        same key (None for no conflation).
+  # @return False if the data was dropped.
+  def put(self, data, count=1, lane=None, key=None):
+    if isinstance(data, Stream):
+      lane = Lane.BULK
+    elif lane == None:
+      lane = classify(data)
+    with self.__lock:
+      if not self.__running:
+        return False
+      if key != None and key in self.__keyed:
+        item = self.__keyed[key]
+        self.queued_bytes += len(data) - len(item[0])
+        self.queued_msgs += count - item[1]
+        item[0] = data
+        item[1] = count
+        self.__conflated.inc()
+        return True
+      if lane == Lane.BULK and not self.fits(data, count) and \
+          not self.make_room(data, count):
+        stalled = self.__stalled
+      elif self.__busy or self.__partial or self.lanes[0] or \
+          self.lanes[1] or isinstance(data, Stream):
+        item = [data, count, key]
+        self.lanes[lane].append(item)
+        if isinstance(data, Stream):
+          data.listener = self.poke
+        if lane == Lane.BULK:
+          self.queued_bytes += len(data)
+          self.queued_msgs += count
+          if key != None:
+            self.__keyed[key] = item
+        self.wake()
+        return True
+      else:
+        self.__busy = True
+        stalled = None
+    if stalled == None:
+      self.write(data, count)
+      return True
+    if stalled:
+      self.shutdown()
+      self.error_callback(socket.timeout('queue full for ' +
+        str(self.timeout) + 's'))
+    return False
+  ## Check whether bulk data fits in the queue (with the lock held).
+  # @param self The playernsd::outbox::Outbox instance.
+  # @param data The data.
+  # @param count The number of messages in the data.
+  def fits(self, data, count):
+    return not self.lanes[Lane.BULK] or \
+      ((not self.max_bytes or self.queued_bytes + len(data) <= self.max_bytes)
+      and (not self.max_msgs or self.queued_msgs + count <= self.max_msgs))
+  ## Apply the policy to bulk data that doesn't fit (with the lock held).
+  # @param self The playernsd::outbox::Outbox instance.
+  # @param data The data.
+  # @param count The number of messages in the data.
+  # @return True if the data can now be queued.
+  def make_room(self, data, count):
+    if self.policy == Policy.BLOCK and not self.__stalled:
+      start = time.time()
+      self.__blocked.inc()
+      while self.__running and not self.fits(data, count):
+        remaining = start + self.timeout - time.time()
+        if remaining <= 0:
+          self.__stalled = True
+          break
+        self.__space.wait(remaining)
+      self.__blocked_time.observe(time.time() - start)
+      return self.__running and not self.__stalled
+    elif self.policy == Policy.DROP_OLDEST:
+      bulk = self.lanes[Lane.BULK]
+      while not self.fits(data, count):
+        old, n, key = bulk.popleft()
+        if isinstance(old, Stream):
+          old.close()
+        self.queued_bytes -= len(old)
+        self.queued_msgs -= n
+        self.__keyed.pop(key, None)
+        self.__dropped.inc(n)
+      return True
+    self.__dropped.inc(count)
+    return False
+  ## Write data without blocking, leaving the rest to the outbox thread.
+  # @param self The playernsd::outbox::Outbox instance.
+  # @param data The data to write.
+  # @param count The number of messages in the data.
+  def write(self, data, count):
+    start = time.time()
+    try:
+      n = self.socket.send(data, socket.MSG_DONTWAIT)
+    except socket.error, e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        self.close()
+        self.error_callback(e)
+        return
+      n = 0
+    if n == len(data):
+      self.sent_callback(data, count, time.time() - start)
+    with self.__lock:
+      if n < len(data):
+        self.__partial = (data, n, count, start)
+      self.__busy = False
+      if self.__partial or self.lanes[0] or self.lanes[1]:
+        self.wake()
+  ## Get the outbox thread to write the backlog (with the lock held).
+  #
+  # The thread is started if there isn't one, and otherwise only woken up
+  # when it is idle, not for every frame.
+  # @param self The playernsd::outbox::Outbox instance.
+  def wake(self):
+    if self.__thread == None:
+      self.__thread = Thread(target=self.run)
+      self.__thread.daemon = True
+      self.__thread.start()
+    elif self.__waiting:
+      self.__cond.notify()
+  ## Wake up the outbox thread waiting for a stream to be ready.
+  # @param self The playernsd::outbox::Outbox instance.
+  def poke(self):
+    with self.__lock:
+      if self.__waiting:
+        self.__cond.notify()
+  ## Stop writing and shut down the socket straight away.
+  #
+  # This wakes up anything blocked on the socket, such as the outbox
+  # thread in the middle of a write to a client that has stopped reading,
+  # and the handler of the client waiting for its commands.
+  # @param self The playernsd::outbox::Outbox instance.
+  def shutdown(self):
+    self.close()
+    try:
+      self.socket.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+  ## Get the next data to write.
+  # @param self The playernsd::outbox::Outbox instance.
+  # @return The partially written frame as (data, offset, count, start),
+  #         or a list of [data, count, key] items, or None to stop, when
+  #         the outbox is closed or everything has been written.
+  def next(self):
+    control, bulk = self.lanes
+    with self.__lock:
+      # wait for a caller writing straight away to finish, or for the
+      # stream next in line to be ready
+      while self.__running and ((self.__busy and (self.__partial or
+          control or bulk)) or (not self.__partial and not control and
+          bulk and isinstance(bulk[0][0], Stream) and
+          not bulk[0][0].ready())):
+        self.__waiting = True
+        self.__cond.wait()
+        self.__waiting = False
+      if not self.__running or not (self.__partial or control or bulk):
+        self.__thread = None
+        return None
+      self.__busy = True
+      if self.__partial:
+        partial = self.__partial
+        self.__partial = None
+        return partial
+      if control:
+        items = list(control)
+        control.clear()
+        return items
+      # Small bulk frames are written together, streams on their own
+      items = [bulk.popleft()]
+      size = len(items[0][0])
+      while bulk and size + len(bulk[0][0]) <= BATCH_BYTES and \
+          not isinstance(items[0][0], Stream) and \
+          not isinstance(bulk[0][0], Stream):
+        items.append(bulk.popleft())
+        size += len(items[-1][0])
+      self.queued_bytes -= size
+      for data, count, key in items:
+        self.queued_msgs -= count
+        self.__keyed.pop(key, None)
+      self.__space.notify_all()
+      return items
+  ## Worker routine writing the queued data.
+  # @param self The playernsd::outbox::Outbox instance.
+  def run(self):
+    while True:
+      items = self.next()
+      if items == None:
+        break
+      if isinstance(items, tuple):
+        data, offset, count, start = items
+        pending = buffer(data, offset)
+      elif isinstance(items[0][0], Stream):
+        self.write_stream(items[0][0], items[0][1])
+        continue
+      else:
+        data = ''.join(item[0] for item in items)
+        count = sum(item[1] for item in items)
+        start = time.time()
+        pending = data
+      try:
+        self.socket.sendall(pending)
+        self.sent_callback(data, count, time.time() - start)
+      except socket.error, e:
+        self.close()
+        self.error_callback(e)
+      with self.__lock:
+        self.__busy = False
+  ## Write a stream as its payload arrives.
+  # @param self The playernsd::outbox::Outbox instance.
+  # @param stream The playernsd::stream::Stream instance.
+  # @param count The number of messages in the stream.
+  def write_stream(self, stream, count):
+    with self.__lock:
+      self.__stream = stream
+      if not self.__running:
+        stream.close()
+    try:
+      for chunk in stream:
+        start = time.time()
+        self.socket.sendall(chunk)
+        self.sent_callback(chunk, count, time.time() - start)
+        count = 0
+    except socket.error, e:
+      self.close()
+      self.error_callback(e)
+    with self.__lock:
+      self.__stream = None
+      self.__busy = False
+  ## Stop the outbox thread, dropping anything not yet written.
+  # @param self The playernsd::outbox::Outbox instance.
+  def close(self):
+    with self.__lock:
+      self.__running = False
+      self.__partial = None
+      for item in self.lanes[Lane.BULK]:
+        if isinstance(item[0], Stream):
+          item[0].close()
+      if self.__stream:
+        self.__stream.close()
+      self.lanes[0].clear()
+      self.lanes[1].clear()
+      self.__keyed.clear()
+      self.queued_bytes = self.queued_msgs = 0
+      self.__cond.notify()
+      self.__space.notify_all()
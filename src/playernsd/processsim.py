@@ -0,0 +1,274 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file processsim.py
+# The simulation class that hosts a python simulation script in a child
+# process, so that the simulation does not compete with the daemon for
+# the interpreter lock.
+
+import os
+import imp
+import logging
+import threading
+from multiprocessing import Process, Pipe
+from threading import Thread
+from playernsd import new_simulation, new_client, send_batch, send_group
+from playernsd.simulation import wait_step
+
+log = logging.getLogger('playernsd')
+
+## Call type for communication between the daemon and the child process.
+class CallType:
+  NEW_CLIENT = 0
+  REMOVE_CLIENT = 1
+  SEND = 2
+  PROPGET = 3
+  PROPSET = 4
+  RECV = 5
+  RECVMANY = 6
+  PROPVAL = 7
+  STOP = 8
+  SEND_GROUP = 9
+  SEND_BATCH = 10
+  ADVANCE = 11
+  STEPPED = 12
+
+## Entry point of the child process hosting the simulation script.
+# @param args The arguments for the simulation, starting with the script.
+# @param calls The connection the daemon's calls are received from.
+# @param events The connection the simulation's callbacks are sent to.
+# @param parent_ends The daemon's ends of the connections, which are closed
+#        so the child notices when the daemon goes away.
+def host(args, calls, events, parent_ends):
+  for c in parent_ends:
+    c.close()
+  # The callbacks are made from the simulation's threads as well as this
+  # one, so the frames are sent one at a time
+  lock = threading.Lock()
+  def event(e):
+    with lock:
+      events.send(e)
+  def recv_callback(_from, to, msg):
+    event((CallType.RECV, _from, to, msg))
+  def prop_val_callback(_from, prop, val):
+    event((CallType.PROPVAL, _from, prop, val))
+  def recv_many_callback(batch):
+    event((CallType.RECVMANY, batch))
+  module = os.path.splitext(args[0])[0]
+  script = imp.load_source(module, args[0])
+  sim = new_simulation(script.Simulation, args, recv_callback,
+    prop_val_callback, recv_many_callback)
+  sim.daemon = True
+  sim.start()
+  def advance(until):
+    if hasattr(sim, 'advance'):
+      sim.advance(until)
+    # everything received within the step has been sent before this
+    event((CallType.STEPPED,))
+  handlers = {
+    CallType.NEW_CLIENT: lambda clientid, handle:
+      new_client(sim, clientid, handle),
+    CallType.REMOVE_CLIENT: sim.remove_client,
+    CallType.SEND: sim.send,
+    CallType.SEND_GROUP: lambda _from, group, members, msg:
+      send_group(sim, _from, group, members, msg),
+    CallType.SEND_BATCH: lambda batch: send_batch(sim, batch),
+    CallType.PROPGET: sim.prop_get,
+    CallType.PROPSET: sim.prop_set,
+    CallType.ADVANCE: advance,
+  }
+  while True:
+    try:
+      call = calls.recv()
+    except EOFError:
+      break
+    if call[0] == CallType.STOP:
+      break
+    handlers[call[0]](*call[1:])
+  sim.stop()
+  events.close()
+
+## Simulation thread for controlling a simulation script in a child process.
+#
+# The calls made by the daemon are forwarded to the child process and
+# the callbacks made by the simulation script are read back by this
+# thread, which invokes the daemon's callbacks.
+class ProcessSimulation(Thread):
+  ## Initialise this class.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  # @param args The arguments for the simulation, starting with the script.
+  # @param recv_callback The callback to call when a message is recevied.
+  # @param prop_val_callback The callback to call when a property
+  #        value is received.
+  # @param recv_many_callback The callback to call with a batch of
+  #        received messages (optional).
+  def __init__(self, args, recv_callback, prop_val_callback,
+      recv_many_callback=None):
+    self.recv_callback = recv_callback
+    self.prop_val_callback = prop_val_callback
+    self.recv_many_callback = recv_many_callback
+    self.__lock = threading.Lock()
+    # Set once the child process has gone, after which calls are dropped
+    self.__gone = False
+    # Set once the child process has been asked to stop
+    self.__stopping = False
+    ## Set when the simulation has reached the requested simulated time.
+    self.stepped = threading.Event()
+    ## Whether the simulation answers steps (None until it is known).
+    self.steps = None
+    Thread.__init__(self)
+    calls_r, self.__calls = Pipe(False)
+    self.__events, events_w = Pipe(False)
+    self.p = Process(target=host, args=(args, calls_r, events_w,
+      (self.__calls, self.__events)))
+    self.p.daemon = True
+    self.p.start()
+    # Only the child needs these ends.
+    calls_r.close()
+    events_w.close()
+  ## Forward a call to the child process.
+  #
+  # If the child process has died, the simulation is disabled, as the
+  # threads making the calls only expect socket errors.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  # @param call The call tuple.
+  # @return False if the child process has gone.
+  def call(self, call):
+    with self.__lock:
+      if self.__gone:
+        return False
+      try:
+        self.__calls.send(call)
+        return True
+      except (IOError, EOFError, OSError), e:
+        self.__gone = True
+        log.error('Simulation process died (' + str(e) + '), ' +
+          'the simulation is disabled.')
+        return False
+  ## Note that the child process has gone, logging it unless it was asked
+  # to stop or has been noticed already.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  def gone(self):
+    with self.__lock:
+      if self.__gone:
+        return
+      self.__gone = True
+    if not self.__stopping:
+      log.error('Simulation process died, the simulation is disabled.')
+  ## Add new client.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  # @param clientid Client ID of client added.
+  # @param handle The integer handle of the client.
+  def new_client(self, clientid, handle=None):
+    self.call((CallType.NEW_CLIENT, clientid, handle))
+  ## Remove a client after its disconnected.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  # @param clientid Client ID of client to be removed.
+  def remove_client(self, clientid):
+    self.call((CallType.REMOVE_CLIENT, clientid))
+  ## Send a message simulated.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  # @param _from The client that the message comes from.
+  # @param to The client that the messagesa is being sent to.
+  # @param msg The message to be sent.
+  def send(self, _from, to, message):
+    self.call((CallType.SEND, _from, to, message))
+  ## Send a message to the members of a group.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  # @param _from The client that the message comes from.
+  # @param group The name of the group.
+  # @param members The clients in the group, other than the sender.
+  # @param msg The message to be sent.
+  def send_group(self, _from, group, members, message):
+    self.call((CallType.SEND_GROUP, _from, group, members, message))
+  ## Send a batch of messages.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  # @param batch List of (from, to, msg) tuples.
+  def send_batch(self, batch):
+    self.call((CallType.SEND_BATCH, batch))
+  ## Getting a property value from the simulation.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  # @param _from The client that asked this.
+  # @param prop The property name.
+  def prop_get(self, _from, prop):
+    self.call((CallType.PROPGET, _from, prop))
+  ## Setting a property value in the simulation.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  # @param _from The client that asked this.
+  # @param prop The property name.
+  # @param val The property value.
+  def prop_set(self, _from, prop, val):
+    self.call((CallType.PROPSET, _from, prop, val))
+  ## Ask the simulation to advance simulated time, without waiting.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  # @param until The simulated time to advance to in seconds.
+  def step(self, until):
+    self.stepped.clear()
+    if not self.call((CallType.ADVANCE, until)):
+      # the child process has gone, so there is nothing to wait for
+      self.stepped.set()
+  ## Advance simulated time, waiting until the simulation has got there
+  # (or STEP_TIMEOUT has passed).
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  # @param until The simulated time to advance to in seconds.
+  def advance(self, until):
+    self.step(until)
+    wait_step(self, until)
+  ## Worker routine that dispatches the callbacks from the child process.
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  def run(self):
+    while True:
+      try:
+        event = self.__events.recv()
+      except EOFError:
+        break
+      if event[0] == CallType.RECV:
+        self.recv_callback(*event[1:])
+      elif event[0] == CallType.RECVMANY:
+        if self.recv_many_callback:
+          self.recv_many_callback(event[1])
+        else:
+          for _from, to, msg in event[1]:
+            for t in (to if isinstance(to, list) else [to]):
+              self.recv_callback(_from, t, msg)
+      elif event[0] == CallType.PROPVAL:
+        self.prop_val_callback(*event[1:])
+      elif event[0] == CallType.STEPPED:
+        self.steps = True
+        self.stepped.set()
+    self.stepped.set()
+    self.gone()
+    log.info('Simulation process exited.')
+  ## Stop the simulation
+  # @param self The playernsd::processsim::ProcessSimulation instance.
+  def stop(self):
+    self.__stopping = True
+    if self.p.is_alive():
+      self.call((CallType.STOP,))
+      self.p.join()
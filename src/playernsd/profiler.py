@@ -0,0 +1,178 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file profiler.py
+# The profiler classes that sample the stacks of all threads into a
+# collapsed stack file (for flamegraphs) and snapshot memory allocations
+# using tracemalloc, while the daemon keeps running.
+
+import os
+import sys
+import time
+import logging
+import threading
+from threading import Thread
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+log = logging.getLogger('playernsd')
+
+## Interval in seconds between stack samples.
+SAMPLE_INTERVAL = 0.005
+## Number of frames tracemalloc keeps for each allocation.
+TRACE_FRAMES = 16
+
+## Get a name for a thread that tells what it is.
+# @param t The thread.
+def thread_name(t):
+  if t.__class__ is threading.Thread or t.__class__ is threading._MainThread:
+    return t.name
+  return t.__class__.__name__
+
+## Stack sampler thread.
+#
+# Samples the stacks of all other threads for a number of seconds and
+# writes the counts in the collapsed stack format, one line per stack with
+# the frames separated by semicolons, as read by flamegraph.pl.
+class StackSampler(Thread):
+  ## Initialise the sampler.
+  # @param self The playernsd::profiler::StackSampler instance.
+  # @param seconds The number of seconds to sample for.
+  # @param path The file to write the collapsed stacks to.
+  # @param interval The interval in seconds between samples.
+  def __init__(self, seconds, path, interval=SAMPLE_INTERVAL):
+    Thread.__init__(self)
+    self.seconds = seconds
+    self.path = path
+    self.interval = interval
+  ## Take one sample of all threads.
+  # @param self The playernsd::profiler::StackSampler instance.
+  # @param counts Dictionary of collapsed stacks to counts.
+  def sample(self, counts):
+    names = dict((t.ident, thread_name(t)) for t in threading.enumerate())
+    for ident, frame in sys._current_frames().iteritems():
+      if ident == self.ident:
+        continue
+      stack = []
+      while frame:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (code.co_name,
+          os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+      stack.append(names.get(ident, str(ident)))
+      key = ';'.join(reversed(stack))
+      counts[key] = counts.get(key, 0) + 1
+  ## Worker routine that samples and writes the collapsed stacks.
+  # @param self The playernsd::profiler::StackSampler instance.
+  def run(self):
+    counts = {}
+    end = time.time() + self.seconds
+    while time.time() < end:
+      self.sample(counts)
+      time.sleep(self.interval)
+    with open(self.path, 'w') as f:
+      for key, count in sorted(counts.iteritems()):
+        f.write(key + ' ' + str(count) + '\n')
+    log.info('Wrote stack profile to ' + self.path)
+
+## Memory profiler using tracemalloc.
+#
+# The allocations are attributed to categories by the first frame of their
+# traceback that matches a category rule.
+class MemoryProfiler():
+  ## Initialise the profiler.
+  # @param self The playernsd::profiler::MemoryProfiler instance.
+  # @param rules List of (category, filename, function) rules, where the
+  #        filename is matched against the end of the frame's filename and
+  #        a function of None matches any function.
+  def __init__(self, rules):
+    self.rules = rules
+  ## Check whether memory profiling is available.
+  def available(self):
+    return tracemalloc != None
+  ## Start tracing allocations.
+  # @param self The playernsd::profiler::MemoryProfiler instance.
+  def start(self):
+    if tracemalloc and not tracemalloc.is_tracing():
+      tracemalloc.start(TRACE_FRAMES)
+  ## Get the category of an allocation traceback.
+  # @param self The playernsd::profiler::MemoryProfiler instance.
+  # @param traceback The tracemalloc traceback.
+  # @param functions Dictionary of (filename, lineno) to function names.
+  def category(self, traceback, functions):
+    for frame in traceback:
+      function = functions.get((frame.filename, frame.lineno))
+      for category, filename, func in self.rules:
+        if frame.filename.endswith(filename) and \
+            (func == None or func == function):
+          return category
+    return 'other'
+  ## Take a snapshot and write a report of the memory per category.
+  # @param self The playernsd::profiler::MemoryProfiler instance.
+  # @param path The file to write the report to.
+  def snapshot(self, path):
+    self.start()
+    snapshot = tracemalloc.take_snapshot()
+    functions = self.functions()
+    sizes = {}
+    for stat in snapshot.statistics('traceback'):
+      c = self.category(stat.traceback, functions)
+      size, count = sizes.get(c, (0, 0))
+      sizes[c] = (size + stat.size, count + stat.count)
+    with open(path, 'w') as f:
+      f.write('# category bytes blocks\n')
+      for c, (size, count) in sorted(sizes.iteritems(),
+          key=lambda i: -i[1][0]):
+        f.write('%s %d %d\n' % (c, size, count))
+      f.write('# top lines\n')
+      for stat in snapshot.statistics('lineno')[:25]:
+        f.write(str(stat) + '\n')
+    log.info('Wrote memory profile to ' + path)
+  ## Find the function names of the traced lines.
+  #
+  # tracemalloc only records filenames and line numbers, so the function
+  # of each line is looked up from the loaded modules' code objects.
+  # @param self The playernsd::profiler::MemoryProfiler instance.
+  def functions(self):
+    functions = {}
+    for module in sys.modules.values():
+      for obj in getattr(module, '__dict__', {}).values():
+        for f in getattr(obj, '__dict__', {}).values() + [obj]:
+          code = getattr(f, 'func_code', None)
+          if not code:
+            continue
+          line = code.co_firstlineno
+          functions[(code.co_filename, line)] = code.co_name
+          for increment in code.co_lnotab[1::2]:
+            line += ord(increment)
+            functions[(code.co_filename, line)] = code.co_name
+    return functions
@@ -31,7 +31,12 @@
 # The remote client class that contains information about the client.
 
 ## Remote client class for handling... remote clients.
-class RemoteClient():
+#
+# There is one of these for every connection, so it is a slotted record.
+class RemoteClient(object):
+  __slots__ = ('name', 'address', 'version', 'socket', 'handle', 'bytes_in',
+    'bytes_out', 'msgs_in', 'msgs_out', 'outbox', 'groups', 'compressor',
+    'token', 'udp')
   ## Initialise the data for a remote client.
   def __init__(self, name, address, version, request):
     ## The clientid(or username) of the client.
@@ -42,3 +47,26 @@ class RemoteClient():
     self.version = version
     ## The socket of the client.
     self.socket = request
+    ## The integer handle of the client once registered (see
+    # playernsd::handles::Handles).
+    self.handle = None
+    ## The number of bytes received from the client.
+    self.bytes_in = 0
+    ## The number of bytes sent to the client.
+    self.bytes_out = 0
+    ## The number of commands received from the client.
+    self.msgs_in = 0
+    ## The number of messages sent to the client.
+    self.msgs_out = 0
+    ## The playernsd::outbox::Outbox writing to the client.
+    self.outbox = None
+    ## The names of the groups the client has joined.
+    self.groups = set()
+    ## The playernsd::compress::Compressor of the binary messages
+    # delivered to the client, if it asked for compression.
+    self.compressor = None
+    ## The token of the client's datagrams, if it asked for UDP.
+    self.token = None
+    ## The (host, port) the client's UDP deliveries are sent to, once it
+    # has subscribed.
+    self.udp = None
@@ -0,0 +1,320 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file sharding.py
+# The sharded simulation class that spreads the clients over several
+# simulation instances, such as one ns3 process per area of a large fleet.
+#
+# Messages between clients of the same shard are simulated by that shard
+# alone.  A shard knows nothing of the clients of the other shards, such as
+# their positions, so a message to a client of another shard is delivered
+# directly, without being simulated.  A broadcast is simulated in the
+# sender's shard and delivered directly to the clients of the other shards.
+# A simulation such as lineofsight therefore only decides the traffic
+# within a shard.
+
+import os
+import imp
+import zlib
+import time
+import logging
+from threading import Thread
+from playernsd import stats, new_client, send_batch
+from playernsd.simulation import STEP_TIMEOUT, wait_step
+
+log = logging.getLogger('playernsd')
+
+## Assigns clients to shards by a hash of the client id.
+class HashPolicy():
+  ## Get the shard of a client.
+  # @param self The playernsd::sharding::HashPolicy instance.
+  # @param clientid The client id.
+  # @param count The number of shards.
+  # @return The shard index.
+  def shard(self, clientid, count):
+    return (zlib.crc32(clientid) & 0xffffffff) % count
+
+## Assigns clients to shards as listed in a file.
+#
+# Each line of the file has a client id and a shard index; clients that
+# are not listed are assigned by hash.
+class MappingPolicy(HashPolicy):
+  ## Read the mapping.
+  # @param self The playernsd::sharding::MappingPolicy instance.
+  # @param path The path of the mapping file.
+  def __init__(self, path):
+    ## The shard index of each listed client id.
+    self.mapping = {}
+    for line in open(path):
+      fields = line.split()
+      if len(fields) == 2 and not line.startswith('#'):
+        self.mapping[fields[0]] = int(fields[1])
+  ## Get the shard of a client.
+  # @param self The playernsd::sharding::MappingPolicy instance.
+  # @param clientid The client id.
+  # @param count The number of shards.
+  # @return The shard index.
+  def shard(self, clientid, count):
+    if clientid in self.mapping:
+      return self.mapping[clientid] % count
+    return HashPolicy.shard(self, clientid, count)
+
+## Assigns clients to shards by the region their starting position is in.
+#
+# The file has lines "region SHARD X0 Y0 X1 Y1" giving the area of a shard,
+# and lines "CLIENTID X Y" giving the starting position of a client.
+# Clients outside of every region, or without a position, are assigned by
+# hash.
+class RegionPolicy(HashPolicy):
+  ## Read the regions and positions.
+  # @param self The playernsd::sharding::RegionPolicy instance.
+  # @param path The path of the region file.
+  def __init__(self, path):
+    ## List of (shard, x0, y0, x1, y1) regions.
+    self.regions = []
+    ## The starting (x, y) position of each listed client id.
+    self.positions = {}
+    for line in open(path):
+      fields = line.split()
+      if not fields or line.startswith('#'):
+        continue
+      if fields[0] == 'region' and len(fields) == 6:
+        self.regions.append((int(fields[1]),) + tuple(map(float, fields[2:])))
+      elif len(fields) == 3:
+        self.positions[fields[0]] = (float(fields[1]), float(fields[2]))
+  ## Get the shard of a client.
+  # @param self The playernsd::sharding::RegionPolicy instance.
+  # @param clientid The client id.
+  # @param count The number of shards.
+  # @return The shard index.
+  def shard(self, clientid, count):
+    if clientid in self.positions:
+      x, y = self.positions[clientid]
+      for shard, x0, y0, x1, y1 in self.regions:
+        if x0 <= x < x1 and y0 <= y < y1:
+          return shard % count
+    return HashPolicy.shard(self, clientid, count)
+
+## Create a policy from its description.
+# @param spec "hash", "map:FILE", "region:FILE", or a python script
+#        defining a Policy class with a shard(clientid, count) method.
+# @return The policy instance.
+def new_policy(spec):
+  if spec == 'hash':
+    return HashPolicy()
+  elif spec.startswith('map:'):
+    return MappingPolicy(spec[4:])
+  elif spec.startswith('region:'):
+    return RegionPolicy(spec[7:])
+  elif spec.endswith('.py') and os.path.exists(spec):
+    module = os.path.splitext(os.path.basename(spec))[0]
+    return imp.load_source(module, spec).Policy()
+  raise ValueError('unknown shard policy ' + spec)
+
+## Simulation spread over several shards.
+#
+# The clients are addressed like in the shards: by their handles if the
+# shards are addressed by handle (see playernsd::simulation::Simulation),
+# and otherwise by their ids.
+class ShardedSimulation(Thread):
+  ## Initialise this class.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  # @param count The number of shards.
+  # @param policy The policy assigning clients to shards.
+  # @param factory Function creating a shard, taking the recv, prop_val
+  #        and recv_many callbacks.
+  # @param recv_callback The callback to call when a message is recevied.
+  # @param prop_val_callback The callback to call when a property
+  #        value is received.
+  # @param recv_many_callback The callback to call with a batch of
+  #        received messages (optional).
+  def __init__(self, count, policy, factory, recv_callback, prop_val_callback,
+      recv_many_callback=None):
+    self.policy = policy
+    self.recv_callback = recv_callback
+    self.prop_val_callback = prop_val_callback
+    self.recv_many_callback = recv_many_callback
+    ## The shard index of each client.
+    self.assigned = {}
+    self.__crossed = stats.registry.counter('playernsd_shard_crossings_total',
+      'Messages delivered between shards without being simulated.')
+    Thread.__init__(self)
+    ## The simulation instance of each shard.
+    self.shards = []
+    for i in range(count):
+      shard = factory(
+        lambda _from, to, msg: self.deliver([(_from, to, msg)]),
+        prop_val_callback, self.deliver)
+      shard.daemon = True
+      self.shards.append(shard)
+    ## Whether the clients are addressed by handle.
+    self.by_handle = all(getattr(s, 'by_handle', False) for s in self.shards)
+    ## The address of a broadcast.
+    self.broadcast = '__broadcast__'
+    if self.by_handle:
+      self.broadcast = 0
+    stats.registry.gauge('playernsd_shard_clients',
+      'Number of clients assigned to a shard.',
+      lambda: [({'shard': i}, self.assigned.values().count(i))
+        for i in range(len(self.shards))])
+    # in place of the gauge each simulation executable registers, which
+    # only the last shard would be left with
+    stats.registry.gauge('playernsd_sim_queue_depth',
+      'Number of frames queued for the simulation executable of a shard.',
+      lambda: [({'shard': i}, s.writer.send_queue.qsize())
+        for i, s in enumerate(self.shards) if hasattr(s, 'writer')])
+  ## Add new client to the shard the policy assigns it to.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  # @param clientid Client ID of client added.
+  # @param handle The integer handle of the client.
+  def new_client(self, clientid, handle=None):
+    i = self.policy.shard(clientid, len(self.shards))
+    log.info('Client ' + clientid + ' is in shard ' + str(i) + '.')
+    if self.by_handle:
+      self.assigned[handle] = i
+    else:
+      self.assigned[clientid] = i
+    new_client(self.shards[i], clientid, handle)
+  ## Remove a client.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  # @param clientid The client removed.
+  def remove_client(self, clientid):
+    self.shards[self.assigned.pop(clientid)].remove_client(clientid)
+  ## Send a message in the shard of the sender.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  # @param _from The client that the message comes from.
+  # @param to The client that the message is being sent to.
+  # @param message The message to be sent.
+  def send(self, _from, to, message):
+    i = self.assigned[_from]
+    if to == self.broadcast or self.assigned.get(to) == i:
+      self.shards[i].send(_from, to, message)
+    if to == self.broadcast:
+      self.cross(i, _from, None, message)
+    elif to in self.assigned and self.assigned[to] != i:
+      self.cross(i, _from, [to], message)
+  ## Send a batch of messages, each shard getting its part in one call.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  # @param batch List of (from, to, msg) tuples.
+  def send_batch(self, batch):
+    parts = {}
+    for _from, to, message in batch:
+      i = self.assigned[_from]
+      if to == self.broadcast or self.assigned.get(to) == i:
+        parts.setdefault(i, []).append((_from, to, message))
+      if to == self.broadcast:
+        self.cross(i, _from, None, message)
+      elif to in self.assigned and self.assigned[to] != i:
+        self.cross(i, _from, [to], message)
+    for i, part in parts.iteritems():
+      send_batch(self.shards[i], part)
+  ## Send a message to the members of a group.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  # @param _from The client that the message comes from.
+  # @param group The name of the group.
+  # @param members The clients in the group, other than the sender.
+  # @param message The message to be sent.
+  def send_group(self, _from, group, members, message):
+    i = self.assigned[_from]
+    local = [m for m in members if self.assigned.get(m) == i]
+    if local:
+      shard = self.shards[i]
+      if hasattr(shard, 'send_group'):
+        shard.send_group(_from, group, local, message)
+      else:
+        for m in local:
+          shard.send(_from, m, message)
+    remote = [m for m in members if m in self.assigned and
+      self.assigned[m] != i]
+    if remote:
+      self.cross(i, _from, remote, message)
+  ## Pass messages received in a shard on.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  # @param batch List of (from, to, msg) tuples, where to may be a list.
+  def deliver(self, batch):
+    if self.recv_many_callback:
+      self.recv_many_callback(batch)
+      return
+    for _from, to, msg in batch:
+      for t in (to if isinstance(to, list) else [to]):
+        self.recv_callback(_from, t, msg)
+  ## Deliver a message to clients of other shards, without simulating it.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  # @param i The index of the sender's shard.
+  # @param _from The client that the message comes from.
+  # @param tos The clients of other shards the message is for, or None for
+  #        all of them.
+  # @param msg The message.
+  def cross(self, i, _from, tos, msg):
+    if tos == None:
+      tos = [c for c, j in self.assigned.items() if j != i]
+    if tos:
+      self.__crossed.inc()
+      self.deliver([(_from, tos, msg)])
+  ## Getting a property value from the shard of the client that asked.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  # @param _from The client that asked this.
+  # @param prop The property name.
+  def prop_get(self, _from, prop):
+    self.shards[self.assigned[_from]].prop_get(_from, prop)
+  ## Setting a property value in the shard of the client that asked.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  # @param _from The client that asked this.
+  # @param prop The property name.
+  # @param val The property value.
+  def prop_set(self, _from, prop, val):
+    self.shards[self.assigned[_from]].prop_set(_from, prop, val)
+  ## Advance simulated time in all of the shards at once.
+  #
+  # The shards that can be stepped without waiting are all stepped first,
+  # and then waited for together, for at most STEP_TIMEOUT.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  # @param until The simulated time to advance to in seconds.
+  def advance(self, until):
+    stepping = [s for s in self.shards if hasattr(s, 'step')]
+    for s in stepping:
+      s.step(until)
+    for s in self.shards:
+      if s not in stepping and hasattr(s, 'advance'):
+        s.advance(until)
+    end = time.time() + STEP_TIMEOUT
+    for s in stepping:
+      wait_step(s, until, end)
+  ## Worker routine running the shards until they have all finished.
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  def run(self):
+    for shard in self.shards:
+      shard.start()
+    for shard in self.shards:
+      shard.join()
+  ## Stop the simulation
+  # @param self The playernsd::sharding::ShardedSimulation instance.
+  def stop(self):
+    for shard in self.shards:
+      shard.stop()
@@ -0,0 +1,341 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file simpool.py
+# A pool of warm simulator executables that daemons attach to over a unix
+# socket, so that back-to-back experiments don't each wait for a simulator
+# such as ns3 to start and build its topology.
+#
+# The pool is started with the simulator command line:
+#
+#   python -m playernsd.simpool -n 4 /tmp/wifisim.sock ./wifisim ARGS...
+#
+# and each daemon attaches to a simulator with --pool /tmp/wifisim.sock.
+# The pipe protocol is relayed between them unchanged.  When the daemon
+# goes away, the simulator is sent a RESET frame and given back to the
+# pool once it replies with RESETACK; a simulator that exits or doesn't
+# reply in time is replaced by a fresh one.
+
+import os
+import sys
+import time
+import socket
+import select
+import logging
+import optparse
+import subprocess
+from threading import Thread, Lock
+from struct import unpack_from
+from playernsd.simulation import MessageType, Simulation, READ_SIZE
+
+log = logging.getLogger('playernsd')
+
+## Seconds to wait for a simulator to acknowledge a reset.
+RESET_TIMEOUT = 30.0
+
+## Get the end of the frame at a position of a buffer.
+# @param data The buffer.
+# @param pos The position of the frame.
+# @param from_sim Whether the frame comes from the simulator.
+# @return The position after the frame, or None if it isn't complete.
+def frame_end(data, pos, from_sim):
+  n = len(data)
+  cmd = ord(data[pos])
+  if cmd in (MessageType.SEND, MessageType.SENDZ, MessageType.RECV):
+    if n < pos + 13:
+      return None
+    end = pos + 13 + unpack_from('<I', data, pos + 9)[0]
+  elif cmd in (MessageType.SENDMANY, MessageType.RECVMANY):
+    if n < pos + 9:
+      return None
+    start = pos + 9 + 4 * unpack_from('<I', data, pos + 5)[0]
+    if n < start + 4:
+      return None
+    end = start + 4 + unpack_from('<I', data, start)[0]
+  elif cmd in (MessageType.PROPGET, MessageType.PROPVAL):
+    if n < pos + 9:
+      return None
+    end = pos + 9 + unpack_from('<I', data, pos + 5)[0]
+  elif cmd == MessageType.PROPSET:
+    if n < pos + 5:
+      return None
+    end = pos + 5 + unpack_from('<I', data, pos + 1)[0]
+  elif cmd == MessageType.DISCONNECT:
+    # the simulator's own disconnect frame has no client id
+    end = pos + (from_sim and 1 or 5)
+  elif cmd == MessageType.STEP:
+    end = pos + 9
+  else:
+    end = pos + 1
+  if end > n:
+    return None
+  return end
+
+## Get the length of the complete frames at the start of a buffer.
+# @param data The buffer.
+# @param from_sim Whether the frames come from the simulator.
+# @return The number of bytes of complete frames.
+def complete(data, from_sim):
+  pos = 0
+  while pos < len(data):
+    end = frame_end(data, pos, from_sim)
+    if end == None:
+      break
+    pos = end
+  return pos
+
+## A simulator executable kept by the pool.
+class Simulator():
+  ## Start the simulator.
+  # @param self The playernsd::simpool::Simulator instance.
+  # @param command The command line of the simulator.
+  def __init__(self, command):
+    self.p = subprocess.Popen(command,
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    ## The file descriptor of the simulator's stdout.
+    self.fd = self.p.stdout.fileno()
+    ## The number of runs the simulator has been attached to.
+    self.runs = 0
+  ## Write to the simulator.
+  # @param self The playernsd::simpool::Simulator instance.
+  # @param data The frames to write.
+  def write(self, data):
+    self.p.stdin.write(data)
+  ## Reset the simulator, waiting for it to acknowledge.
+  # @param self The playernsd::simpool::Simulator instance.
+  # @param data What was read from the simulator but not yet passed on,
+  #        starting at a frame.
+  # @param timeout Seconds to wait for the acknowledgement.
+  # @return Whether the simulator has been reset.
+  def reset(self, data='', timeout=RESET_TIMEOUT):
+    try:
+      self.write(chr(MessageType.RESET))
+    except (IOError, OSError):
+      return False
+    deadline = time.time() + timeout
+    while True:
+      # Skip whatever was meant for the previous run
+      pos = 0
+      while pos < len(data):
+        if ord(data[pos]) == MessageType.RESETACK:
+          return True
+        end = frame_end(data, pos, True)
+        if end == None:
+          break
+        pos = end
+      data = data[pos:]
+      remaining = deadline - time.time()
+      if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+        log.warn('Simulator %d did not acknowledge the reset.', self.p.pid)
+        return False
+      stuff = os.read(self.fd, READ_SIZE)
+      if len(stuff) == 0:
+        return False
+      data += stuff
+  ## Check that the simulator is still running.
+  # @param self The playernsd::simpool::Simulator instance.
+  # @return Whether the simulator is running.
+  def alive(self):
+    return self.p.poll() == None
+  ## Stop the simulator.
+  # @param self The playernsd::simpool::Simulator instance.
+  def kill(self):
+    if self.alive():
+      self.p.kill()
+    self.p.wait()
+
+## Pass frames between a daemon and a simulator until either goes away.
+# @param conn The socket of the daemon.
+# @param sim The playernsd::simpool::Simulator instance.
+# @return What was read from the simulator but not passed on, or None if
+#         the simulator has exited.
+def relay(conn, sim):
+  # only whole frames are passed on, so that the simulator can be reset
+  # between frames whenever the daemon goes away
+  up = ''
+  down = ''
+  cfd = conn.fileno()
+  while True:
+    ready = select.select([cfd, sim.fd], [], [])[0]
+    if cfd in ready:
+      try:
+        stuff = conn.recv(READ_SIZE)
+      except socket.error:
+        stuff = ''
+      if len(stuff) == 0:
+        return down
+      up += stuff
+      end = complete(up, False)
+      if end:
+        try:
+          sim.write(up[:end])
+        except (IOError, OSError):
+          return None
+        up = up[end:]
+    if sim.fd in ready:
+      stuff = os.read(sim.fd, READ_SIZE)
+      if len(stuff) == 0:
+        return None
+      down += stuff
+      end = complete(down, True)
+      if end:
+        try:
+          conn.sendall(down[:end])
+        except socket.error:
+          return down[end:]
+        down = down[end:]
+
+## The pool of warm simulators.
+class Pool():
+  ## Start the simulators of the pool.
+  # @param self The playernsd::simpool::Pool instance.
+  # @param command The command line of the simulators.
+  # @param size The number of simulators to keep warm.
+  # @param timeout Seconds to wait for a simulator to reset.
+  def __init__(self, command, size, timeout=RESET_TIMEOUT):
+    self.command = command
+    self.size = size
+    self.timeout = timeout
+    self.lock = Lock()
+    ## The simulators waiting for a run.
+    self.idle = [Simulator(command) for i in range(size)]
+    log.info('Started %d simulators.', size)
+  ## Take a simulator for a run, starting one if none is warm.
+  # @param self The playernsd::simpool::Pool instance.
+  # @return The playernsd::simpool::Simulator instance.
+  def take(self):
+    with self.lock:
+      while self.idle:
+        sim = self.idle.pop()
+        if sim.alive():
+          return sim
+        sim.kill()
+    log.warn('No warm simulator left, starting one.')
+    return Simulator(self.command)
+  ## Give a simulator back after a run.
+  # @param self The playernsd::simpool::Pool instance.
+  # @param sim The playernsd::simpool::Simulator instance.
+  # @param data What was read from the simulator but not passed on, or
+  #        None if the simulator has exited.
+  def give(self, sim, data):
+    if data != None and sim.alive() and sim.reset(data, self.timeout):
+      with self.lock:
+        if len(self.idle) < self.size:
+          self.idle.append(sim)
+          return
+    sim.kill()
+    # Keep the pool full
+    with self.lock:
+      short = len(self.idle) < self.size
+    if short:
+      log.info('Replacing simulator %d.', sim.p.pid)
+      sim = Simulator(self.command)
+      with self.lock:
+        self.idle.append(sim)
+  ## Attach a daemon to a simulator for a run.
+  # @param self The playernsd::simpool::Pool instance.
+  # @param conn The socket of the daemon.
+  def attach(self, conn):
+    sim = self.take()
+    sim.runs += 1
+    log.info('Run attached to simulator %d (run %d).', sim.p.pid, sim.runs)
+    data = relay(conn, sim)
+    conn.close()
+    log.info('Run detached from simulator %d.', sim.p.pid)
+    self.give(sim, data)
+  ## Accept daemons on a unix socket forever.
+  # @param self The playernsd::simpool::Pool instance.
+  # @param path The path of the socket.
+  def serve(self, path):
+    if os.path.exists(path):
+      os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(16)
+    log.info('Listening on ' + path + '.')
+    while True:
+      conn = listener.accept()[0]
+      t = Thread(target=self.attach, args=(conn,))
+      t.daemon = True
+      t.start()
+  ## Stop all simulators.
+  # @param self The playernsd::simpool::Pool instance.
+  def stop(self):
+    with self.lock:
+      for sim in self.idle:
+        sim.kill()
+      self.idle = []
+
+## The connection to a pooled simulator, standing in for subprocess.Popen.
+class Connection():
+  ## Attach to a simulator of the pool.
+  # @param self The playernsd::simpool::Connection instance.
+  # @param path The path of the pool's socket.
+  def __init__(self, path):
+    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.socket.connect(path)
+    self.stdin = self.socket.makefile('wb', 0)
+    self.stdout = self.socket
+
+## Simulation with a simulator of a pool instead of a new executable.
+#
+# The process argument is the path of the pool's socket.
+class PooledSimulation(Simulation):
+  ## Attach to a simulator of the pool.
+  # @param self The playernsd::simpool::PooledSimulation instance.
+  # @return The playernsd::simpool::Connection instance.
+  def spawn(self):
+    log.info('Attaching to the simulator pool at ' + self.process[0] + '.')
+    return Connection(self.process[0])
+
+## Run a pool from the command line.
+def main():
+  parser = optparse.OptionParser(
+    usage='usage: %prog [options] SOCKET COMMAND [ARGS...]')
+  parser.disable_interspersed_args()
+  parser.add_option('-n', '--size', type='int', dest='size', default=2,
+    help='number of simulators to keep warm [default: %default]')
+  parser.add_option('-t', '--reset-timeout', type='float', dest='timeout',
+    default=RESET_TIMEOUT,
+    help='seconds to wait for a simulator to reset [default: %default]')
+  (options, args) = parser.parse_args()
+  if len(args) < 2:
+    parser.error('a socket path and a simulator command are needed')
+  logging.basicConfig(level=logging.INFO,
+    format='%(asctime)s %(levelname)-5s : %(message)s')
+  pool = Pool(args[1:], options.size, options.timeout)
+  try:
+    pool.serve(args[0])
+  except KeyboardInterrupt:
+    pass
+  finally:
+    pool.stop()
+
+if __name__ == '__main__':
+  main()
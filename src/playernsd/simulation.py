@@ -32,24 +32,91 @@
 # such as ns3 to provide more accurate simulations.
 
 import sys
+import os
 import subprocess
 import thread
+import threading
+import time
 import logging
 from Queue import Queue
 from threading import Thread
 from struct import *
+from collections import OrderedDict
+from playernsd import stats, Message
+from playernsd.logqueue import Payload, sample
 
 log = logging.getLogger('playernsd')
 
+## Number of bytes to read from the executable at once.
+READ_SIZE = 65536
+## Wall clock seconds to wait for a simulation to reach a lockstep step.
+STEP_TIMEOUT = 10.0
+## Number of playernsd::Message payloads remembered while in the executable.
+MARKED = 4096
+
+## Wait for a simulation to reach the simulated time it was stepped to.
+#
+# A simulation that doesn't get there in time is warned about and left
+# behind, so that the lockstep thread carries on.  One that doesn't answer
+# its first step in time is taken not to implement stepping, and isn't
+# waited for again until it answers a step.
+# @param sim The simulation, with a stepped threading.Event and a steps
+#        attribute.
+# @param until The simulated time in seconds.
+# @param end The wall clock time to wait until (STEP_TIMEOUT from now if
+#        None).
+# @return False if the time ran out.
+def wait_step(sim, until, end=None):
+  if sim.steps == False:
+    return sim.stepped.is_set()
+  if end == None:
+    end = time.time() + STEP_TIMEOUT
+  if sim.stepped.wait(max(end - time.time(), 0)):
+    return True
+  if sim.steps == None:
+    sim.steps = False
+    log.warn('Simulation did not answer its first step within ' +
+      str(STEP_TIMEOUT) + 's, so it is not waited for until it does.')
+  else:
+    log.warn('Simulation did not reach ' + repr(until) + 's within ' +
+      str(STEP_TIMEOUT) + 's, carrying on without it.')
+  return False
+
 ## Message type for communication over the stdin/stdout with the executable.
 class MessageType:
   NEW_CLIENT = 0
   SEND = 1
   RECV = 2
+  ## A client has gone.  Sent for every node when the daemon stops, and
+  # also as soon as a client leaves if the daemon is run with
+  # --sim-reuse-nodes, in which case the node may be given to a later
+  # client.
   DISCONNECT = 3
   PROPGET = 4
   PROPSET = 5
   PROPVAL = 6
+  ## One message delivered to several clients; the frame carries the
+  # sender, the recipient count, the recipients and the message.
+  RECVMANY = 7
+  ## Advance simulated time up to the given time in microseconds; the
+  # executable replies with the same frame once it has got there.  Sent
+  # every step when the daemon is run in lockstep (-s), and an executable
+  # that is used that way must answer it: one that doesn't answer the
+  # first STEP within STEP_TIMEOUT is not waited for until it does.
+  STEP = 8
+  ## One message sent to several clients, such as the members of a group;
+  # the frame is laid out like RECVMANY.  Only sent if the daemon is run
+  # with --sim-sendmany.
+  SENDMANY = 9
+  ## Like SEND, but with the message compressed by zlib; only sent if the
+  # daemon is run with --compress-sim.
+  SENDZ = 10
+  ## Forget all clients, properties and pending messages and go back to
+  # simulated time zero, as when just started; sent between runs by
+  # playernsd::simpool.
+  RESET = 11
+  ## The executable's reply to RESET once it has been reset.
+  RESETACK = 12
 
 ## Writer thread to write messages to stdout (or any stream).
 class Writer(Thread):
@@ -59,13 +126,18 @@ class Writer(Thread):
   def __init__(self, stream):
     self.send_queue = Queue()
     self.stream = stream
+    ## The playernsd::compress::Compressor of the messages sent, if the
+    # executable takes SENDZ frames.
+    self.compressor = None
+    ## Whether the executable takes SENDMANY frames.
+    self.sendmany = False
     Thread.__init__(self)
   ## Setting a property value in the target executable.
   # @param self The playernsd::simulation::Writer instance.
   # @param prop The property name.
   # @param val The property value.
   def prop_set(self, prop, val):
-    log.debug("SIMPROPSET " + prop + ":" + val)
+    log.debug("SIMPROPSET %s:%s", prop, val)
     self.send_queue.put(pack('<BI', MessageType.PROPSET,
       len(prop) + len(val) + 2) + prop + '\0' + val + '\0')
   ## Getting a property value from the target executable.
@@ -73,7 +145,7 @@ class Writer(Thread):
   # @param _from The client that asked this.
   # @param prop The property name.
   def prop_get(self, _from, prop):
-    log.debug("SIMPROPGET " + prop)
+    log.debug("SIMPROPGET %s", prop)
     self.send_queue.put(pack('<BII', MessageType.PROPGET, _from,
       len(prop)+1) + prop + '\0')
   ## Send a message in the target executable.
@@ -82,19 +154,59 @@ class Writer(Thread):
   # @param to The client that the messagesa is being sent to.
   # @param msg The message to be sent.
   def send(self, _from, to, msg):
-    data = pack('<BIII', MessageType.SEND,
-              _from, to, len(msg)) + msg
-    log.debug("SIMSEND(%d->%d) %s" % (_from, to,
-      data.encode(sys.stdout.encoding,
-        'backslashreplace').replace('\n', '\\n')))
+    self.send_queue.put(self.frame(_from, to, msg))
+  ## Make the frame sending a message in the target executable.
+  # @param self The playernsd::simulation::Writer instance.
+  # @param _from The client that the message comes from.
+  # @param to The client that the message is being sent to.
+  # @param msg The message to be sent.
+  # @return The SEND (or SENDZ) frame.
+  def frame(self, _from, to, msg):
+    z = self.compressor and self.compressor.compress(msg)
+    if z:
+      data = pack('<BIII', MessageType.SENDZ, _from, to, len(z)) + z
+    else:
+      data = pack('<BIII', MessageType.SEND,
+                _from, to, len(msg)) + msg
+    if log.isEnabledFor(logging.DEBUG) and sample():
+      log.debug("SIMSEND(%d->%d) %s", _from, to, Payload(msg))
+    return data
+  ## Send a batch of messages in the target executable, written at once.
+  # @param self The playernsd::simulation::Writer instance.
+  # @param batch List of (from, to, msg) tuples.
+  def send_batch(self, batch):
+    self.send_queue.put(''.join([self.frame(_from, to, msg)
+      for _from, to, msg in batch]))
+  ## Send one message to several clients in the target executable.
+  #
+  # Executables that don't take SENDMANY frames get a SEND frame for each
+  # client, written at once.
+  # @param self The playernsd::simulation::Writer instance.
+  # @param _from The client that the message comes from.
+  # @param tos The clients that the message is being sent to.
+  # @param msg The message to be sent.
+  def send_many(self, _from, tos, msg):
+    if not self.sendmany:
+      self.send_queue.put(''.join([self.frame(_from, to, msg) for to in tos]))
+      return
+    data = pack('<BII%dI' % len(tos), MessageType.SENDMANY, _from,
+      len(tos), *tos) + pack('<I', len(msg)) + msg
+    if log.isEnabledFor(logging.DEBUG) and sample():
+      log.debug("SIMSENDMANY(%d->%s) %s", _from, tos, Payload(msg))
     self.send_queue.put(data)
   ## Disconnect from the socket.
   # @param self The playernsd::simulation::Writer instance.
   # @param socket The socket that is disconnecting.
   def disconnect(self, socket):
     data = pack('<BI', MessageType.DISCONNECT, socket)
-    log.debug("SIMDISCONNECT(%d)" % socket)
+    log.debug("SIMDISCONNECT(%d)", socket)
     self.send_queue.put(data)
+  ## Advance simulated time in the target executable.
+  # @param self The playernsd::simulation::Writer instance.
+  # @param until The simulated time to advance to in microseconds.
+  def step(self, until):
+    log.debug("SIMSTEP(%d)", until)
+    self.send_queue.put(pack('<BQ', MessageType.STEP, until))
   ## Queue processing worker routine.
   # @param self The playernsd::simulation::Writer instance.
   def run(self):
@@ -110,49 +222,194 @@ class Writer(Thread):
     self.send_queue.put('')
 
 ## Simulation thread for controlling the simulation executable.
+#
+# The clients are addressed by their integer handles (0 being the
+# broadcast address) rather than by their ids, both in the calls and in
+# the callbacks, and are looked up in lists rather than dictionaries.  Each
+# client is given a node of the executable: a new one, as executables
+# usually have a network configured for a number of nodes in advance, or,
+# with reuse_nodes, its handle, so that the nodes in use stay within the
+# number of clients connected at once.
 class Simulation(Thread):
+  ## The simulation is addressed by client handles.
+  by_handle = True
+  ## Whether the nodes of clients that have gone are given to new clients.
+  reuse_nodes = False
   ## Initialise this class.
   # @param self The playernsd::simulation::Simulation instance.
   # @param process The process to run and execute to simulate.
   # @param recv_callback The callback to call when a message is recevied.
   # @param prop_val_callback The callback to call when a property
   #        value is received.
-  def __init__(self, process, recv_callback, prop_val_callback):
-    self.cidi = {'__broadcast__':0}
-    self.cidt = ['__broadcast__']
+  # @param recv_many_callback The callback to call with a batch of
+  #        received messages (optional).
+  def __init__(self, process, recv_callback, prop_val_callback,
+      recv_many_callback=None):
+    ## The node of each handle (None for handles not in use).
+    self.cidi = [0]
+    ## The handle of each node (None for nodes not in use).
+    self.cidt = [0]
+    ## The client id of each node.
+    self.ids = ['__broadcast__']
+    ## The node of each client id, for property names.
+    self.names = {'__broadcast__':0}
+    ## The number of nodes given out.
     self.cidn = 1
+    ## The number of clients.
+    self.count = 0
     self.recv_callback = recv_callback
+    self.recv_many_callback = recv_many_callback
     self.prop_val_callback = prop_val_callback
     self.process = process
+    ## Set when the executable has reached the requested simulated time.
+    self.stepped = threading.Event()
+    ## Whether the executable answers STEP frames (None until it is known).
+    self.steps = None
+    ## The playernsd::Message payloads in the executable and the number of
+    # deliveries of each still to come, by (from node, payload).
+    self.marked = OrderedDict()
+    self.marked_lock = threading.Lock()
     Thread.__init__(self)
-    self.p = subprocess.Popen(self.process,
-      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    self.p = self.spawn()
     self.writer = Writer(self.p.stdin)
     self.writer.daemon = True
     self.writer.start()
+    stats.registry.gauge('playernsd_sim_queue_depth',
+      'Number of frames queued for the simulation executable.',
+      self.writer.send_queue.qsize)
+  ## Start the executable.
+  # @param self The playernsd::simulation::Simulation instance.
+  # @return The subprocess.Popen instance, or anything with stdin and
+  #         stdout like it.
+  def spawn(self):
+    return subprocess.Popen(self.process,
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
   ## Add new client.
   #
   # This typically can only added up to some application defined limit of
   # maximum clients.
   # @param self The playernsd::simulation::Simulation instance.
   # @param clientid Client ID of client added.
-  def new_client(self, clientid):
-    self.cidi[clientid] = self.cidn
-    self.cidt.append(clientid)
-    self.cidn += 1
+  # @param handle The integer handle of the client.
+  def new_client(self, clientid, handle):
+    if self.reuse_nodes:
+      node = handle
+    else:
+      node = self.cidn
+      self.cidn += 1
+    if handle >= len(self.cidi):
+      self.cidi.extend([None] * (handle + 1 - len(self.cidi)))
+    if node >= len(self.cidt):
+      self.cidt.extend([None] * (node + 1 - len(self.cidt)))
+      self.ids.extend([None] * (node + 1 - len(self.ids)))
+    self.cidi[handle] = node
+    self.cidt[node] = handle
+    self.ids[node] = clientid
+    self.names[clientid] = node
+    self.count += 1
   ## Remove a client.
   #
-  # This is unsupported, because external simulations usually need pre-configured
+  # Whatever the executable still delivers from or to the client's node is
+  # dropped.  The executable is only told that the node is free if nodes
+  # are reused, because external simulations usually need pre-configured
   # networks.
-  def remove_client(self, clientid):
-    pass
+  # @param self The playernsd::simulation::Simulation instance.
+  # @param handle The handle of the client removed.
+  def remove_client(self, handle):
+    node = handle < len(self.cidi) and self.cidi[handle]
+    if not node:
+      return
+    self.cidi[handle] = None
+    self.cidt[node] = None
+    del self.names[self.ids[node]]
+    self.ids[node] = None
+    self.count -= 1
+    if self.reuse_nodes:
+      self.writer.disconnect(node)
+  ## Get the node of a client.
+  # @param self The playernsd::simulation::Simulation instance.
+  # @param handle The handle of the client.
+  # @return The node, or None if the client isn't in the simulation.
+  def node(self, handle):
+    if handle < len(self.cidi):
+      return self.cidi[handle]
+    return None
   ## Send a message in the target executable.
   # @param self The playernsd::simulation::Simulation instance.
   # @param _from The client that the message comes from.
   # @param to The client that the messagesa is being sent to.
   # @param msg The message to be sent.
   def send(self, _from, to, message):
-    self.writer.send(self.cidi[_from], self.cidi[to], message)
+    _from = self.cidi[_from]
+    to = self.node(to)
+    if to == None:
+      return
+    self.mark(_from, message, to and 1 or self.count - 1)
+    self.writer.send(_from, to, message)
+  ## Send a batch of messages in the target executable.
+  # @param self The playernsd::simulation::Simulation instance.
+  # @param batch List of (from, to, msg) tuples.
+  def send_batch(self, batch):
+    cidi = self.cidi
+    batch = [(cidi[_from], cidi[to], message)
+      for _from, to, message in batch
+      if to < len(cidi) and cidi[to] != None]
+    for _from, to, message in batch:
+      self.mark(_from, message, to and 1 or self.count - 1)
+    if batch:
+      self.writer.send_batch(batch)
+  ## Send a message to the members of a group in the target executable.
+  # @param self The playernsd::simulation::Simulation instance.
+  # @param _from The client that the message comes from.
+  # @param group The name of the group.
+  # @param members The clients in the group, other than the sender.
+  # @param msg The message to be sent.
+  def send_group(self, _from, group, members, message):
+    if members:
+      cidi = self.cidi
+      tos = [cidi[m] for m in members if m < len(cidi) and cidi[m] != None]
+      self.mark(cidi[_from], message, len(tos))
+      self.writer.send_many(cidi[_from], tos, message)
+  ## Remember a playernsd::Message payload sent into the executable.
+  #
+  # The executable only hands back the sender and the bytes of a message,
+  # so a playernsd::Message is looked up by those when it comes back, until
+  # all of its deliveries have been made.  An ordinary message with the
+  # same bytes from the same sender takes its place, so that it isn't
+  # delivered as the earlier one.
+  # @param self The playernsd::simulation::Simulation instance.
+  # @param _from The node of the sender.
+  # @param message The message.
+  # @param count The number of deliveries to expect.
+  def mark(self, _from, message, count):
+    if not isinstance(message, Message):
+      if self.marked:
+        with self.marked_lock:
+          self.marked.pop((_from, message), None)
+      return
+    with self.marked_lock:
+      self.marked.pop((_from, message), None)
+      if count > 0:
+        self.marked[(_from, message)] = [message, count]
+        if len(self.marked) > MARKED:
+          self.marked.popitem(False)
+  ## Get back the playernsd::Message payload of a delivered message.
+  # @param self The playernsd::simulation::Simulation instance.
+  # @param _from The node of the sender.
+  # @param msg The bytes of the message.
+  # @param count The number of deliveries made.
+  # @return The playernsd::Message, or msg if it wasn't one.
+  def unmark(self, _from, msg, count):
+    if not self.marked:
+      return msg
+    with self.marked_lock:
+      entry = self.marked.get((_from, msg))
+      if entry == None:
+        return msg
+      entry[1] -= count
+      if entry[1] <= 0:
+        del self.marked[(_from, msg)]
+    return entry[0]
   ## Substitute the property name using the _from parameter.
   #
   # This allows property names using the 'self.' namespace to refer
@@ -164,7 +421,7 @@ class Simulation(Thread):
   def prop_substitution(self, _from, prop):
     if _from != 0 and prop.startswith("self."):
       return '__node' + str(_from) + '.' + prop[len('self.'):]
-    for t,i in self.cidi.iteritems():
+    for t,i in self.names.iteritems():
       if prop.startswith(t + '.'):
         return '__node' + str(i) + '.' + prop[len(t)+1:]
     return prop
@@ -183,38 +440,134 @@ class Simulation(Thread):
   def prop_set(self, _from, prop, val):
     prop = self.prop_substitution(self.cidi[_from], prop)
     self.writer.prop_set(prop, val)
+  ## Ask the executable to advance simulated time, without waiting.
+  # @param self The playernsd::simulation::Simulation instance.
+  # @param until The simulated time to advance to in seconds.
+  def step(self, until):
+    self.stepped.clear()
+    self.writer.step(int(until * 1000000))
+  ## Advance simulated time, waiting until the executable has got there
+  # (or STEP_TIMEOUT has passed).
+  # @param self The playernsd::simulation::Simulation instance.
+  # @param until The simulated time to advance to in seconds.
+  def advance(self, until):
+    self.step(until)
+    wait_step(self, until)
+  ## Deliver a batch of received messages.
+  #
+  # The batch is handed over in one call if a batch callback was given,
+  # otherwise each message is passed to the single message callback.
+  # @param self The playernsd::simulation::Simulation instance.
+  # @param batch List of (from, to, msg) tuples, where to may be a list.
+  def deliver(self, batch):
+    if self.recv_many_callback:
+      self.recv_many_callback(batch)
+      return
+    for _from, to, msg in batch:
+      if isinstance(to, list):
+        for t in to:
+          self.recv_callback(_from, t, msg)
+      else:
+        self.recv_callback(_from, to, msg)
   ## Worker routine for simulation.
+  #
+  # Everything available on the pipe is read at once and all complete
+  # frames are parsed from the buffer, so that consecutive messages are
+  # delivered as one batch.
   # @param self The playernsd::simulation::Simulation instance.
   def run(self):
-    while True:
-      stuff = self.p.stdout.read(1)
+    fd = self.p.stdout.fileno()
+    cidt = self.cidt
+    data = ''
+    running = True
+    while running:
+      stuff = os.read(fd, READ_SIZE)
       # If nothing read, terminate simulation thread.
-      if stuff == None or len(stuff) == 0:
-        break;
-      cmd = unpack('B', stuff)[0]
-      if cmd == MessageType.DISCONNECT:
+      if len(stuff) == 0:
         break
-      elif cmd == MessageType.RECV:
-        _from, to, length = unpack('<III', self.p.stdout.read(12))
-        msg = self.p.stdout.read(length)
-        # Ignore out of range clients
-        log.debug("SIMRECV(%d->%d) %s" % (_from, to,
-          msg.encode(sys.stdout.encoding,
-            'backslashreplace').replace('\n', '\\n')))
-        if to < self.cidn and _from < self.cidn:
-          self.recv_callback(self.cidt[_from], self.cidt[to], msg)
-      elif cmd == MessageType.PROPVAL:
-        _from, length = unpack('<II', self.p.stdout.read(8))
-        propval = self.p.stdout.read(length)
-        prop, val = propval[:-1].split('\0')
-        prop = self.prop_substitution(0, prop)
-        self.prop_val_callback(self.cidt[_from], prop, val)
+      data += stuff
+      batch = []
+      pos = 0
+      while pos < len(data):
+        cmd = ord(data[pos])
+        if cmd == MessageType.DISCONNECT:
+          running = False
+          break
+        elif cmd == MessageType.RECV:
+          if len(data) < pos + 13:
+            break
+          _from, to, length = unpack_from('<III', data, pos + 1)
+          if len(data) < pos + 13 + length:
+            break
+          msg = data[pos+13:pos+13+length]
+          pos += 13 + length
+          if log.isEnabledFor(logging.DEBUG) and sample():
+            log.debug("SIMRECV(%d->%d) %s", _from, to, Payload(msg))
+          # Ignore out of range clients
+          if to < len(cidt) and _from < len(cidt) and \
+              cidt[to] != None and cidt[_from] != None:
+            batch.append((cidt[_from], cidt[to], self.unmark(_from, msg, 1)))
+        elif cmd == MessageType.RECVMANY:
+          if len(data) < pos + 9:
+            break
+          _from, count = unpack_from('<II', data, pos + 1)
+          start = pos + 9 + 4 * count
+          if len(data) < start + 4:
+            break
+          length = unpack_from('<I', data, start)[0]
+          if len(data) < start + 4 + length:
+            break
+          tos = unpack_from('<%dI' % count, data, pos + 9)
+          msg = data[start+4:start+4+length]
+          pos = start + 4 + length
+          if log.isEnabledFor(logging.DEBUG) and sample():
+            log.debug("SIMRECVMANY(%d->%s) %s", _from, tos, Payload(msg))
+          # Ignore out of range clients
+          if _from < len(cidt) and cidt[_from] != None:
+            batch.append((cidt[_from], [cidt[to] for to in tos
+              if to < len(cidt) and cidt[to] != None],
+              self.unmark(_from, msg, len(tos))))
+        elif cmd == MessageType.PROPVAL:
+          if len(data) < pos + 9:
+            break
+          _from, length = unpack_from('<II', data, pos + 1)
+          if len(data) < pos + 9 + length:
+            break
+          propval = data[pos+9:pos+9+length]
+          pos += 9 + length
+          # Keep ordering with the messages received before this value.
+          if batch:
+            self.deliver(batch)
+            batch = []
+          prop, val = propval[:-1].split('\0')
+          prop = self.prop_substitution(0, prop)
+          if _from < len(cidt) and cidt[_from] != None:
+            self.prop_val_callback(cidt[_from], prop, val)
+        elif cmd == MessageType.STEP:
+          if len(data) < pos + 9:
+            break
+          pos += 9
+          # Deliver everything received within the step first.
+          if batch:
+            self.deliver(batch)
+            batch = []
+          self.steps = True
+          self.stepped.set()
+        else:
+          log.warn("SIMUNKNOWN(%d)", cmd)
+          pos += 1
+      data = data[pos:]
+      if batch:
+        self.deliver(batch)
     self.stop()
   ## Stop the simulation
   # @param self The playernsd::simulation::Simulation instance.
   def stop(self):
-    for i in range(1, self.cidn):
-      self.writer.disconnect(i)
+    self.stepped.set()
+    # nodes that are reused were disconnected when their clients left
+    for i in range(1, len(self.cidt)):
+      if self.cidt[i] != None or not self.reuse_nodes:
+        self.writer.disconnect(i)
     self.writer.stop()
     self.writer.join()
 
@@ -0,0 +1,205 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file stats.py
+# The statistics classes for counters and latency histograms, which can be
+# rendered in the Prometheus text exposition format.
+
+import threading
+from bisect import bisect_left
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+## Default histogram bucket upper bounds in seconds.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+  0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+## Format a label set for the text format.
+# @param labels Tuple of (name, value) pairs.
+# @param extra Additional (name, value) pair appended (optional).
+def format_labels(labels, extra=None):
+  if extra:
+    labels = labels + (extra,)
+  if not labels:
+    return ''
+  return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+    .replace('"', '\\"').replace('\n', '\\n')) for k, v in labels) + '}'
+
+## Counter that only ever increases.
+class Counter():
+  ## Initialise the counter.
+  def __init__(self):
+    self.__lock = threading.Lock()
+    ## The current value of the counter.
+    self.value = 0
+  ## Increase the counter.
+  # @param n The amount to increase the counter by.
+  def inc(self, n=1):
+    with self.__lock:
+      self.value += n
+  ## Get the samples of this counter.
+  # @param name The metric name.
+  # @param labels Tuple of (name, value) label pairs.
+  def samples(self, name, labels):
+    return [name + format_labels(labels) + ' ' + repr(self.value)]
+
+## Histogram of observed values, such as latencies in seconds.
+class Histogram():
+  ## Initialise the histogram.
+  # @param buckets The bucket upper bounds.
+  def __init__(self, buckets=BUCKETS):
+    self.__lock = threading.Lock()
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    ## The sum of all observed values.
+    self.sum = 0.0
+    ## The number of observed values.
+    self.count = 0
+  ## Observe a value.
+  # @param v The value observed.
+  def observe(self, v):
+    i = bisect_left(self.buckets, v)
+    with self.__lock:
+      self.counts[i] += 1
+      self.sum += v
+      self.count += 1
+  ## Get the samples of this histogram.
+  # @param name The metric name.
+  # @param labels Tuple of (name, value) label pairs.
+  def samples(self, name, labels):
+    lines = []
+    total = 0
+    for le, c in zip(self.buckets, self.counts):
+      total += c
+      lines.append(name + '_bucket' + format_labels(labels, ('le', repr(le))) +
+        ' ' + str(total))
+    lines.append(name + '_bucket' + format_labels(labels, ('le', '+Inf')) +
+      ' ' + str(self.count))
+    lines.append(name + '_sum' + format_labels(labels) + ' ' + repr(self.sum))
+    lines.append(name + '_count' + format_labels(labels) + ' ' +
+      str(self.count))
+    return lines
+
+## Registry of all metrics of the daemon.
+class Registry():
+  ## Initialise the registry.
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.__families = {}
+    self.__order = []
+  ## Get or create a metric.
+  # @param cls The class of the metric.
+  # @param kind The metric type name.
+  # @param name The metric name.
+  # @param doc The help text of the metric.
+  # @param labels The label values of the metric.
+  def __metric(self, cls, kind, name, doc, labels):
+    key = tuple(sorted(labels.iteritems()))
+    family = self.__families.get(name)
+    if family and key in family[2]:
+      return family[2][key]
+    with self.__lock:
+      if name not in self.__families:
+        self.__families[name] = (kind, doc, {})
+        self.__order.append(name)
+      metrics = self.__families[name][2]
+      if key not in metrics:
+        metrics[key] = cls()
+      return metrics[key]
+  ## Get or create a counter.
+  # @param name The metric name.
+  # @param doc The help text of the metric.
+  # @param labels The label values of the metric.
+  def counter(self, name, doc, **labels):
+    return self.__metric(Counter, 'counter', name, doc, labels)
+  ## Get or create a histogram.
+  # @param name The metric name.
+  # @param doc The help text of the metric.
+  # @param labels The label values of the metric.
+  def histogram(self, name, doc, **labels):
+    return self.__metric(Histogram, 'histogram', name, doc, labels)
+  ## Add a gauge whose value is read when the metrics are rendered.
+  # @param name The metric name.
+  # @param doc The help text of the metric.
+  # @param function Function returning a value, or a list of
+  #        (labels dict, value) pairs.
+  # @param kind The metric type name (gauge by default).
+  def gauge(self, name, doc, function, kind='gauge'):
+    with self.__lock:
+      if name not in self.__families:
+        self.__order.append(name)
+      self.__families[name] = (kind, doc, function)
+  ## Render all metrics in the text exposition format.
+  def render(self):
+    lines = []
+    with self.__lock:
+      families = [(n, self.__families[n]) for n in self.__order]
+    for name, (kind, doc, metrics) in families:
+      lines.append('# HELP ' + name + ' ' + doc)
+      lines.append('# TYPE ' + name + ' ' + kind)
+      if callable(metrics):
+        value = metrics()
+        if not isinstance(value, list):
+          value = [({}, value)]
+        for labels, v in value:
+          lines.append(name + format_labels(tuple(sorted(labels.items()))) +
+            ' ' + repr(v))
+      else:
+        for labels, metric in sorted(metrics.items()):
+          lines.extend(metric.samples(name, labels))
+    return '\n'.join(lines) + '\n'
+
+## The registry instance used by the daemon.
+registry = Registry()
+
+## HTTP request handler serving the metrics.
+class MetricsHandler(BaseHTTPRequestHandler):
+  ## Reply with the rendered metrics.
+  def do_GET(self):
+    if self.path not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+    body = registry.render()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+  ## Requests are not logged.
+  def log_message(self, format, *args):
+    pass
+
+## Start serving the metrics over HTTP in a daemon thread.
+# @param address The (host, port) tuple to listen on.
+# @return The HTTP server instance.
+def serve(address):
+  server = HTTPServer(address, MetricsHandler)
+  t = threading.Thread(target=server.serve_forever)
+  t.daemon = True
+  t.start()
+  return server
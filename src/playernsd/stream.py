@@ -0,0 +1,145 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file stream.py
+# The stream class that passes a large message on in chunks as it is
+# received, instead of holding all of it in memory first.
+
+import threading
+import time
+
+## Maximum number of bytes of a stream buffered at once while it is read.
+BUFFER_BYTES = 262144
+## Seconds the rest of a stream may take to arrive once it is read.
+CUT_THROUGH_SECONDS = 0.25
+
+## A frame whose payload is written by one thread and read by another.
+#
+# Once the frame is being read, nothing else can be sent to the reader
+# until the whole payload is, so a stream is only ready to be read when
+# the rest of it is expected within CUT_THROUGH_SECONDS at the rate it has
+# been written so far (or it has all been written).  Until then the
+# payload is held as it is written, as it would be without streaming, so a
+# slow writer doesn't hold up the reader.  Once the stream is read, the
+# writer blocks while it buffers BUFFER_BYTES, so the memory taken by a
+# fast transfer is bounded however large the message is.  If the writer
+# gives up part way (abort), the rest of the payload is read as zeros, so
+# that the reader still gets a whole frame.
+class Stream():
+  ## Initialise the stream.
+  # @param self The playernsd::stream::Stream instance.
+  # @param header The frame header, read before the payload.
+  # @param length The payload length in bytes.
+  def __init__(self, header, length):
+    ## The frame header.
+    self.header = header
+    ## The payload length in bytes.
+    self.length = length
+    ## The callback called when data is written before the stream is read.
+    self.listener = None
+    self.__chunks = []
+    self.__buffered = 0
+    self.__written = 0
+    self.__start = time.time()
+    self.__reading = False
+    self.__aborted = False
+    self.__closed = False
+    self.__cond = threading.Condition(threading.Lock())
+  ## Get the number of bytes of the frame, counted against queue limits.
+  # @param self The playernsd::stream::Stream instance.
+  def __len__(self):
+    return len(self.header) + self.length
+  ## Check whether the stream can be read without holding up the reader
+  # for long.
+  # @param self The playernsd::stream::Stream instance.
+  def ready(self):
+    with self.__cond:
+      if self.__aborted or self.__closed or self.__written == self.length:
+        return True
+      # the rate isn't trusted before CUT_THROUGH_SECONDS have passed
+      elapsed = max(time.time() - self.__start, CUT_THROUGH_SECONDS)
+      return (self.length - self.__written) * elapsed <= \
+        self.__written * CUT_THROUGH_SECONDS
+  ## Append payload data, waiting while too much is buffered.
+  # @param self The playernsd::stream::Stream instance.
+  # @param chunk The data.
+  def write(self, chunk):
+    with self.__cond:
+      while self.__reading and self.__buffered >= BUFFER_BYTES and \
+          not self.__closed:
+        self.__cond.wait()
+      if self.__closed:
+        return
+      self.__chunks.append(chunk)
+      self.__buffered += len(chunk)
+      self.__written += len(chunk)
+      self.__cond.notify_all()
+      listener = not self.__reading and self.listener
+    if listener:
+      listener()
+  ## Give up writing the payload; the rest is read as zeros.
+  # @param self The playernsd::stream::Stream instance.
+  def abort(self):
+    with self.__cond:
+      self.__aborted = True
+      self.__cond.notify_all()
+      listener = not self.__reading and self.listener
+    if listener:
+      listener()
+  ## Stop reading; writes are discarded from now on.
+  # @param self The playernsd::stream::Stream instance.
+  def close(self):
+    with self.__cond:
+      self.__closed = True
+      self.__chunks = []
+      self.__cond.notify_all()
+  ## Read the header and then the payload as it is written.
+  # @param self The playernsd::stream::Stream instance.
+  def __iter__(self):
+    with self.__cond:
+      self.__reading = True
+    yield self.header
+    read = 0
+    while read < self.length:
+      with self.__cond:
+        while not self.__chunks and not self.__aborted and \
+            not self.__closed:
+          self.__cond.wait()
+        if self.__closed:
+          return
+        if self.__chunks:
+          chunks = self.__chunks
+          self.__chunks = []
+          self.__buffered = 0
+          self.__cond.notify_all()
+        else:
+          chunks = ['\0' * min(self.length - read, BUFFER_BYTES)]
+      for chunk in chunks:
+        read += len(chunk)
+        yield chunk
@@ -0,0 +1,95 @@
+#
+# Copyright (c) 2011, The University of York
+# All rights reserved.
+# Author(s):
+#   Tai Chi Minh Ralph Eastwood <tcmreastwood@gmail.com>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the The University of York nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# ANY ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF YORK BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+##@file unixserver.py
+# The unix domain socket server for clients on the daemon's host, which
+# skip the TCP stack of the loopback interface.
+#
+# The peers of a unix socket have no address, so each connection is known
+# by ('unix', n, pid, uid, gid), with the credentials of the peer process
+# from SO_PEERCRED where the platform has it (None otherwise).
+
+import os
+import sys
+import stat
+import socket
+import itertools
+import SocketServer
+from struct import unpack, calcsize
+
+## The SO_PEERCRED socket option, which Python 2 doesn't name on Linux.
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED',
+  sys.platform.startswith('linux') and 17 or None)
+## Format of the credentials of SO_PEERCRED.
+UCRED = '3i'
+
+## Get the socket address of a path, where a path starting with '@' is a
+# name in the abstract namespace.
+# @param path The path.
+def socket_address(path):
+  if path.startswith('@'):
+    return '\0' + path[1:]
+  return path
+
+## Threading unix domain socket server.
+class UnixServer(SocketServer.ThreadingUnixStreamServer):
+  ## Client threads must not keep the daemon alive when it quits.
+  daemon_threads = True
+  ## Bind the server, replacing a socket file left behind.
+  # @param self The playernsd::unixserver::UnixServer instance.
+  # @param path The path of the socket, or '@' and an abstract name.
+  # @param handler The request handler class.
+  def __init__(self, path, handler):
+    ## The path of the socket.
+    self.path = path
+    self.__connections = itertools.count(1)
+    if not path.startswith('@') and os.path.exists(path) and \
+        stat.S_ISSOCK(os.stat(path).st_mode):
+      os.unlink(path)
+    SocketServer.ThreadingUnixStreamServer.__init__(self,
+      socket_address(path), handler)
+  ## Accept a connection, naming it by the credentials of the peer.
+  # @param self The playernsd::unixserver::UnixServer instance.
+  # @return The (socket, address) of the connection.
+  def get_request(self):
+    request, unused = self.socket.accept()
+    pid = uid = gid = None
+    if SO_PEERCRED != None:
+      try:
+        pid, uid, gid = unpack(UCRED, request.getsockopt(socket.SOL_SOCKET,
+          SO_PEERCRED, calcsize(UCRED)))
+      except socket.error:
+        pass
+    return request, ('unix', next(self.__connections), pid, uid, gid)
+  ## Close the server, removing the socket file.
+  # @param self The playernsd::unixserver::UnixServer instance.
+  def server_close(self):
+    SocketServer.ThreadingUnixStreamServer.server_close(self)
+    if not self.path.startswith('@') and os.path.exists(self.path):
+      os.unlink(self.path)